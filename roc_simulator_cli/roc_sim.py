@@ -1,68 +1,208 @@
+'''
+Scriptable ROC simulator CLI for the (old) testship topics.
+
+Commands are read one per line, interactively, from a command file or from a stdin pipe:
+
+    write <COG|SOG|state> <value>       publish a value
+    read <COG_out|SOG_out|lat|lon|state_out|all>
+                                        print the latest received telemetry
+    wait <seconds>                      pause the script
+    flood <COG|SOG|state> <rate> <seconds> [value]
+                                        publish at rate per second for a while and report the
+                                        achieved rate and send latency percentiles
+
+A command can be prefixed with "@<seconds>" to run it at that time after the script started,
+instead of right after the previous one. Empty lines and lines starting with # are ignored.
+
+    @0    write SOG 5
+    @2.5  write COG 90
+    @10   read all
+    flood SOG 1000 10 5
+
+Flood mode can also be started directly, e.g. python3 roc_sim.py --flood SOG --rate 1000 --duration 10
+'''
+
+import argparse
+import json
+import sys
+import time
 import zenoh
 
-cog_out = ""
-sog_out = ""
-lat = ""
-lon = ""
-state_out = ""
+WRITE_TOPICS = ["COG", "SOG", "state"]
+READ_TOPICS = ["COG_out", "SOG_out", "lat", "lon", "state_out"]
+
+
+class Telemetry:
+    '''
+    Latest value received per telemetry topic. Written from zenoh threads, read by the script.
+    '''
+    def __init__(self, session, prefix):
+        self.values = {topic: "" for topic in READ_TOPICS}
+        self.subscribers = [
+            session.declare_subscriber(f"{prefix}/{topic}", self.listener(topic)) for topic in READ_TOPICS
+        ]
+
+    def listener(self, topic):
+        def listen(sample):
+            self.values[topic] = sample.payload.to_string()
+        return listen
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    def at(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+    return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": values[-1]}
+
+
+def flood(publisher, rate, duration, value):
+    '''
+    Publish value rate times per second for duration seconds, returning a report of the achieved
+    rate and the time each put() took (in microseconds). Raises ValueError for a rate that isn't
+    positive or a negative duration.
+    '''
+    if not rate > 0:
+        raise ValueError(f"flood rate must be positive, not {rate}")
+    if not duration >= 0:
+        raise ValueError(f"flood duration can't be negative, not {duration}")
+    payload = str(value)
+    interval = 1.0 / rate
+    latencies = []
+    start = time.perf_counter()
+    end = start + duration
+    next_send = start
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if next_send > now:
+            time.sleep(next_send - now)
+        before = time.perf_counter_ns()
+        publisher.put(payload)
+        latencies.append((time.perf_counter_ns() - before) / 1000)
+        # Fixed schedule, so a late send doesn't shift all the ones after it
+        next_send += interval
+    elapsed = time.perf_counter() - start
+
+    return {
+        "sent": len(latencies),
+        "target_rate": rate,
+        "achieved_rate": round(len(latencies) / elapsed, 1),
+        "send_latency_us": {name: round(value, 1) for name, value in percentiles(latencies).items()},
+    }
+
+
+class Script:
+    def __init__(self, session, prefix):
+        self.publishers = {topic: session.declare_publisher(f"{prefix}/{topic}") for topic in WRITE_TOPICS}
+        self.telemetry = Telemetry(session, prefix)
+        self.start = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def run(self, lines, interactive=False):
+        for number, line in enumerate(lines, start=1):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                try:
+                    self.execute(line)
+                except (ValueError, KeyError) as e:
+                    print(f"line {number}: {e}", file=sys.stderr)
+            if interactive:
+                print("> ", end="", flush=True)
+
+    def execute(self, line):
+        words = line.split()
+        if words[0].startswith("@"):
+            delay = self.start + float(words[0][1:]) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            words = words[1:]
+        if not words:
+            raise ValueError("missing command")
+
+        command, args = words[0], words[1:]
+        if command == "write" and len(args) >= 2:
+            self.topic(args[0], WRITE_TOPICS)
+            self.publishers[args[0]].put(" ".join(args[1:]))
+            print(f"[{self.elapsed():8.3f}] {args[0]} <- {' '.join(args[1:])}")
+        elif command == "read" and len(args) == 1:
+            topics = READ_TOPICS if args[0] == "all" else [self.topic(args[0], READ_TOPICS)]
+            for topic in topics:
+                print(f"[{self.elapsed():8.3f}] {topic}: {self.telemetry.values[topic]}")
+        elif command == "wait" and len(args) == 1:
+            time.sleep(float(args[0]))
+        elif command == "flood" and len(args) in (3, 4):
+            self.topic(args[0], WRITE_TOPICS)
+            value = args[3] if len(args) == 4 else "0"
+            report = flood(self.publishers[args[0]], float(args[1]), float(args[2]), value)
+            print(json.dumps({"topic": args[0], **report}))
+        else:
+            raise ValueError(f"can't parse {line!r}")
+
+    @staticmethod
+    def topic(name, topics):
+        if name not in topics:
+            raise ValueError(f"unknown topic {name!r}, expected one of {'/'.join(topics)}")
+        return name
+
+
+def positive_float(text):
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f"must be positive, not {text}")
+    return value
+
+
+def non_negative_float(text):
+    value = float(text)
+    if not value >= 0:
+        raise argparse.ArgumentTypeError(f"can't be negative, not {text}")
+    return value
 
-def listen_cog_out(sample):
-    global cog_out
-    cog_out = sample.payload
 
-def listen_sog_out(sample):
-    global sog_out
-    sog_out = sample.payload
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("script",
+                        nargs="?",
+                        help="command file, - for stdin (default: interactive, or stdin if piped)")
+    parser.add_argument("--prefix",
+                        default="testship",
+                        help="key prefix of the ship's topics")
+    parser.add_argument("--connect",
+                        action="append",
+                        metavar="ENDPOINT",
+                        help="zenoh endpoint to connect to, e.g. tcp/127.0.0.1:7447 (repeatable)")
+    parser.add_argument("--flood",
+                        choices=WRITE_TOPICS,
+                        help="only flood this topic (see --rate, --duration and --value), then exit")
+    parser.add_argument("--rate", type=positive_float, default=100.0, help="flood rate (messages per second)")
+    parser.add_argument("--duration", type=non_negative_float, default=10.0, help="flood duration (seconds)")
+    parser.add_argument("--value", default="0", help="flood payload")
+    args = parser.parse_args()
 
-def listen_lat(sample):
-    global lat
-    lat = sample.payload
+    config = zenoh.Config()
+    if args.connect:
+        config.insert_json5("connect/endpoints", json.dumps(args.connect))
 
-def listen_lon(sample):
-    global lon
-    lon = sample.payload
+    with zenoh.open(config) as session:
+        script = Script(session, args.prefix)
 
-def listen_state_out(sample):
-    global state_out
-    state_out = sample.payload
+        if args.flood:
+            report = flood(script.publishers[args.flood], args.rate, args.duration, args.value)
+            print(json.dumps({"topic": args.flood, **report}))
+        elif args.script and args.script != "-":
+            with open(args.script) as script_file:
+                script.run(script_file)
+        elif sys.stdin.isatty():
+            print("Commands: write/read/wait/flood, see --help. Ctrl-D to quit.")
+            print("> ", end="", flush=True)
+            script.run(sys.stdin, interactive=True)
+        else:
+            script.run(sys.stdin)
 
 if __name__ == "__main__":
-    with zenoh.open(zenoh.Config()) as session:
-        session.declare_subscriber("testship/COG_out", listen_cog_out)
-        session.declare_subscriber("testship/SOG_out", listen_sog_out)
-        session.declare_subscriber("testship/lat", listen_lat)
-        session.declare_subscriber("testship/lon", listen_lon)
-        session.declare_subscriber("testship/state_out", listen_state_out)
-
-        cog = session.declare_publisher("testship/COG")
-        sog = session.declare_publisher("testship/SOG")
-        state = session.declare_publisher("testship/state")
-
-        while True:
-            print("read/write: ", end="")
-            match input():
-                case "read":
-                    print("COG_out/SOG_out/lat/lon/state_out: ", end="")
-                    match input():
-                        case "COG_out":
-                            print(f"COG_out: {cog_out}")
-                        case "SOG_out":
-                            print(f"SOG_out: {sog_out}")
-                        case "lat":
-                            print(f"lat: {lat}")
-                        case "lon":
-                            print(f"lon: {lon}")
-                        case "state_out":
-                            print(f"state_out: {state_out}")
-                case "write":
-                    print("COG/SOG/state: ", end="")
-                    match input():
-                        case "COG":
-                            print("COG: ", end="")
-                            cog.put(input())
-                        case "SOG":
-                            print("SOG: ", end="")
-                            sog.put(input())
-                        case "state":
-                            print("state: ", end="")
-                            state.put(input())
+    main()
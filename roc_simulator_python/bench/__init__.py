@@ -0,0 +1,12 @@
+'''
+Benchmarks for the ROC simulator's telemetry ingest and GUI update path.
+
+They run against synthetic keelson payloads, so no ship simulator or zenoh router is needed. Run
+from the roc_simulator_python directory, e.g. ```python3 -m bench.bench_ingest --help```.
+'''
+
+import os
+import sys
+
+# The ROC simulator modules live in ../src and import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,119 @@
+'''
+Benchmark of the collision screening: time per screening tick of a fleet with AIS-like background
+traffic (busy around ports, many vessels moored), and the number of pairs the grid leaves to
+screen compared to all pairs. With --verify, the alerts are checked against screening every pair.
+
+    python3 -m bench.bench_collision --vessels 5000 --output collision.json
+'''
+
+import argparse
+import contextlib
+import json
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+from bench.bench_ingest import git_commit, percentiles
+from bench.synthetic import fleet_positions
+from collision import DEFAULT_CPA_ALERT_NM, DEFAULT_TCPA_ALERT_S, CollisionScreening, cpa_tcpa
+
+# Share of the traffic that is moored or at anchor
+MOORED_SHARE = 0.3
+
+
+def load_fleet(screening, count, seed):
+    rng = random.Random(seed)
+    states = []
+    for vessel_id, (lat, lon) in fleet_positions(count, seed).items():
+        cog = rng.uniform(0, 360)
+        sog = 0.0 if rng.random() < MOORED_SHARE else rng.uniform(4, 22)
+        screening.observe_location(vessel_id, lat, lon)
+        screening.observe_cog(vessel_id, cog)
+        screening.observe_sog(vessel_id, sog)
+        states.append((vessel_id, lat, lon, cog, sog))
+    return states
+
+
+def all_pair_alerts(states, cpa_alert_nm, tcpa_alert_s, chunk=256):
+    '''
+    Alerts found screening every pair, in chunks of rows to bound memory.
+    '''
+    ids = [state[0] for state in states]
+    lat, lon, cog, sog = (np.array([state[k] for state in states]) for k in range(1, 5))
+    course = np.radians(cog)
+    velocity = (sog * np.sin(course), sog * np.cos(course))
+    alerts = set()
+    for first in range(0, len(ids), chunk):
+        i = np.repeat(np.arange(first, min(first + chunk, len(ids))), len(ids))
+        j = np.tile(np.arange(len(ids)), min(chunk, len(ids) - first))
+        keep = i < j
+        i, j = i[keep], j[keep]
+        cpa, tcpa, _ = cpa_tcpa(lat[i], lon[i], (velocity[0][i], velocity[1][i]),
+                                lat[j], lon[j], (velocity[0][j], velocity[1][j]))
+        for k in np.nonzero((cpa <= cpa_alert_nm) & (tcpa <= tcpa_alert_s))[0].tolist():
+            alerts.add(tuple(sorted((ids[i[k]], ids[j[k]]))))
+    return alerts
+
+
+def run(args):
+    screening = CollisionScreening(args.cpa, args.tcpa * 60.0)
+    states = load_fleet(screening, args.vessels, args.seed)
+
+    # Screen at the time of the fixes, so no dead reckoning moves them between ticks
+    now = time.monotonic()
+    durations = []
+    for _ in range(args.ticks):
+        start = time.perf_counter_ns()
+        alerts = screening.screen(now)
+        durations.append(time.perf_counter_ns() - start)
+
+    results = {
+        "vessels": screening.last_vessels,
+        "all_pairs": args.vessels * (args.vessels - 1) // 2,
+        "screened_pairs": screening.last_pairs,
+        "alerts": len(alerts),
+        "tick_ms": {key: round(value / 1e6, 2) for key, value in percentiles(durations).items()},
+    }
+    if args.verify:
+        expected = all_pair_alerts(states, args.cpa, args.tcpa * 60.0)
+        found = {(alert.vessel_a, alert.vessel_b) for alert in alerts}
+        results["verified"] = {"missed": len(expected - found), "extra": len(found - expected)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the collision screening")
+    parser.add_argument("--vessels", type=int, default=5000)
+    parser.add_argument("--ticks", type=int, default=20, help="screening ticks to time")
+    parser.add_argument("--cpa", type=float, default=DEFAULT_CPA_ALERT_NM, help="CPA alert distance (nm)")
+    parser.add_argument("--tcpa", type=float, default=DEFAULT_TCPA_ALERT_S / 60, help="TCPA alert time (minutes)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verify", action="store_true", help="check the alerts against screening every pair")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    # Keep stdout for the JSON, components print on construction
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args)
+
+    report = {
+        "benchmark": "collision",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
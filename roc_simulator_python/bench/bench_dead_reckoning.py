@@ -0,0 +1,128 @@
+'''
+Benchmark of dead reckoning: how far the shown position of a manoeuvring vessel is from its true
+position, at the GUI's display rate, when location fixes are downsampled to lower rates. Compared
+with showing the latest fix until the next one, as without dead reckoning.
+
+The vessel sails at varying speed with a new rate of turn every few minutes. Fixes, COG and SOG
+carry GNSS-like noise. COG and SOG arrive at their full rate, only location fixes are downsampled
+(as with --location-rate).
+
+    python3 -m bench.bench_dead_reckoning --output dead_reckoning.json
+'''
+
+import argparse
+import json
+import platform
+import random
+
+from bench.bench_ingest import git_commit, percentiles
+from dead_reckoning import DeadReckoning, distance_m, project
+
+# Rate of the vessel's COG/SOG telemetry, and of the GUI's frames (Hz)
+TELEMETRY_RATE = 1
+DISPLAY_RATE = 20
+
+# Standard deviations of the noise on fixes (metres), COG (degrees) and SOG (knots)
+POSITION_NOISE_M = 2.0
+COG_NOISE_DEG = 1.0
+SOG_NOISE_KN = 0.1
+
+VESSEL_ID = "MASS_0"
+
+
+def voyage(duration, seed):
+    '''
+    [(time, lat, lon, cog, sog)] of a vessel, one per display frame.
+    '''
+    rng = random.Random(seed)
+    lat, lon, cog, sog = 59.3, 18.5, 45.0, 12.0
+    turn_rate, acceleration = 0.0, 0.0
+    step = 1 / DISPLAY_RATE
+    states = []
+    for frame in range(int(duration * DISPLAY_RATE)):
+        t = frame * step
+        if frame % (180 * DISPLAY_RATE) == 0:
+            # A new manoeuvre every 3 minutes: straight, or turning at up to 1 degree per second
+            turn_rate = rng.choice([0.0, 0.0, rng.uniform(-1.0, 1.0)])
+            acceleration = rng.uniform(-0.02, 0.02) # knots per second
+        states.append((t, lat, lon, cog, sog))
+        lat, lon = project(lat, lon, cog, sog, step)
+        cog = (cog + turn_rate * step) % 360
+        sog = min(max(sog + acceleration * step, 2.0), 20.0)
+    return states
+
+
+def run_rate(states, fix_rate, dead_reckoning, seed):
+    rng = random.Random(seed)
+    estimator = DeadReckoning()
+    telemetry_every = DISPLAY_RATE // TELEMETRY_RATE
+    fix_interval = 1 / fix_rate
+    next_fix = 0.0
+    latest_fix = None
+    errors = []
+    steps = []
+    shown = None
+    for frame, (t, lat, lon, cog, sog) in enumerate(states):
+        now_ns = int(t * 1e9)
+        if frame % telemetry_every == 0:
+            estimator.record(VESSEL_ID, "cog", now_ns, (cog + rng.gauss(0, COG_NOISE_DEG)) % 360)
+            estimator.record(VESSEL_ID, "sog", now_ns, max(sog + rng.gauss(0, SOG_NOISE_KN), 0.0))
+        if t >= next_fix - 1e-9:
+            # Noise in a random direction
+            fix = project(lat, lon, rng.uniform(0, 360), abs(rng.gauss(0, POSITION_NOISE_M)) / 1852 * 3600, 1.0)
+            estimator.record(VESSEL_ID, "location", now_ns, fix)
+            latest_fix = fix
+            next_fix += fix_interval
+        position = estimator.position(VESSEL_ID, now_ns) if dead_reckoning else latest_fix
+        errors.append(distance_m(*position, lat, lon))
+        if shown is not None:
+            steps.append(distance_m(*shown, *position))
+        shown = position
+
+    return {
+        "display_error_m": {key: round(value, 2) for key, value in percentiles(errors).items()},
+        # How far the marker moves from frame to frame, jumps show as a high max
+        "frame_step_m": {key: round(value, 2) for key, value in percentiles(steps).items()},
+        "prediction_error_m": {
+            "p50": round(estimator.error_percentile(0.5), 2),
+            "p99": round(estimator.error_percentile(0.99), 2),
+            "max": round(estimator.error_percentile(1.0), 2),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dead reckoning between downsampled location fixes")
+    parser.add_argument("--duration", type=float, default=3600.0, help="seconds of voyage to simulate")
+    parser.add_argument("--rates", type=float, nargs="+", default=[10, 2, 1, 0.5, 0.2, 0.1],
+                        help="location fix rates to compare (Hz)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    states = voyage(args.duration, args.seed)
+    results = {}
+    for rate in args.rates:
+        results[f"{rate:g}_hz"] = {
+            "latest_fix": run_rate(states, rate, False, args.seed),
+            "dead_reckoning": run_rate(states, rate, True, args.seed),
+        }
+
+    report = {
+        "benchmark": "dead_reckoning",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
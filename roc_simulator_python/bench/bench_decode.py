@@ -0,0 +1,207 @@
+'''
+Benchmark of the payload decode path alone, per kind of topic, for the monitor's decoders and for
+the copying path they replaced (payload to bytes, parse the whole Envelope, copy its payload out,
+parse that; to_string() for raw topics): time taken and bytes allocated per sample. Allocations
+are measured on the Python heap with tracemalloc (peak per sample) and, with glibc, on the C heap
+protobuf parses into (bytes still in use per sample after a run, as reused messages keep them).
+
+The samples are the same synthetic ones on every run, so allocations per sample are comparable
+between commits. The run fails (exit status 1) if the monitor's path doesn't allocate less than
+the copying one, as median Python peak plus C heap kept, for every kind of protobuf topic (or
+more, for raw topics):
+
+    python3 -m bench.bench_decode --samples 20000 --output decode.json
+'''
+
+import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import json
+import platform
+import sys
+import threading
+
+from keelson import enclose
+from keelson.Envelope_pb2 import Envelope
+from keelson.payloads.ROCStatus_pb2 import ROCStatus
+
+from bench.bench_ingest import git_commit, make_monitor, measure
+from bench.synthetic import telemetry_samples, vessel_key
+from flight_recorder import RecordedSample
+
+# Topic kinds measured separately, by the field their samples decode to
+KINDS = {
+    "pubsub/location_fix/gnss/0": "location",
+    "pubsub/course_over_ground_deg/gnss/0": "cog",
+    "pubsub/remote_time/bridge/1": "remote_time",
+}
+
+# Entities in the large ROC status payload (783 bytes)
+LARGE_STATUS_ENTITIES = 64
+
+
+def large_roc_status_sample():
+    msg = ROCStatus()
+    msg.timestamp.FromNanoseconds(1_700_000_000_000_000_000)
+    for i in range(LARGE_STATUS_ENTITIES):
+        entity = msg.entities.add()
+        entity.entity_id = f"ROC_{i}"
+        entity.state = ROCStatus.ROCEntity.MONITORING
+    return RecordedSample(vessel_key("MASS_0", "pubsub/roc_status/bridge/0"), enclose(msg.SerializeToString())), ROCStatus
+
+
+class _MallInfo2(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_size_t) for name in (
+        "arena", "ordblks", "smblks", "hblks", "hblkhd", "usmblks", "fsmblks", "uordblks", "fordblks", "keepcost")]
+
+
+def _mallinfo2():
+    try:
+        mallinfo2 = ctypes.CDLL(ctypes.util.find_library("c")).mallinfo2
+    except (OSError, AttributeError, TypeError): # Not glibc, or older than 2.33
+        return None
+    mallinfo2.restype = _MallInfo2
+    return mallinfo2
+
+
+MALLINFO2 = _mallinfo2()
+
+
+def native_heap_used():
+    '''
+    Bytes in use on the C heap, or None without glibc.
+    '''
+    if MALLINFO2 is None:
+        return None
+    info = MALLINFO2()
+    return info.uordblks + info.hblkhd
+
+
+def native_retained(stage, samples):
+    '''
+    C heap bytes still in use per sample after running stage(sample, cls) over all samples, or None.
+    '''
+    for sample, cls in samples[:1]:
+        stage(sample, cls)
+    before = native_heap_used()
+    if before is None:
+        return None
+    for sample, cls in samples:
+        stage(sample, cls)
+    return round((native_heap_used() - before) / len(samples), 2)
+
+
+class _CopyingBuffers(threading.local):
+    def __init__(self):
+        self.envelope = Envelope()
+        self.messages = {}
+
+
+def copying_decoder():
+    '''
+    The decode path before payloads were parsed in place, with the same per thread message reuse.
+    '''
+    buffers = _CopyingBuffers()
+
+    def decode(sample, cls):
+        if cls is None:
+            return float(sample.payload.to_string())
+        msg = buffers.messages.get(cls)
+        if msg is None:
+            msg = buffers.messages[cls] = cls()
+        envelope = buffers.envelope
+        envelope.ParseFromString(sample.payload.to_bytes())
+        msg.ParseFromString(envelope.payload)
+        return msg
+    return decode
+
+
+def monitor_decoder():
+    '''
+    The monitor's decode path, as called from on_sample.
+    '''
+    monitor = make_monitor({}, fleet=False)
+
+    def decode(sample, cls):
+        payload = sample.payload.to_bytes()
+        if cls is None:
+            return float(payload)
+        return monitor._decode(payload, cls)
+    return decode
+
+
+def run(args):
+    samples = telemetry_samples(args.samples * 2) # Every other topic isn't measured
+    by_kind = {kind: [] for kind in KINDS.values()}
+    for sample, cls in samples:
+        kind = KINDS.get(str(sample.key_expr).split("/", 3)[3])
+        if kind and len(by_kind[kind]) < args.samples:
+            by_kind[kind].append((sample, cls))
+    by_kind["roc_status_large"] = [large_roc_status_sample()] * args.samples
+
+    results = {}
+    for kind, kind_samples in by_kind.items():
+        sample, cls = kind_samples[0]
+        results[kind] = {
+            "payload_bytes": len(sample.payload.to_bytes()),
+            "raw": cls is None,
+            "copying": {**measure(copying_decoder(), kind_samples),
+                        "native_retained_bytes_per_sample": native_retained(copying_decoder(), kind_samples)},
+            "monitor": {**measure(monitor_decoder(), kind_samples),
+                        "native_retained_bytes_per_sample": native_retained(monitor_decoder(), kind_samples)},
+        }
+    return results
+
+
+def allocated(result):
+    return result["alloc_peak_bytes_per_sample"]["p50"] + (result["native_retained_bytes_per_sample"] or 0)
+
+
+def regressions(kinds):
+    '''
+    Kinds for which the monitor's path doesn't allocate less than the copying one. For raw topics
+    both only copy the payload out of zenoh, so there it only mustn't allocate more.
+    '''
+    failed = []
+    for kind, result in kinds.items():
+        monitor, copying = allocated(result["monitor"]), allocated(result["copying"])
+        if monitor > copying or (monitor == copying and not result["raw"]):
+            failed.append(kind)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark telemetry payload decoding")
+    parser.add_argument("--samples", type=int, default=20000, help="samples per topic kind")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    # Keep stdout for the JSON, components print on construction
+    with contextlib.redirect_stdout(sys.stderr):
+        kinds = run(args)
+
+    report = {
+        "benchmark": "decode",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "kinds": kinds,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+    failed = regressions(kinds)
+    if failed:
+        print(f"Monitor decode path doesn't allocate less than the copying one for: {', '.join(failed)}",
+              file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
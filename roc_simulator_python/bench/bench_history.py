@@ -0,0 +1,107 @@
+'''
+Benchmark of the telemetry history store: filling it with hours of 10 Hz telemetry for a fleet,
+and querying the last 30 minutes of a signal downsampled to a plot's worth of points.
+
+    python3 -m bench.bench_history --vessels 24 --hours 2 --output history.json
+'''
+
+import argparse
+import contextlib
+import json
+import math
+import platform
+import sys
+import time
+
+from bench.bench_ingest import git_commit, percentiles
+from history import HistoryStore
+
+# Signals recorded per vessel, as the monitor records them
+SIGNALS = ("location", "cog", "sog")
+
+
+def fill(store, vessels, hours, rate_hz):
+    '''
+    Record hours of telemetry at rate_hz for every vessel, returning the number of samples written.
+    '''
+    step_ns = int(1e9 / rate_hz)
+    count = int(hours * 3600 * rate_hz)
+    start_ns = time.time_ns() - count * step_ns
+    for i in range(count):
+        time_ns = start_ns + i * step_ns
+        phase = i / rate_hz / 600.0
+        for vessel_id in vessels:
+            store.record(vessel_id, "location", time_ns, (63.0 + 0.1 * math.sin(phase), 21.0 + 0.1 * math.cos(phase)))
+            store.record(vessel_id, "cog", time_ns, (phase * 57.3) % 360.0)
+            store.record(vessel_id, "sog", time_ns, 10.0 + math.sin(phase * 7.0))
+    return count * len(vessels) * len(SIGNALS), start_ns + count * step_ns
+
+
+def run(args):
+    vessels = [f"MASS_{i}" for i in range(args.vessels)]
+    store = HistoryStore(int(args.budget * 2**20), reserved_vessels=vessels[:1])
+
+    start = time.perf_counter()
+    samples, end_ns = fill(store, vessels, args.hours, args.rate)
+    fill_s = time.perf_counter() - start
+
+    window_ns = int(args.window * 60 * 1e9)
+    latencies = []
+    for i in range(args.queries):
+        vessel_id = vessels[i % len(vessels)]
+        signal = SIGNALS[i % len(SIGNALS)]
+        before = time.perf_counter_ns()
+        store.query(vessel_id, signal, end_ns - window_ns, end_ns, points=args.points)
+        latencies.append(time.perf_counter_ns() - before)
+
+    oldest = min(store.query(vessel_id, signal).times[0] for vessel_id, signal in store.series())
+    return {
+        "fill": {
+            "samples": samples,
+            "samples_per_s": round(samples / fill_s),
+            "memory_bytes": store.memory_used(),
+            "retained_hours": round((end_ns - oldest) / 3.6e12, 2),
+            "series": len(store.series()),
+            "series_evicted": store.evicted,
+        },
+        "query": {
+            "window_minutes": args.window,
+            "points": args.points,
+            "latency_ns": percentiles(latencies),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the telemetry history store")
+    parser.add_argument("--vessels", type=int, default=24)
+    parser.add_argument("--hours", type=float, default=2.0, help="hours of telemetry to record")
+    parser.add_argument("--rate", type=float, default=10.0, help="telemetry rate per signal (Hz)")
+    parser.add_argument("--budget", type=float, default=64, help="history memory budget (MiB)")
+    parser.add_argument("--window", type=float, default=30, help="minutes of history per query")
+    parser.add_argument("--points", type=int, default=600, help="points to downsample each query to")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args)
+
+    report = {
+        "benchmark": "history",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
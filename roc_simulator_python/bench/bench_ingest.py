@@ -0,0 +1,209 @@
+'''
+Benchmark of the telemetry ingest path: decoding, monitor dispatch, GUI slot updates and (with a
+display) rendering into the RocGui labels.
+
+Each stage is run over the same synthetic samples, once timing every sample and once under
+tracemalloc to measure memory allocated per sample. Results are printed (or written) as JSON so
+runs on different commits can be compared:
+
+    python3 -m bench.bench_ingest --samples 50000 --output before.json
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench.synthetic import telemetry_samples
+from gui_pump import LatestValueSlots
+from ship_monitor import ShipTelemetryMonitor
+
+
+CALLBACK_NAMES = [
+    'handle_location', 'handle_cog', 'handle_sog', 'handle_name', 'handle_mmsi', 'handle_imo',
+    'handle_nav_status', 'handle_roc_status', 'handle_remote_status', 'handle_remote_time',
+    'handle_handover_request', 'handle_handover_state',
+]
+
+# Callback name -> GUI slot, mirroring the callbacks roc_main.py hands the monitor (the remote
+# time and handover topics go to the handover engine instead)
+GUI_FIELDS = {
+    'handle_location': "location",
+    'handle_cog': "cog",
+    'handle_sog': "sog",
+    'handle_name': "name",
+    'handle_mmsi': "mmsi",
+    'handle_imo': "imo",
+    'handle_remote_status': "remote_status",
+    'handle_roc_status': "roc_status",
+}
+
+
+class NullController:
+    '''
+    Stands in for ROCController, so a RocGui can be built without a zenoh session.
+    '''
+    roc_id = "ROC_1"
+    ship_id = "MASS_0"
+    setpoints = {}
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    def at(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+    return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": values[-1]}
+
+
+def measure(stage, samples):
+    '''
+    Run stage(sample, cls) over all samples, returning throughput, latency and allocation stats.
+    '''
+    latencies = []
+    start = time.perf_counter_ns()
+    for sample, cls in samples:
+        before = time.perf_counter_ns()
+        stage(sample, cls)
+        latencies.append(time.perf_counter_ns() - before)
+    elapsed = time.perf_counter_ns() - start
+
+    # Separate pass for allocations, tracemalloc slows everything down
+    peaks = []
+    tracemalloc.start()
+    retained_start = tracemalloc.get_traced_memory()[0]
+    for sample, cls in samples:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        stage(sample, cls)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    retained = tracemalloc.get_traced_memory()[0] - retained_start
+    tracemalloc.stop()
+
+    return {
+        "samples": len(samples),
+        "samples_per_s": round(len(samples) / (elapsed / 1e9)),
+        "latency_ns": percentiles(latencies),
+        "alloc_peak_bytes_per_sample": percentiles(peaks),
+        "retained_bytes_per_sample": round(retained / len(samples), 2),
+    }
+
+
+def make_monitor(callbacks, fleet):
+    return ShipTelemetryMonitor("MASS_0", callbacks, fleet=fleet, live=False)
+
+
+def make_gui():
+    '''
+    Build a real RocGui, reading map tiles only from an empty tile file so no network is used.
+    Returns None if there is no display to open a Tk root on.
+    '''
+    import tkinter as tk
+    try:
+        from roc_gui import RocGui
+        tile_db = os.path.join(tempfile.mkdtemp(), "tiles.db")
+        gui = RocGui(NullController(), tile_db=tile_db, offline=True)
+        gui.build_all_panels()
+        return gui
+    except tk.TclError as e:
+        print(f"Skipping Tk stages: {e}", file=sys.stderr)
+        return None
+
+
+def run(args):
+    vessels = [f"MASS_{i}" for i in range(args.vessels)]
+    fleet = args.vessels > 1
+    samples = telemetry_samples(args.samples, vessels)
+    results = {}
+
+    monitor = make_monitor({}, fleet)
+    results["decode"] = measure(
+        lambda sample, cls: monitor._decode(sample.payload.to_bytes(), cls) if cls else float(sample.payload.to_bytes()),
+        samples)
+
+    monitor = make_monitor({name: (lambda *values: None) for name in CALLBACK_NAMES}, fleet)
+    results["ingest"] = measure(lambda sample, cls: monitor.on_sample(sample), samples)
+
+    slots = LatestValueSlots()
+    def slot_writer(field):
+        if fleet:
+            return lambda vessel_id, *values: slots.put(field, *values)
+        return lambda *values: slots.put(field, *values)
+    monitor = make_monitor({name: slot_writer(field) for name, field in GUI_FIELDS.items()}, fleet)
+    results["ingest_to_gui_slots"] = measure(lambda sample, cls: monitor.on_sample(sample), samples)
+
+    if args.tk:
+        gui = make_gui()
+        if gui:
+            gui.root.update()
+            callbacks = {
+                name: getattr(gui, method) for name, method in (
+                    ('handle_location', "update_map_position"), ('handle_cog', "update_cog_out"),
+                    ('handle_sog', "update_sog_out"), ('handle_roc_status', "update_roc_status"),
+                )
+            }
+            if fleet:
+                callbacks = {name: (lambda callback: lambda vessel_id, *values: callback(*values))(callback)
+                             for name, callback in callbacks.items()}
+            monitor = make_monitor(callbacks, fleet)
+
+            def ingest_and_render(sample, cls):
+                # One frame per sample is the worst case for the pump, nothing gets coalesced
+                monitor.on_sample(sample)
+                for field, (_, values) in gui.slots.drain().items():
+                    gui.renderers[field](*values)
+
+            results["ingest_and_render_tk"] = measure(ingest_and_render, samples)
+            gui.root.destroy()
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the telemetry ingest and GUI update path")
+    parser.add_argument("--samples", type=int, default=20000, help="samples per stage")
+    parser.add_argument("--vessels", type=int, default=1, help="vessels to spread the samples over")
+    parser.add_argument("--tk", action="store_true", help="also render into a real RocGui (needs a display)")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    # Keep stdout for the JSON, components print on construction
+    with contextlib.redirect_stdout(sys.stderr):
+        stages = run(args)
+
+    report = {
+        "benchmark": "ingest",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "stages": stages,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+'''
+Benchmark of drawing a fleet on the map: time and canvas calls per redraw while panning and
+zooming, for the fleet layer (spatial index, viewport culling, clustering) and for one marker per
+vessel redrawn on every event, as TkinterMapView does with its own markers.
+
+Without --tk the canvas is a stand-in that only counts calls, which measures the Python side and
+the number of Tk calls made. With --tk (needs a display) a real Tk canvas is drawn on.
+
+    python3 -m bench.bench_map --vessels 5000 --output map.json
+'''
+
+import argparse
+import contextlib
+import json
+import math
+import platform
+import sys
+import time
+
+from bench.bench_ingest import git_commit, percentiles
+from bench.synthetic import fleet_positions
+from fleet_map import FleetLayer, to_world
+from track import TILE_SIZE
+
+MAP_WIDTH = 600
+MAP_HEIGHT = 500
+
+
+class CountingCanvas:
+    '''
+    Stands in for a Tk canvas, counting the calls made to it.
+    '''
+    def __init__(self):
+        self.calls = 0
+        self.items = set()
+        self.next_item = 1
+
+    def _create(self, *args, **kwargs):
+        self.calls += 1
+        item = self.next_item
+        self.next_item += 1
+        self.items.add(item)
+        return item
+
+    create_oval = create_text = _create
+
+    def coords(self, *args):
+        self.calls += 1
+
+    def itemconfigure(self, *args, **kwargs):
+        self.calls += 1
+
+    def tag_raise(self, *args):
+        self.calls += 1
+
+    def delete(self, *items):
+        self.calls += 1
+        self.items.difference_update(items)
+
+
+class TkCanvas:
+    '''
+    A real Tk canvas, counting the calls made to it.
+    '''
+    def __init__(self):
+        import tkinter as tk
+        self.root = tk.Tk()
+        self.canvas = tk.Canvas(self.root, width=MAP_WIDTH, height=MAP_HEIGHT)
+        self.canvas.pack()
+        self.calls = 0
+
+    def __getattr__(self, name):
+        method = getattr(self.canvas, name)
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return method(*args, **kwargs)
+        return counted
+
+    @property
+    def items(self):
+        return self.canvas.find_all()
+
+
+class MapView:
+    '''
+    The attributes of a TkinterMapView the fleet layer reads.
+    '''
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.width = MAP_WIDTH
+        self.height = MAP_HEIGHT
+        self.zoom = 6
+        self.upper_left_tile_pos = (0, 0)
+        self.lower_right_tile_pos = (0, 0)
+
+    def center_on(self, lat, lon, zoom):
+        self.zoom = zoom
+        x, y = to_world(lat, lon)
+        tiles = 2 ** zoom
+        half_width = MAP_WIDTH / TILE_SIZE / 2
+        half_height = MAP_HEIGHT / TILE_SIZE / 2
+        self.upper_left_tile_pos = (x * tiles - half_width, y * tiles - half_height)
+        self.lower_right_tile_pos = (x * tiles + half_width, y * tiles + half_height)
+
+    def manage_z_order(self):
+        self.canvas.tag_raise("marker")
+
+
+class MarkerPerVessel:
+    '''
+    Every vessel a canvas item, all moved on every redraw.
+    '''
+    def __init__(self, map_widget):
+        self.map_widget = map_widget
+        self.positions = {}
+        self.items = {}
+
+    def update(self, vessel_id, lat, lon):
+        self.positions[vessel_id] = to_world(lat, lon)
+
+    def draw(self):
+        widget = self.map_widget
+        canvas = widget.canvas
+        tiles = 2 ** round(widget.zoom)
+        (left, top), (right, bottom) = widget.upper_left_tile_pos, widget.lower_right_tile_pos
+        scale_x = widget.width / (right - left)
+        scale_y = widget.height / (bottom - top)
+        for vessel_id, (x, y) in self.positions.items():
+            cx = (x * tiles - left) * scale_x
+            cy = (y * tiles - top) * scale_y
+            item = self.items.get(vessel_id)
+            if item is None:
+                self.items[vessel_id] = canvas.create_oval(cx - 4, cy - 4, cx + 4, cy + 4)
+            else:
+                canvas.coords(item, cx - 4, cy - 4, cx + 4, cy + 4)
+        widget.manage_z_order()
+
+
+def views():
+    '''
+    (scenario, [(lat, lon, zoom)]) of the map views redrawn in turn.
+    '''
+    def pan(lat, lon, zoom, steps=200):
+        # A circle of a few screen widths, in small steps like mouse drags
+        radius = 3 * MAP_WIDTH / (TILE_SIZE * 2 ** zoom) * 360 / (2 * math.pi)
+        return [(lat + radius * 0.5 * math.sin(2 * math.pi * i / steps),
+                 lon + radius * math.cos(2 * math.pi * i / steps), zoom) for i in range(steps)]
+
+    return [
+        ("pan_zoom_5", pan(60.0, 20.0, 5)),
+        ("pan_zoom_8", pan(59.5, 19.0, 8)),
+        ("pan_zoom_12", pan(59.33, 18.07, 12)),
+        ("zoom_3_to_14", [(59.33, 18.07, zoom) for _ in range(10) for zoom in range(3, 15)]),
+    ]
+
+
+def run_layer(make_canvas, layer_class, positions):
+    canvas = make_canvas()
+    widget = MapView(canvas)
+    layer = layer_class(widget)
+    for vessel_id, (lat, lon) in positions.items():
+        layer.update(vessel_id, lat, lon)
+
+    results = {}
+    for scenario, scenario_views in views():
+        times = []
+        calls = []
+        items = []
+        for lat, lon, zoom in scenario_views:
+            widget.center_on(lat, lon, zoom)
+            calls_before = canvas.calls
+            start = time.perf_counter_ns()
+            layer.draw()
+            if hasattr(canvas, "root"):
+                canvas.root.update_idletasks()
+            times.append(time.perf_counter_ns() - start)
+            calls.append(canvas.calls - calls_before)
+            items.append(len(canvas.items))
+        results[scenario] = {
+            "draws": len(times),
+            "draw_ms": {key: round(value / 1e6, 3) for key, value in percentiles(times).items()},
+            "canvas_calls_per_draw": percentiles(calls),
+            "canvas_items": percentiles(items),
+        }
+    if hasattr(canvas, "root"):
+        canvas.root.destroy()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark drawing a fleet on the map")
+    parser.add_argument("--vessels", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tk", action="store_true", help="draw on a real Tk canvas (needs a display)")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    positions = fleet_positions(args.vessels, args.seed)
+    make_canvas = TkCanvas if args.tk else CountingCanvas
+    # Keep stdout for the JSON, components print on construction
+    with contextlib.redirect_stdout(sys.stderr):
+        layers = {
+            "marker_per_vessel": run_layer(make_canvas, MarkerPerVessel, positions),
+            "fleet_layer": run_layer(make_canvas, FleetLayer, positions),
+        }
+
+    report = {
+        "benchmark": "map",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "layers": layers,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
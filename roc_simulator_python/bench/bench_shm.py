@@ -0,0 +1,173 @@
+'''
+Benchmark of the zenoh transport with and without shared memory, for the payload sizes the
+monitor receives (a COG/SOG sample, a location fix, a large ROC status) and one large payload.
+
+A publishing and a subscribing session are opened in this process, as peers connected over TCP on
+localhost, first without and then with --shm. With --shm every payload is published through shared
+memory here, however small (see SHM_MIN_PAYLOAD_SIZE). For every payload size it measures:
+
+- latency: one-way send to receive time, publishing at a steady --rate,
+- throughput: samples received per second when publishing as fast as possible.
+
+    python3 -m bench.bench_shm --messages 5000 --output shm.json
+'''
+
+import argparse
+import contextlib
+import json
+import platform
+import struct
+import sys
+import threading
+import time
+
+import zenoh
+
+from bench.bench_decode import large_roc_status_sample
+from bench.bench_ingest import git_commit, percentiles
+from bench.synthetic import location_fix, timestamped_float
+from zenoh_session import DEFAULT_SHM_POOL_SIZE, SessionConfig, ShmPayloads
+
+KEY = "bench/shm"
+
+# Send time stamped at the start of every payload
+SEND_TIME = struct.Struct("<q")
+
+# Time allowed for the subscription to reach the publisher, and for stragglers to arrive (seconds)
+SETTLE_TIME = 1.0
+
+
+def payload_sizes():
+    return {
+        "cog": len(timestamped_float(0.0)),
+        "location": len(location_fix(63.0, 21.0)),
+        "roc_status_large": len(large_roc_status_sample()[0].payload.to_bytes()),
+        "64k": 64 * 1024,
+    }
+
+
+class Receiver:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(0)
+
+    def reset(self, expected):
+        with self.lock:
+            self.expected = expected
+            self.latencies = []
+            self.via_shm = 0
+            self.last_ns = None
+            self.done = threading.Event()
+
+    def __call__(self, sample):
+        now = time.perf_counter_ns()
+        payload = sample.payload
+        sent_ns, = SEND_TIME.unpack_from(payload.to_bytes())
+        with self.lock:
+            self.latencies.append(now - sent_ns)
+            if payload.as_shm() is not None:
+                self.via_shm += 1
+            self.last_ns = now
+            if len(self.latencies) >= self.expected:
+                self.done.set()
+
+
+def publish(publisher, shm, size, count, rate=None):
+    '''
+    Publish count payloads of size bytes, rate per second or as fast as possible. Returns the
+    time of the first send.
+    '''
+    padding = bytes(size - SEND_TIME.size)
+    interval = 1e9 / rate if rate else 0
+    start = time.perf_counter_ns()
+    for i in range(count):
+        if interval:
+            delay = start + i * interval - time.perf_counter_ns()
+            if delay > 0:
+                time.sleep(delay / 1e9)
+        data = SEND_TIME.pack(time.perf_counter_ns()) + padding
+        publisher.put(shm.payload(data) if shm else data)
+    return start
+
+
+def run_mode(args, use_shm, sizes):
+    def config(**endpoints):
+        return SessionConfig(mode="peer", shm=use_shm, multicast_scouting=False, **endpoints).to_zenoh_config()
+
+    endpoint = f"tcp/127.0.0.1:{args.port}"
+    subscriber_session = zenoh.open(config(listen=[endpoint]))
+    publisher_session = zenoh.open(config(connect=[endpoint]))
+    receiver = Receiver()
+    results = {}
+    try:
+        subscriber_session.declare_subscriber(KEY, receiver)
+        publisher = publisher_session.declare_publisher(KEY)
+        shm = ShmPayloads(args.shm_pool_size, min_size=0) if use_shm else None
+        time.sleep(SETTLE_TIME)
+
+        for name, size in sizes.items():
+            receiver.reset(args.messages)
+            publish(publisher, shm, size, args.messages, args.rate)
+            receiver.done.wait(SETTLE_TIME + args.messages / args.rate)
+            latency = {key: round(value / 1000, 1) for key, value in percentiles(receiver.latencies).items()}
+            via_shm = receiver.via_shm
+
+            receiver.reset(args.messages)
+            start_ns = publish(publisher, shm, size, args.messages)
+            receiver.done.wait(SETTLE_TIME + args.messages / 1000)
+            received = len(receiver.latencies)
+            elapsed_ns = (receiver.last_ns or start_ns) - start_ns
+
+            results[name] = {
+                "payload_bytes": size,
+                "latency_us": latency,
+                "received_via_shm": via_shm + receiver.via_shm,
+                "throughput": {
+                    "sent": args.messages,
+                    "received": received,
+                    "samples_per_s": round(received / (elapsed_ns / 1e9)) if elapsed_ns else None,
+                    "mb_per_s": round(received * size / (elapsed_ns / 1e3), 1) if elapsed_ns else None,
+                },
+            }
+        if shm:
+            results["shm_fallbacks"] = shm.fallbacks
+    finally:
+        publisher_session.close()
+        subscriber_session.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the zenoh transport with and without shared memory")
+    parser.add_argument("--messages", type=int, default=5000, help="samples per payload size and measurement")
+    parser.add_argument("--rate", type=float, default=2000.0, help="publish rate of the latency measurement")
+    parser.add_argument("--port", type=int, default=7461, help="localhost TCP port the sessions connect on")
+    parser.add_argument("--shm-pool-size", type=float, default=DEFAULT_SHM_POOL_SIZE / 2**20, metavar="MIB",
+                        help="shared memory pool size (in MiB)")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+    args.shm_pool_size = int(args.shm_pool_size * 2**20)
+
+    sizes = payload_sizes()
+    # Keep stdout for the JSON, components print on construction
+    with contextlib.redirect_stdout(sys.stderr):
+        modes = {"network": run_mode(args, False, sizes), "shm": run_mode(args, True, sizes)}
+
+    report = {
+        "benchmark": "shm",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "modes": modes,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
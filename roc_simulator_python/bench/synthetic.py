@@ -0,0 +1,117 @@
+'''
+Generators for synthetic telemetry, shaped like what the ship simulator publishes.
+'''
+
+import math
+import random
+import time
+
+from keelson import enclose
+from keelson.payloads.foxglove.LocationFix_pb2 import LocationFix
+from keelson.payloads.Primitives_pb2 import TimestampedFloat
+from keelson.payloads.VesselNavStatus_pb2 import VesselNavStatus
+from keelson.payloads.ROCStatus_pb2 import ROCStatus
+
+from flight_recorder import RecordedSample
+from ship_monitor import BASE_PATH
+
+# Where the synthetic fleet sails: the Baltic, busier around a few ports
+FLEET_AREA = ((54.0, 10.0), (66.0, 30.0))
+PORTS = [(59.33, 18.07), (60.17, 24.94), (63.09, 21.56), (54.35, 18.65), (57.71, 11.97)]
+
+
+def location_fix(lat, lon, timestamp_ns=None):
+    msg = LocationFix()
+    msg.timestamp.FromNanoseconds(timestamp_ns or time.time_ns())
+    msg.frame_id = "gnss/0"
+    msg.latitude = lat
+    msg.longitude = lon
+    return enclose(msg.SerializeToString())
+
+
+def timestamped_float(value, timestamp_ns=None):
+    msg = TimestampedFloat()
+    msg.timestamp.FromNanoseconds(timestamp_ns or time.time_ns())
+    msg.value = value
+    return enclose(msg.SerializeToString())
+
+
+def nav_status(status=VesselNavStatus.NavigationStatus.UNDER_WAY, timestamp_ns=None):
+    msg = VesselNavStatus()
+    msg.timestamp.FromNanoseconds(timestamp_ns or time.time_ns())
+    msg.navigation_status = status
+    return enclose(msg.SerializeToString())
+
+
+def roc_status(controlling_roc="ROC_1", monitoring_roc="ROC_2", timestamp_ns=None):
+    msg = ROCStatus()
+    msg.timestamp.FromNanoseconds(timestamp_ns or time.time_ns())
+    for roc_id, state in ((controlling_roc, ROCStatus.ROCEntity.CONTROLLING),
+                          (monitoring_roc, ROCStatus.ROCEntity.MONITORING)):
+        entity = msg.entities.add()
+        entity.entity_id = roc_id
+        entity.state = state
+    return enclose(msg.SerializeToString())
+
+
+def vessel_key(vessel_id, topic):
+    return f"{BASE_PATH}/{vessel_id}/{topic}"
+
+
+def telemetry_samples(count, vessels=("MASS_0",)):
+    '''
+    Build count samples, cycling through the telemetry topics of the given vessels. Each vessel
+    steams in a slow circle so consecutive positions and courses differ.
+
+    Returns a list of (sample, message class or None for raw string topics).
+    '''
+    topics = [
+        ("pubsub/location_fix/gnss/0", LocationFix),
+        ("pubsub/course_over_ground_deg/gnss/0", TimestampedFloat),
+        ("pubsub/speed_over_ground_knots/gnss/0", TimestampedFloat),
+        ("pubsub/nav_status/bridge/0", VesselNavStatus),
+        ("pubsub/roc_status/bridge/0", ROCStatus),
+        ("pubsub/remote_time/bridge/1", None),
+    ]
+
+    samples = []
+    for i in range(count):
+        vessel_id = vessels[i % len(vessels)]
+        step = i // len(vessels)
+        topic, cls = topics[step % len(topics)]
+        angle = step / 1000.0
+
+        if cls is LocationFix:
+            payload = location_fix(63.0 + 0.1 * math.sin(angle), 21.0 + 0.2 * math.cos(angle))
+        elif topic.startswith("pubsub/course"):
+            payload = timestamped_float(math.degrees(angle) % 360.0)
+        elif topic.startswith("pubsub/speed"):
+            payload = timestamped_float(10.0 + math.sin(angle))
+        elif cls is VesselNavStatus:
+            payload = nav_status()
+        elif cls is ROCStatus:
+            payload = roc_status()
+        else:
+            payload = str(600.0 - step % 600).encode()
+
+        samples.append((RecordedSample(vessel_key(vessel_id, topic), payload), cls))
+    return samples
+
+
+def fleet_positions(count, seed):
+    '''
+    {vessel id: (lat, lon)} of count vessels, half of them spread over FLEET_AREA and half
+    gathered around PORTS.
+    '''
+    rng = random.Random(seed)
+    (south, west), (north, east) = FLEET_AREA
+    positions = {}
+    for i in range(count):
+        if rng.random() < 0.5:
+            lat, lon = rng.choice(PORTS)
+            lat += rng.gauss(0, 0.3)
+            lon += rng.gauss(0, 0.6)
+        else:
+            lat, lon = rng.uniform(south, north), rng.uniform(west, east)
+        positions[f"MASS_{i}"] = (lat, lon)
+    return positions
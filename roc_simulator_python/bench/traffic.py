@@ -0,0 +1,233 @@
+'''
+Synthetic multi-vessel traffic generator, for load testing a ROC process.
+
+Simulates a fleet of vessels steaming on plausible tracks (slowly wandering course and speed,
+turning back at the edges of the area) and publishes their keelson enclosed telemetry on exactly
+the key expressions ShipTelemetryMonitor subscribes to. The vessels are spread over worker
+processes, each with its own zenoh session.
+
+By default the workers are zenoh peers connecting to tcp/127.0.0.1:7447 with multicast scouting
+off, so no router or network is needed. Start the ROC listening there, e.g.:
+
+    python3 src/roc_main.py -r ROC_1 --fleet --headless --zenoh-mode peer \\
+        --listen tcp/127.0.0.1:7447 --no-multicast-scouting
+    python3 -m bench.traffic --vessels 200 --workers 4 --rate 10 --duration 60
+
+With --shm (on both sides), the telemetry is published through shared memory instead.
+'''
+
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import sys
+import time
+
+from bench.synthetic import location_fix, nav_status, roc_status, timestamped_float, vessel_key
+from ship_monitor import TOPICS
+from zenoh_session import DEFAULT_SHM_POOL_SIZE, SessionConfig, ShmPayloads
+
+# Area the vessels are kept in: (south, west), (north, east) (roughly the Gulf of Bothnia)
+AREA = ((60.5, 17.5), (65.5, 25.0))
+
+NAUTICAL_MILE_DEG = 1.0 / 60.0
+
+# Topic of every VesselState field, so the keys always match what the monitor subscribes to
+FIELD_TOPICS = {field: topic for topic, _, _, field, _ in TOPICS}
+
+
+class Vessel:
+    '''
+    A vessel on a random but smooth track.
+    '''
+    def __init__(self, vessel_id, rng):
+        self.vessel_id = vessel_id
+        self.rng = rng
+        (south, west), (north, east) = AREA
+        self.lat = rng.uniform(south, north)
+        self.lon = rng.uniform(west, east)
+        self.cog = rng.uniform(0.0, 360.0)
+        self.sog = rng.uniform(4.0, 16.0)
+        self.remote_time = rng.uniform(300.0, 3600.0) # Seconds until the next safety gate
+
+    def step(self, dt):
+        '''
+        Advance by dt seconds.
+        '''
+        self.cog = (self.cog + self.rng.gauss(0.0, 2.0) * dt) % 360.0
+        self.sog = min(20.0, max(2.0, self.sog + self.rng.gauss(0.0, 0.1) * dt))
+
+        distance = self.sog * dt / 3600.0 * NAUTICAL_MILE_DEG
+        self.lat += distance * math.cos(math.radians(self.cog))
+        self.lon += distance * math.sin(math.radians(self.cog)) / math.cos(math.radians(self.lat))
+
+        # Turn back towards the middle of the area when leaving it
+        (south, west), (north, east) = AREA
+        if not (south <= self.lat <= north and west <= self.lon <= east):
+            middle_lat, middle_lon = (south + north) / 2, (west + east) / 2
+            self.cog = math.degrees(math.atan2((middle_lon - self.lon) * math.cos(math.radians(self.lat)),
+                                               middle_lat - self.lat)) % 360.0
+
+        self.remote_time -= dt
+        if self.remote_time <= 0:
+            self.remote_time = self.rng.uniform(300.0, 3600.0)
+
+
+def handover_request(vessel_id):
+    # Same shape as roc_simulator_js/handover-example.json
+    return json.dumps({
+        "OriginallyResponsible": "ROC_1",
+        "ReceivingResponsibility": "ROC_2",
+        "Vessel": vessel_id,
+        "SafetyGate": "safety-gate-1",
+    })
+
+
+def run_worker(worker, vessel_ids, options, results):
+    '''
+    Publish the telemetry of the given vessels until the duration is over, then put a summary on
+    the results queue.
+    '''
+    import zenoh
+
+    config = SessionConfig(mode="peer", connect=options["connect"], listen=options["listen"],
+                           multicast_scouting=options["multicast_scouting"], shm=options["shm"]).to_zenoh_config()
+    # Keep retrying, so it doesn't matter whether the generator or the ROC is started first
+    config.insert_json5("connect/exit_on_failure", "false")
+    session = zenoh.open(config)
+    shm = ShmPayloads(options["shm_pool_size"]) if options["shm"] else None
+
+    rng = random.Random(options["seed"] + worker)
+    vessels = [Vessel(vessel_id, rng) for vessel_id in vessel_ids]
+    publishers = {}
+
+    def put(vessel_id, field, payload):
+        key = (vessel_id, field)
+        publisher = publishers.get(key)
+        if publisher is None:
+            publisher = publishers[key] = session.declare_publisher(vessel_key(vessel_id, FIELD_TOPICS[field]))
+        publisher.put(shm.payload(payload) if shm else payload)
+
+    interval = 1.0 / options["rate"]
+    slow_every = max(1, round(options["rate"] / options["status_rate"]))
+    handover_every = round(options["handover_interval"] * options["rate"]) if options["handover_interval"] else 0
+
+    sent = 0
+    late = 0
+    start = time.perf_counter()
+    end = start + options["duration"] if options["duration"] else math.inf
+    tick = 0
+    while time.perf_counter() < end:
+        for vessel in vessels:
+            vessel.step(interval)
+            put(vessel.vessel_id, "location", location_fix(vessel.lat, vessel.lon))
+            put(vessel.vessel_id, "cog", timestamped_float(vessel.cog))
+            put(vessel.vessel_id, "sog", timestamped_float(vessel.sog))
+            sent += 3
+            if tick % slow_every == 0:
+                put(vessel.vessel_id, "nav_status", nav_status())
+                put(vessel.vessel_id, "roc_status", roc_status())
+                put(vessel.vessel_id, "remote_time", str(round(vessel.remote_time, 1)))
+                sent += 3
+            if handover_every and tick % handover_every == handover_every - 1:
+                put(vessel.vessel_id, "handover_request", handover_request(vessel.vessel_id))
+                put(vessel.vessel_id, "handover_state", "new_priority=ROC_2")
+                sent += 2
+
+        tick += 1
+        delay = start + tick * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            late += 1
+
+    elapsed = time.perf_counter() - start
+    session.close()
+    results.put({"worker": worker, "vessels": len(vessels), "sent": sent, "ticks": tick,
+                 "late_ticks": late, "elapsed_s": elapsed, "shm_fallbacks": shm.fallbacks if shm else None})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish synthetic telemetry of many vessels")
+    parser.add_argument("--vessels", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=2, help="publishing processes")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="position, COG and SOG updates per vessel per second")
+    parser.add_argument("--status-rate", type=float, default=1.0,
+                        help="nav status, ROC status and remote time updates per vessel per second")
+    parser.add_argument("--handover-interval", type=float, default=0.0,
+                        help="seconds between handover request/state pairs per vessel, 0 for none")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run, 0 for until interrupted")
+    parser.add_argument("--prefix", default="MASS_", help="vessel id prefix")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--connect", action="append", metavar="ENDPOINT",
+                        help="endpoint to connect to (repeatable, default tcp/127.0.0.1:7447)")
+    parser.add_argument("--listen", action="append", metavar="ENDPOINT",
+                        help="endpoint for the workers to listen on instead (one per worker, repeatable)")
+    parser.add_argument("--multicast-scouting", action=argparse.BooleanOptionalAction, default=False,
+                        help="discover peers by UDP multicast")
+    parser.add_argument("--shm", action=argparse.BooleanOptionalAction, default=None,
+                        help="publish through shared memory (the ROC needs --shm too)")
+    parser.add_argument("--shm-pool-size", type=float, default=DEFAULT_SHM_POOL_SIZE / 2**20, metavar="MIB",
+                        help="shared memory pool size per worker (in MiB)")
+    parser.add_argument("--output", help="write the JSON summary here instead of stdout")
+    args = parser.parse_args()
+    if args.listen and len(args.listen) != args.workers:
+        parser.error("give one --listen endpoint per worker")
+
+    vessel_ids = [f"{args.prefix}{i}" for i in range(args.vessels)]
+    connect = args.connect if args.connect or args.listen else ["tcp/127.0.0.1:7447"]
+
+    # Spawned rather than forked, zenoh sessions don't survive a fork
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = []
+    for worker in range(args.workers):
+        options = {
+            "connect": connect,
+            "listen": [args.listen[worker]] if args.listen else [],
+            "multicast_scouting": args.multicast_scouting,
+            "shm": args.shm,
+            "shm_pool_size": int(args.shm_pool_size * 2**20),
+            "rate": args.rate,
+            "status_rate": args.status_rate,
+            "handover_interval": args.handover_interval,
+            "duration": args.duration,
+            "seed": args.seed,
+        }
+        process = context.Process(target=run_worker,
+                                  args=(worker, vessel_ids[worker::args.workers], options, results),
+                                  daemon=True)
+        process.start()
+        workers.append(process)
+    print(f"Publishing {args.vessels} vessels from {args.workers} workers...", file=sys.stderr)
+
+    try:
+        summaries = [results.get() for _ in workers]
+    except KeyboardInterrupt:
+        return
+    for process in workers:
+        process.join()
+
+    sent = sum(summary["sent"] for summary in summaries)
+    elapsed = max(summary["elapsed_s"] for summary in summaries)
+    report = {
+        "vessels": args.vessels,
+        "workers": args.workers,
+        "target_rate_hz": args.rate,
+        "messages_sent": sent,
+        "messages_per_s": round(sent / elapsed),
+        "late_ticks": sum(summary["late_ticks"] for summary in summaries),
+        "per_worker": sorted(summaries, key=lambda summary: summary["worker"]),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
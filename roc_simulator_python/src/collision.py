@@ -0,0 +1,264 @@
+'''
+This module contains the collision screening of the ROC: the closest point of approach (CPA) and
+time to it (TCPA) of every pair of vessels of the fleet, re-evaluated on a fixed tick, with the
+pairs that come closer than the alert thresholds reported to listeners.
+
+The latest position, COG and SOG of every vessel are kept in NumPy arrays, and every tick works on
+all vessels at once:
+
+1. Positions are dead reckoned to the time of the tick.
+2. Vessels are sorted into a grid of cells at least as large as the distance two vessels can close
+   within the TCPA threshold, so only pairs in the same or neighbouring cells can raise an alert.
+3. CPA and TCPA are computed for those pairs in one vectorised pass.
+
+Distances are in nautical miles and speeds in knots. Positions are projected onto a plane
+tangent at the middle of each pair, which is accurate to well under the alert distances for
+vessels within a few tens of miles of each other.
+'''
+
+import math
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# Alert on pairs whose CPA is within this distance (nautical miles) within this time (seconds)
+DEFAULT_CPA_ALERT_NM = 0.5
+DEFAULT_TCPA_ALERT_S = 12 * 60.0
+
+# Interval between screenings (time in seconds)
+SCREENING_TICK = 1.0
+
+# Vessels not heard from for this long are left out (time in seconds)
+VESSEL_STALE_AFTER = 5 * 60.0
+
+# Faster SOGs are taken as faulty and capped, so a single bad value can't blow up the grid cells (knots)
+MAX_SCREENING_SOG_KN = 50.0
+
+# Initial number of vessels the arrays have room for, they grow as needed
+INITIAL_CAPACITY = 1024
+
+# A pair of vessels coming closer than the thresholds
+Encounter = namedtuple("Encounter", ["vessel_a", "vessel_b", "cpa_nm", "tcpa_s", "distance_nm"])
+
+# Half of the 3x3 cell neighbourhood (with the cell itself), so every pair of cells is visited once
+_NEIGHBOUR_OFFSETS = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+
+
+def candidate_pairs(cell_x, cell_y):
+    '''
+    Index arrays (i, j), i < j, of the pairs of points in the same or neighbouring grid cells,
+    given the integer cell coordinates of every point.
+    '''
+    count = len(cell_x)
+    if count < 2:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty
+
+    # One integer key per cell, the offsets below never leave the key range
+    cell_x = cell_x - cell_x.min() + 1
+    cell_y = cell_y - cell_y.min() + 1
+    stride = int(cell_y.max()) + 2
+    keys = cell_x * stride + cell_y
+
+    order = np.argsort(keys, kind="stable")
+    cells, starts, sizes = np.unique(keys[order], return_index=True, return_counts=True)
+
+    pairs_i = []
+    pairs_j = []
+    for dx, dy in _NEIGHBOUR_OFFSETS:
+        if dx == 0 and dy == 0:
+            a, b = np.arange(len(cells)), np.arange(len(cells))
+        else:
+            neighbours = cells + dx * stride + dy
+            found = np.searchsorted(cells, neighbours)
+            found[found == len(cells)] = 0
+            a = np.nonzero(cells[found] == neighbours)[0]
+            b = found[a]
+
+        # Every member of cell a with every member of cell b
+        combinations = sizes[a] * sizes[b]
+        total = int(combinations.sum())
+        if total == 0:
+            continue
+        pair_cell = np.repeat(np.arange(len(a)), combinations)
+        within = np.arange(total) - np.repeat(np.cumsum(combinations) - combinations, combinations)
+        size_b = sizes[b][pair_cell]
+        i = starts[a][pair_cell] + within // size_b
+        j = starts[b][pair_cell] + within % size_b
+        if dx == 0 and dy == 0:
+            keep = i < j
+            i, j = i[keep], j[keep]
+        pairs_i.append(order[i])
+        pairs_j.append(order[j])
+
+    if not pairs_i:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def cpa_tcpa(lat_a, lon_a, velocity_a, lat_b, lon_b, velocity_b):
+    '''
+    (CPA in nm, TCPA in s, current distance in nm) of pairs of vessels, given as arrays of
+    positions in degrees and (east, north) velocities in knots. Pairs that are moving apart have
+    their CPA now, at a TCPA of 0.
+    '''
+    # Relative position of b seen from a, on the plane tangent at the middle of the pair
+    mid_lat = np.radians((lat_a + lat_b) / 2)
+    dx = (lon_b - lon_a) * 60.0 * np.cos(mid_lat)
+    dy = (lat_b - lat_a) * 60.0
+    dvx = velocity_b[0] - velocity_a[0]
+    dvy = velocity_b[1] - velocity_a[1]
+
+    speed_sq = dvx * dvx + dvy * dvy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tcpa_h = np.where(speed_sq > 0, -(dx * dvx + dy * dvy) / speed_sq, 0.0)
+    tcpa_h = np.maximum(tcpa_h, 0.0)
+    cpa = np.hypot(dx + dvx * tcpa_h, dy + dvy * tcpa_h)
+    return cpa, tcpa_h * 3600.0, np.hypot(dx, dy)
+
+
+class CollisionScreening:
+    def __init__(self, cpa_alert_nm=DEFAULT_CPA_ALERT_NM, tcpa_alert_s=DEFAULT_TCPA_ALERT_S, tick=SCREENING_TICK):
+        self.cpa_alert_nm = cpa_alert_nm
+        self.tcpa_alert_s = tcpa_alert_s
+        self.tick = tick
+        self.lock = threading.Lock()
+
+        # Vessel state, one row per vessel. NaN until received.
+        self.ids = []
+        self.rows = {} # Vessel id -> row
+        self.lat = np.full(INITIAL_CAPACITY, np.nan)
+        self.lon = np.full(INITIAL_CAPACITY, np.nan)
+        self.cog = np.full(INITIAL_CAPACITY, np.nan)
+        self.sog = np.full(INITIAL_CAPACITY, np.nan)
+        self.fixed_at = np.full(INITIAL_CAPACITY, np.nan) # time.monotonic() of the position
+
+        # Called as listener(alerts) with the list of Encounters, soonest first, after every
+        # screening that has alerts or clears the last ones. Called from the screening thread.
+        self.listeners = []
+        self.alerts = []
+
+        # Statistics of the last screening
+        self.last_vessels = 0
+        self.last_pairs = 0
+        self.last_duration = 0.0
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.tick):
+            self.screen()
+
+
+    # -------------------------------------------------------------------
+    # INPUTS (monitor callbacks, callable from any thread)
+    # -------------------------------------------------------------------
+
+    def _row(self, vessel_id):
+        row = self.rows.get(vessel_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self.lat):
+                for name in ("lat", "lon", "cog", "sog", "fixed_at"):
+                    array = getattr(self, name)
+                    setattr(self, name, np.concatenate([array, np.full(len(array), np.nan)]))
+            self.ids.append(vessel_id)
+            self.rows[vessel_id] = row
+        return row
+
+    def observe_location(self, vessel_id, lat, lon):
+        with self.lock:
+            row = self._row(vessel_id)
+            self.lat[row] = lat
+            self.lon[row] = lon
+            self.fixed_at[row] = time.monotonic()
+
+    def observe_cog(self, vessel_id, value):
+        with self.lock:
+            self.cog[self._row(vessel_id)] = value
+
+    def observe_sog(self, vessel_id, value):
+        with self.lock:
+            self.sog[self._row(vessel_id)] = value
+
+
+    # -------------------------------------------------------------------
+    # SCREENING
+    # -------------------------------------------------------------------
+
+    def screen(self, now=None):
+        '''
+        Screen every pair of vessels, notify the listeners if the alerts changed, and return them.
+        '''
+        start = time.perf_counter()
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            count = len(self.ids)
+            ids = list(self.ids)
+            lat, lon, cog, sog, fixed_at = (array[:count].copy() for array in
+                                            (self.lat, self.lon, self.cog, self.sog, self.fixed_at))
+
+        # Vessels with a complete and recent state
+        age = now - fixed_at
+        valid = np.nonzero(~(np.isnan(lat) | np.isnan(lon) | np.isnan(cog) | np.isnan(sog))
+                           & (age <= VESSEL_STALE_AFTER))[0]
+        lat, lon, cog, sog, age = lat[valid], lon[valid], cog[valid], sog[valid], age[valid]
+
+        # Velocities (east, north) in knots, and positions dead reckoned to now
+        course = np.radians(cog)
+        sog = np.clip(sog, 0.0, MAX_SCREENING_SOG_KN)
+        velocity = (sog * np.sin(course), sog * np.cos(course))
+        hours = np.maximum(age, 0.0) / 3600.0
+        lon = lon + velocity[0] * hours / (60.0 * np.maximum(np.cos(np.radians(lat)), 0.01))
+        lat = lat + velocity[1] * hours / 60.0
+
+        # Cells no two vessels can cross towards each other within the TCPA threshold. In longitude
+        # they are sized for the highest latitude, where a degree is shortest.
+        alerts = []
+        pairs = 0
+        if len(valid) >= 2:
+            reach_nm = self.cpa_alert_nm + 2 * float(sog.max()) * self.tcpa_alert_s / 3600.0
+            cell_lat = reach_nm / 60.0
+            cos_max = max(math.cos(math.radians(min(float(np.abs(lat).max()), 89.0))), 0.01)
+            cell_lon = reach_nm / (60.0 * cos_max)
+            i, j = candidate_pairs(np.floor(lon / cell_lon).astype(np.int64),
+                                   np.floor(lat / cell_lat).astype(np.int64))
+            pairs = len(i)
+
+            cpa, tcpa, distance = cpa_tcpa(lat[i], lon[i], (velocity[0][i], velocity[1][i]),
+                                           lat[j], lon[j], (velocity[0][j], velocity[1][j]))
+            hits = np.nonzero((cpa <= self.cpa_alert_nm) & (tcpa <= self.tcpa_alert_s))[0]
+            hits = hits[np.argsort(tcpa[hits], kind="stable")]
+            for k in hits.tolist():
+                a, b = ids[valid[i[k]]], ids[valid[j[k]]]
+                if b < a:
+                    a, b = b, a
+                alerts.append(Encounter(a, b, float(cpa[k]), float(tcpa[k]), float(distance[k])))
+
+        self.last_vessels = len(valid)
+        self.last_pairs = pairs
+        self.last_duration = time.perf_counter() - start
+
+        notify = alerts or self.alerts
+        self.alerts = alerts
+        if notify:
+            for listener in self.listeners:
+                listener(alerts)
+        return alerts
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
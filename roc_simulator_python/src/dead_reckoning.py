@@ -0,0 +1,181 @@
+'''
+This module contains the dead reckoning of the ROC: vessel positions projected forward from their
+latest location fix along their latest COG and SOG, so the GUI can move the vessel at its display
+rate however rarely fixes arrive (e.g. with location_fix downsampled, see --location-rate).
+
+When a new fix arrives, the difference between it and the position shown until then is blended
+out over SNAP_BACK_TIME instead of jumping there, unless it is more than SNAP_BACK_MAX_M. The shown
+position is thus never further than SNAP_BACK_MAX_M from the projection of the latest fix.
+
+Every fix is also compared with where the previous one was projected to be by then. These
+prediction errors are kept in a histogram, and tell how far the position stream can be downsampled
+for the vessels' speeds and manoeuvres.
+
+Times are wall clock times in ns, as the monitor's receive times. Projection is done on a plane
+tangent at the vessel, which is accurate to centimetres over the distances covered between fixes.
+'''
+
+import math
+import sys
+import threading
+
+from telemetry_stats import LogHistogram
+
+# New fixes further than this from the shown position are jumped to instead of blended in (metres)
+SNAP_BACK_MAX_M = 250.0
+
+# Time over which the shown position converges onto the projection of a new fix (time in seconds)
+SNAP_BACK_TIME = 1.0
+
+# Positions are not projected further than this past the latest fix, e.g. when the link drops
+# (time in seconds)
+MAX_PROJECTION_TIME = 60.0
+
+METRES_PER_NM = 1852.0
+METRES_PER_DEGREE = 60 * METRES_PER_NM
+
+# VesselState fields dead reckoning is based on
+DEAD_RECKONING_FIELDS = ("location", "cog", "sog")
+
+
+def project(lat, lon, cog, sog, seconds):
+    '''
+    Position after sailing for seconds along cog (degrees) at sog (knots) from (lat, lon).
+    '''
+    distance = sog * METRES_PER_NM * seconds / 3600.0
+    course = math.radians(cog)
+    lat_next = lat + distance * math.cos(course) / METRES_PER_DEGREE
+    lon_next = lon + distance * math.sin(course) / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return lat_next, lon_next
+
+
+def distance_m(lat_a, lon_a, lat_b, lon_b):
+    '''
+    Distance between two nearby positions (metres).
+    '''
+    dx = (lon_b - lon_a) * math.cos(math.radians((lat_a + lat_b) / 2))
+    dy = lat_b - lat_a
+    return math.hypot(dx, dy) * METRES_PER_DEGREE
+
+
+class VesselEstimate:
+    '''
+    Dead reckoned position of a single vessel. Not thread safe on its own.
+    '''
+    def __init__(self):
+        self.fix_ns = None # Receive time of the latest fix
+        self.cog = None
+        self.sog = None
+
+        # Projection base: the latest fix, or where it had been projected to when COG or SOG
+        # last changed
+        self.base = None # (lat, lon)
+        self.base_ns = None
+
+        # What the shown position was off the projection when the latest fix arrived, blended
+        # out over SNAP_BACK_TIME
+        self.offset = (0.0, 0.0) # (lat, lon)
+
+    def projected(self, now_ns):
+        '''
+        Projection of the latest fix at now_ns, without the snap back offset.
+        '''
+        lat, lon = self.base
+        if self.cog is None or self.sog is None:
+            return lat, lon
+        until_ns = min(now_ns, self.fix_ns + int(MAX_PROJECTION_TIME * 1e9))
+        seconds = max(until_ns - self.base_ns, 0) / 1e9
+        return project(lat, lon, self.cog, self.sog, seconds)
+
+    def position(self, now_ns):
+        '''
+        Position to show at now_ns, or None before the first fix.
+        '''
+        if self.base is None:
+            return None
+        lat, lon = self.projected(now_ns)
+        remaining = 1.0 - (now_ns - self.fix_ns) / (SNAP_BACK_TIME * 1e9)
+        if remaining > 0:
+            lat += self.offset[0] * min(remaining, 1.0)
+            lon += self.offset[1] * min(remaining, 1.0)
+        return lat, lon
+
+    def fix(self, now_ns, lat, lon):
+        '''
+        Take a new fix, returning its prediction error in metres (None for the first one).
+        '''
+        error = None
+        offset = (0.0, 0.0)
+        if self.base is not None:
+            error = distance_m(*self.projected(now_ns), lat, lon)
+            shown_lat, shown_lon = self.position(now_ns)
+            if distance_m(shown_lat, shown_lon, lat, lon) <= SNAP_BACK_MAX_M:
+                offset = (shown_lat - lat, shown_lon - lon)
+        self.base = (lat, lon)
+        self.base_ns = self.fix_ns = now_ns
+        self.offset = offset
+        return error
+
+    def set_velocity(self, now_ns, cog=None, sog=None):
+        '''
+        Take a new COG and/or SOG, applying from now_ns on.
+        '''
+        if self.base is not None:
+            self.base = self.projected(now_ns)
+            self.base_ns = max(self.base_ns, min(now_ns, self.fix_ns + int(MAX_PROJECTION_TIME * 1e9)))
+        if cog is not None:
+            self.cog = cog
+        if sog is not None:
+            self.sog = sog
+
+
+class DeadReckoning:
+    '''
+    VesselEstimates of every vessel, and the prediction errors of all of their fixes.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.vessels = {} # Vessel id -> VesselEstimate
+
+        # Prediction errors of every fix (in millimetres, so the histogram resolves errors from ~1 m)
+        self.errors = LogHistogram()
+
+    def record(self, vessel_id, field, time_ns, value):
+        '''
+        Add a sample. Fields not in DEAD_RECKONING_FIELDS are ignored, so every field can be passed
+        in. Called from zenoh threads.
+        '''
+        if field not in DEAD_RECKONING_FIELDS:
+            return
+        with self.lock:
+            vessel = self.vessels.get(vessel_id)
+            if vessel is None:
+                vessel = self.vessels[vessel_id] = VesselEstimate()
+            if field == "location":
+                error = vessel.fix(time_ns, *value)
+                if error is not None:
+                    self.errors.record(error * 1000)
+            elif field == "cog":
+                vessel.set_velocity(time_ns, cog=value)
+            else:
+                vessel.set_velocity(time_ns, sog=value)
+
+    def position(self, vessel_id, now_ns):
+        '''
+        Position (lat, lon) of a vessel to show at now_ns, or None if it has had no fix yet.
+        '''
+        with self.lock:
+            vessel = self.vessels.get(vessel_id)
+            return vessel.position(now_ns) if vessel else None
+
+    def error_percentile(self, fraction):
+        '''
+        Approximate prediction error (metres) below which the given fraction of fixes are, or None.
+        '''
+        value = self.errors.percentile(fraction)
+        return None if value is None else value / 1000
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
@@ -0,0 +1,305 @@
+'''
+This module contains the fleet layer of the map: the positions of every other vessel, drawn on the
+map widget's canvas without going through its markers.
+
+TkinterMapView redraws every marker it has on every pan and zoom event, which doesn't scale to a
+fleet. Here vessel positions are kept in a spatial grid index, and only vessels inside the
+viewport get canvas items. Nearby vessels are clustered into count bubbles at low zoom levels, or
+when too many are in view, so the number of canvas items stays bounded however many vessels are
+loaded. Clusters are formed on a grid fixed to the map rather than to the screen, so they don't
+change while panning, and are only formed again once vessels have moved.
+
+Positions are kept in normalized web mercator coordinates, (0, 0) being the top left corner of the
+world map and (1, 1) its bottom right one.
+'''
+
+import math
+import sys
+
+from tkintermapview import TkinterMapView
+
+from track import TILE_SIZE, to_map_pixels
+
+# Cells of the spatial index are the size of map tiles at this zoom level (~150 km at 8)
+FLEET_INDEX_ZOOM = 8
+
+# Vessels are clustered below this zoom level, or at any zoom level when more than
+# FLEET_MAX_MARKERS of them are in view
+FLEET_CLUSTER_MAX_ZOOM = 10
+FLEET_MAX_MARKERS = 300
+
+# Size of the cells vessels are clustered in (pixels)
+FLEET_CLUSTER_CELL_PX = 48
+
+# Vessel ids are shown next to their markers from this zoom level on
+FLEET_LABEL_MIN_ZOOM = 11
+
+# Radius of a vessel marker, and of a cluster bubble of 2 vessels, growing with its count (pixels)
+FLEET_MARKER_RADIUS = 4
+FLEET_BUBBLE_RADIUS = 9
+
+FLEET_MARKER_COLOR = "#3E69CB"
+FLEET_BUBBLE_COLOR = "#F0A030"
+
+# Canvas tag of all fleet layer items
+FLEET_TAG = "fleet"
+
+
+def to_world(lat, lon):
+    '''
+    Normalized web mercator coordinates of a position.
+    '''
+    x, y = to_map_pixels(lat, lon, 0)
+    return x / TILE_SIZE, y / TILE_SIZE
+
+
+class SpatialGrid:
+    '''
+    Points by id, bucketed in square cells of the world map for range queries.
+    '''
+    def __init__(self, level=FLEET_INDEX_ZOOM):
+        self.cells_per_side = 2 ** level
+        self.cells = {} # (column, row) -> {id: (x, y)}
+        self.points = {} # id -> (x, y, cell)
+
+    def __len__(self):
+        return len(self.points)
+
+    def all(self):
+        '''
+        [(id, x, y)] of all points.
+        '''
+        return [(point_id, x, y) for point_id, (x, y, _) in self.points.items()]
+
+    def _cell(self, x, y):
+        last = self.cells_per_side - 1
+        return (min(max(int(x * self.cells_per_side), 0), last),
+                min(max(int(y * self.cells_per_side), 0), last))
+
+    def update(self, point_id, x, y):
+        cell = self._cell(x, y)
+        old = self.points.get(point_id)
+        if old is not None and old[2] != cell:
+            self._remove_from_cell(point_id, old[2])
+        self.points[point_id] = (x, y, cell)
+        self.cells.setdefault(cell, {})[point_id] = (x, y)
+
+    def remove(self, point_id):
+        old = self.points.pop(point_id, None)
+        if old is not None:
+            self._remove_from_cell(point_id, old[2])
+
+    def _remove_from_cell(self, point_id, cell):
+        points = self.cells[cell]
+        del points[point_id]
+        if not points:
+            del self.cells[cell]
+
+    def query(self, left, top, right, bottom):
+        '''
+        [(id, x, y)] of the points inside the rectangle.
+        '''
+        first_column, first_row = self._cell(left, top)
+        last_column, last_row = self._cell(right, bottom)
+        area = (last_column - first_column + 1) * (last_row - first_row + 1)
+        if area > len(self.cells):
+            # Zoomed out: fewer occupied cells than cells in view
+            cells = [points for (column, row), points in self.cells.items()
+                     if first_column <= column <= last_column and first_row <= row <= last_row]
+        else:
+            cells = [self.cells[cell] for cell in
+                     ((column, row) for column in range(first_column, last_column + 1)
+                      for row in range(first_row, last_row + 1))
+                     if cell in self.cells]
+
+        found = []
+        for points in cells:
+            for point_id, (x, y) in points.items():
+                if left <= x <= right and top <= y <= bottom:
+                    found.append((point_id, x, y))
+        return found
+
+
+def cluster(points, cell_size):
+    '''
+    Group [(id, x, y)] in square cells of cell_size, returning [(x, y, count, id)] with the mean
+    position of every cell's points, and the id of its point if it has a single one (else None).
+    '''
+    cells = {}
+    for point_id, x, y in points:
+        key = (int(x // cell_size), int(y // cell_size))
+        group = cells.get(key)
+        if group is None:
+            cells[key] = [x, y, 1, point_id]
+        else:
+            group[0] += x
+            group[1] += y
+            group[2] += 1
+            group[3] = None
+    return [(x / count, y / count, count, point_id) for x, y, count, point_id in cells.values()]
+
+
+class FleetLayer:
+    def __init__(self, map_widget):
+        '''
+        Draw the fleet on map_widget's canvas. Call draw() whenever the map moved or vessels did.
+        '''
+        self.map_widget = map_widget
+        self.canvas = map_widget.canvas
+        self.grid = SpatialGrid()
+        self.dirty = False # Vessels moved since the last draw
+        self.clusters = {} # Zoom level -> cluster() of all vessels, until they move
+
+        # Canvas items of what is currently drawn
+        self.marker_items = {} # Vessel id -> (circle, label or None)
+        self.bubble_items = [] # [(circle, count text, count shown)], reused from draw to draw
+
+        # Counters
+        self.draws = 0
+        self.items_created = 0
+        self.items_deleted = 0
+
+    def update(self, vessel_id, lat, lon):
+        self.grid.update(vessel_id, *to_world(lat, lon))
+        self.dirty = True
+        self.clusters = {}
+
+    def remove(self, vessel_id):
+        self.grid.remove(vessel_id)
+        self.dirty = True
+        self.clusters = {}
+
+    def _clustered(self, zoom, left, top, right, bottom):
+        clusters = self.clusters.get(zoom)
+        if clusters is None:
+            clusters = self.clusters[zoom] = cluster(self.grid.all(), FLEET_CLUSTER_CELL_PX / (2 ** zoom * TILE_SIZE))
+        return [group for group in clusters if left <= group[0] <= right and top <= group[1] <= bottom]
+
+    def visible_groups(self):
+        '''
+        [(canvas x, canvas y, count, vessel id or None)] of the markers and bubbles in view, and
+        whether labels are shown at this zoom level.
+        '''
+        widget = self.map_widget
+        zoom = round(widget.zoom)
+        (left, top), (right, bottom) = widget.upper_left_tile_pos, widget.lower_right_tile_pos
+        if right <= left or bottom <= top:
+            return [], False
+
+        # Map tiles per world, and canvas pixels per tile
+        tiles = 2 ** zoom
+        scale_x = widget.width / (right - left)
+        scale_y = widget.height / (bottom - top)
+
+        # Anything partly in view is drawn too
+        margin = FLEET_BUBBLE_RADIUS * 3 / scale_x
+        bounds = ((left - margin) / tiles, (top - margin) / tiles, (right + margin) / tiles, (bottom + margin) / tiles)
+        if zoom < FLEET_CLUSTER_MAX_ZOOM:
+            groups = self._clustered(zoom, *bounds)
+        else:
+            visible = self.grid.query(*bounds)
+            if len(visible) > FLEET_MAX_MARKERS:
+                groups = self._clustered(zoom, *bounds)
+            else:
+                groups = [(x, y, 1, vessel_id) for vessel_id, x, y in visible]
+
+        return [((x * tiles - left) * scale_x, (y * tiles - top) * scale_y, count, vessel_id)
+                for x, y, count, vessel_id in groups], zoom >= FLEET_LABEL_MIN_ZOOM
+
+    def draw(self):
+        groups, labels = self.visible_groups()
+        canvas = self.canvas
+
+        markers = {}
+        bubbles = []
+        for x, y, count, vessel_id in groups:
+            if count == 1:
+                markers[vessel_id] = (x, y)
+            else:
+                bubbles.append((x, y, count))
+
+        # Markers: kept for vessels that stay in view, created and deleted as they come and go
+        for vessel_id in [vessel_id for vessel_id in self.marker_items if vessel_id not in markers]:
+            for item in self.marker_items.pop(vessel_id):
+                if item is not None:
+                    canvas.delete(item)
+                    self.items_deleted += 1
+        r = FLEET_MARKER_RADIUS
+        for vessel_id, (x, y) in markers.items():
+            items = self.marker_items.get(vessel_id)
+            if items is None:
+                circle = canvas.create_oval(x - r, y - r, x + r, y + r, fill=FLEET_MARKER_COLOR,
+                                            outline="white", tags=FLEET_TAG)
+                self.items_created += 1
+                items = (circle, None)
+            else:
+                canvas.coords(items[0], x - r, y - r, x + r, y + r)
+
+            label = items[1]
+            if labels and label is None:
+                label = canvas.create_text(x + r + 2, y, text=vessel_id, anchor="w", font=("Arial", 8),
+                                           tags=FLEET_TAG)
+                self.items_created += 1
+            elif labels:
+                canvas.coords(label, x + r + 2, y)
+            elif label is not None:
+                canvas.delete(label)
+                self.items_deleted += 1
+                label = None
+            self.marker_items[vessel_id] = (items[0], label)
+
+        # Bubbles: a pool of items, moved to wherever the bubbles are now
+        for index, (x, y, count) in enumerate(bubbles):
+            r = FLEET_BUBBLE_RADIUS * (1 + math.log10(count / 2) / 2)
+            if index < len(self.bubble_items):
+                circle, text, shown = self.bubble_items[index]
+                canvas.coords(circle, x - r, y - r, x + r, y + r)
+                canvas.coords(text, x, y)
+                if shown != count:
+                    canvas.itemconfigure(text, text=str(count))
+            else:
+                circle = canvas.create_oval(x - r, y - r, x + r, y + r, fill=FLEET_BUBBLE_COLOR,
+                                            outline="white", tags=FLEET_TAG)
+                text = canvas.create_text(x, y, text=str(count), font=("Arial", 8, "bold"), tags=FLEET_TAG)
+                self.items_created += 2
+            self.bubble_items[index:index + 1] = [(circle, text, count)]
+        for circle, text, _ in self.bubble_items[len(bubbles):]:
+            canvas.delete(circle, text)
+            self.items_deleted += 2
+        del self.bubble_items[len(bubbles):]
+
+        # Above the map tiles, below the widget's own markers and paths
+        canvas.tag_raise(FLEET_TAG)
+        self.map_widget.manage_z_order()
+        self.dirty = False
+        self.draws += 1
+
+
+class FleetMapView(TkinterMapView):
+    '''
+    TkinterMapView with a FleetLayer (in self.fleet), redrawn whenever the map moves or zooms.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.fleet = None
+        super().__init__(*args, **kwargs)
+        self.fleet = FleetLayer(self)
+
+    def get_tile_image_from_cache(self, zoom, x, y):
+        # A single lookup, as the tile loading threads may evict the tile between a check and a read
+        return self.tile_image_cache.get(f"{zoom}{x}{y}", False)
+
+    def draw_initial_array(self):
+        super().draw_initial_array()
+        if self.fleet:
+            self.fleet.draw()
+
+    def draw_move(self, called_after_zoom=False):
+        # Also called after zooming and resizing
+        super().draw_move(called_after_zoom)
+        if self.fleet:
+            self.fleet.draw()
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
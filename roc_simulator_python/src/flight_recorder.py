@@ -0,0 +1,176 @@
+'''
+This module contains the telemetry flight recorder and its replay source.
+
+The recorder appends every raw sample the ShipTelemetryMonitor receives (key expression, receive
+time and payload bytes) to a binary log, and every INDEX_INTERVAL records also writes the record's
+time and file offset to an index file next to it, so a replay can seek to a point in time without
+reading the whole log.
+
+Log file:   MAGIC, then records of RECORD_HEADER (receive time in ns, key length, payload length),
+            followed by the key (utf-8) and the payload.
+Index file: entries of INDEX_ENTRY (receive time in ns, offset of the record in the log).
+
+Replay feeds the recorded samples back into a monitor at the recorded pace, N times faster, or as
+fast as possible.
+'''
+
+import bisect
+import os
+import struct
+import sys
+import threading
+import time
+import zenoh
+
+MAGIC = b"ROCREC01"
+RECORD_HEADER = struct.Struct("<qHI")
+INDEX_ENTRY = struct.Struct("<qQ")
+
+# Write an index entry for every this many records
+INDEX_INTERVAL = 64
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+class FlightRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = 0
+
+        self.log = open(path, "ab")
+        self.index = open(index_path(path), "ab")
+        if self.log.tell() == 0:
+            self.log.write(MAGIC)
+
+    def record(self, key_expr, payload, received_ns=None):
+        '''
+        Append a raw sample to the log. Safe to call from any thread.
+        '''
+        key = key_expr.encode()
+        received_ns = received_ns or time.time_ns()
+        with self.lock:
+            if self.log.closed:
+                return
+            if self.records % INDEX_INTERVAL == 0:
+                self.index.write(INDEX_ENTRY.pack(received_ns, self.log.tell()))
+            self.log.write(RECORD_HEADER.pack(received_ns, len(key), len(payload)))
+            self.log.write(key)
+            self.log.write(payload)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            self.log.close()
+            self.index.close()
+        print(f"{self.__class__.__name__}: {self.records} samples recorded to {self.path}")
+
+
+class RecordedSample:
+    '''
+    Stand-in for a zenoh Sample, with what the monitor reads from it.
+    '''
+    def __init__(self, key_expr, payload):
+        self.key_expr = key_expr
+        self.payload = zenoh.ZBytes(payload)
+
+
+class FlightLog:
+    '''
+    Reader for a recorded log.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+        # Index entries as parallel lists, for bisecting on time
+        self.index_times = []
+        self.index_offsets = []
+        if os.path.exists(index_path(path)):
+            with open(index_path(path), "rb") as index:
+                data = index.read()
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            for received_ns, offset in INDEX_ENTRY.iter_unpack(data[:usable]):
+                self.index_times.append(received_ns)
+                self.index_offsets.append(offset)
+
+    def records(self, start_ns=None):
+        '''
+        Yield (received_ns, key_expr, payload) for every record, from start_ns on if given.
+        A truncated last record (e.g. from a crashed recorder) is ignored.
+        '''
+        with open(self.path, "rb") as log:
+            if log.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a flight recorder log")
+
+            if start_ns is not None:
+                # Start from the last indexed record before start_ns
+                position = bisect.bisect_right(self.index_times, start_ns) - 1
+                if position >= 0:
+                    log.seek(self.index_offsets[position])
+
+            while True:
+                header = log.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                received_ns, key_length, payload_length = RECORD_HEADER.unpack(header)
+                key = log.read(key_length)
+                payload = log.read(payload_length)
+                if len(payload) < payload_length:
+                    return
+                if start_ns is not None and received_ns < start_ns:
+                    continue
+                yield received_ns, key.decode(), payload
+
+    def first_time(self):
+        for received_ns, _, _ in self.records():
+            return received_ns
+        return None
+
+
+class ReplaySource:
+    '''
+    Feeds a recorded log into a monitor, as if the samples were received live.
+    '''
+    def __init__(self, path, monitor, speed=1.0, start_offset=0.0):
+        self.log = FlightLog(path)
+        self.monitor = monitor
+        self.speed = speed # Replay speed factor, 0 or None for as fast as possible
+        self.start_offset = start_offset # Seconds into the recording to start from
+        self.replayed = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        first_ns = self.log.first_time()
+        if first_ns is None:
+            return
+        start_ns = first_ns + int(self.start_offset * 1e9)
+
+        replay_start = time.monotonic()
+        for received_ns, key_expr, payload in self.log.records(start_ns):
+            if self.stopped.is_set():
+                break
+
+            if self.speed:
+                delay = replay_start + (received_ns - start_ns) / 1e9 / self.speed - time.monotonic()
+                if delay > 0 and self.stopped.wait(delay):
+                    break
+
+            self.monitor.on_sample(RecordedSample(key_expr, payload))
+            self.replayed += 1
+
+        print(f"{self.__class__.__name__}: {self.replayed} samples replayed from {self.log.path}")
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
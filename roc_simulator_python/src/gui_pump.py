@@ -0,0 +1,55 @@
+'''
+This module contains the latest-value slots used to hand telemetry from Zenoh callback threads to
+the Tk thread.
+
+Writers (any thread) only store the newest arguments for a field and mark it dirty. The GUI drains
+the dirty fields on its own refresh tick, so a field updated many times between two frames is
+rendered once, and Tk widgets are only ever touched from the Tk thread.
+'''
+
+import sys
+import threading
+import time
+
+# Default rate at which telemetry updates are rendered (frames per second)
+DEFAULT_FRAME_RATE = 20
+
+
+class LatestValueSlots:
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        # Field -> (time of the write in ns, latest arguments). Kept in the order fields first
+        # became dirty since the last drain, so e.g. a handover request is still rendered before
+        # the following handover state.
+        self._dirty = {}
+
+        # Counters
+        self.writes = 0
+        self.coalesced = 0
+        self.drained = 0
+
+    def put(self, field, *args):
+        '''
+        Store the latest value of field. Safe to call from any thread.
+        '''
+        with self._lock:
+            self.writes += 1
+            if field in self._dirty:
+                self.coalesced += 1
+            self._dirty[field] = (time.time_ns(), args)
+
+    def drain(self):
+        '''
+        Take all dirty fields, returning a dict of field -> (write time in ns, latest arguments).
+        '''
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+            self.drained += len(dirty)
+        return dirty
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
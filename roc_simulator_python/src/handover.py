@@ -0,0 +1,392 @@
+'''
+This module contains the handover engine of the ROC: it parses the ship's handover messages,
+tracks the handover of every vessel through explicit states, and keeps a safety-gate countdown
+per vessel.
+
+Handover messages are JSON, shaped like roc_simulator_js/handover-example.json:
+
+    {"OriginallyResponsible": "ROC_1", "ReceivingResponsibility": "ROC_2",
+     "Vessel": "MASS_0", "SafetyGate": "safety-gate-1"}
+
+The older "key=value" strings (e.g. "new_priority=ROC_2") are still understood.
+
+States of a vessel's handover:
+
+    IDLE ──request──> REQUESTED ──relinquish/takeover sent──> AWAITING_CONFIRMATION ──state──> COMPLETED
+                          │                                          │
+                          └────────── safety gate reached, or no confirmation in time ──────> TIMED_OUT
+
+The countdowns run locally between remote_time samples, which only correct them. All timers
+(countdown ticks, safety gates, confirmation timeouts) live in one hierarchical timer wheel,
+advanced by a single thread, so scheduling and cancelling a timer is O(1) however many vessels
+are handed over at once.
+'''
+
+import contextlib
+import json
+import math
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# Handover states
+IDLE = "idle"
+REQUESTED = "requested"
+AWAITING_CONFIRMATION = "awaiting confirmation"
+COMPLETED = "completed"
+TIMED_OUT = "timed out"
+
+# Give up on a sent relinquish/takeover if the ship hasn't confirmed it after this long (time in seconds)
+CONFIRMATION_TIMEOUT = 30.0
+
+# Resolution of the timer wheel (time in seconds), and its number of slots per level. With these,
+# level 0 covers 25.6 s, level 1 27 minutes and level 2 29 hours; later timers are cascaded down
+# when their time comes closer.
+TIMER_TICK = 0.1
+WHEEL_LEVEL_BITS = (8, 6, 6)
+
+HandoverMessage = namedtuple("HandoverMessage", ["vessel_id", "from_roc", "to_roc", "safety_gate", "raw"])
+
+# Immutable snapshot of a vessel's handover, as handed to listeners
+HandoverStatus = namedtuple("HandoverStatus",
+                            ["vessel_id", "state", "from_roc", "to_roc", "safety_gate", "reason"])
+
+
+def parse_handover_message(text, vessel_id=None):
+    '''
+    Parse a JSON or legacy "key=value" handover message. Fields it doesn't contain are None,
+    except the vessel, which defaults to the vessel the message was received from.
+    Raises ValueError for JSON that isn't a handover message.
+    '''
+    text = text.strip()
+    if text.startswith("{"):
+        fields = json.loads(text)
+        if not isinstance(fields, dict):
+            raise ValueError(f"Handover message is not an object: {text!r}")
+        return HandoverMessage(
+            vessel_id=fields.get("Vessel") or vessel_id,
+            from_roc=fields.get("OriginallyResponsible"),
+            to_roc=fields.get("ReceivingResponsibility"),
+            safety_gate=fields.get("SafetyGate"),
+            raw=text,
+        )
+
+    # Legacy: whitespace or comma separated key=value pairs
+    fields = {}
+    for pair in text.replace(",", " ").split():
+        key, _, value = pair.partition("=")
+        fields[key.strip()] = value.strip()
+    return HandoverMessage(
+        vessel_id=fields.get("vessel") or vessel_id,
+        from_roc=fields.get("old_priority") or fields.get("from"),
+        to_roc=fields.get("new_priority") or fields.get("to"),
+        safety_gate=fields.get("safety_gate"),
+        raw=text,
+    )
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "slot")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline # In ticks
+        self.callback = callback
+        self.slot = None # Set of the wheel slot the timer is in, None once fired or cancelled
+
+
+class TimerWheel:
+    '''
+    Hierarchical timing wheel. Timers are kept in per tick slots at the level their deadline
+    falls in, and moved down a level whenever the lower level wraps around. Not thread safe on its
+    own.
+    '''
+    def __init__(self, tick=TIMER_TICK, level_bits=WHEEL_LEVEL_BITS, now=None):
+        self.tick = tick
+        self.origin = time.monotonic() if now is None else now
+        self.current = 0 # Ticks since origin processed so far
+
+        self.shifts = []
+        shift = 0
+        for bits in level_bits:
+            self.shifts.append(shift)
+            shift += bits
+        self.span = 1 << shift # Ticks covered by all levels together
+        self.sizes = [1 << bits for bits in level_bits]
+        self.levels = [[set() for _ in range(size)] for size in self.sizes]
+        self.count = 0
+
+    def ticks(self, now):
+        return int((now - self.origin) / self.tick)
+
+    def schedule(self, at, callback):
+        '''
+        Call callback() once the wheel is advanced past the time at (time.monotonic() based).
+        '''
+        deadline = max(self.current + 1, math.ceil((at - self.origin) / self.tick))
+        timer = Timer(deadline, callback)
+        self._insert(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None and timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def _insert(self, timer):
+        delta = timer.deadline - self.current
+        for level, (shift, size) in enumerate(zip(self.shifts, self.sizes)):
+            if delta < (size << shift) or level == len(self.sizes) - 1:
+                if delta >= self.span:
+                    # Further away than the wheel reaches, park it in the top level's last slot
+                    # to visit, it is placed again from there
+                    index = ((self.current >> shift) - 1) % size
+                else:
+                    index = (timer.deadline >> shift) % size
+                timer.slot = self.levels[level][index]
+                timer.slot.add(timer)
+                return
+
+    def advance(self, now):
+        '''
+        Process every tick up to now, calling the callbacks of the timers that are due.
+        '''
+        target = self.ticks(now)
+        while self.current < target:
+            self.current += 1
+
+            # When a level wraps around, move the timers of the next level's current slot down
+            for level in range(len(self.sizes) - 1, 0, -1):
+                if self.current & ((1 << self.shifts[level]) - 1) == 0:
+                    self._cascade(level, (self.current >> self.shifts[level]) % self.sizes[level])
+
+            slot = self.levels[0][self.current % self.sizes[0]]
+            if slot:
+                due = list(slot)
+                slot.clear()
+                for timer in due:
+                    timer.slot = None
+                    self.count -= 1
+                    timer.callback()
+
+    def _cascade(self, level, index):
+        slot = self.levels[level][index]
+        if slot:
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer)
+
+
+class _Vessel:
+    '''
+    Handover and countdown state of one vessel.
+    '''
+    __slots__ = ("vessel_id", "state", "from_roc", "to_roc", "safety_gate", "reason",
+                 "gate_at", "countdown_timer", "timeout_timer")
+
+    def __init__(self, vessel_id):
+        self.vessel_id = vessel_id
+        self.state = IDLE
+        self.from_roc = None
+        self.to_roc = None
+        self.safety_gate = None
+        self.reason = None
+        self.gate_at = None # time.monotonic() at which the safety gate is reached
+        self.countdown_timer = None
+        self.timeout_timer = None
+
+    def status(self):
+        return HandoverStatus(self.vessel_id, self.state, self.from_roc, self.to_roc, self.safety_gate, self.reason)
+
+
+class HandoverEngine:
+    def __init__(self, roc_id, tick=TIMER_TICK, confirmation_timeout=CONFIRMATION_TIMEOUT):
+        self.roc_id = roc_id
+        self.confirmation_timeout = confirmation_timeout
+        self.lock = threading.RLock()
+        self.wheel = TimerWheel(tick)
+        self.vessels = {}
+
+        # Called as listener("handover", vessel_id, HandoverStatus) on state changes, and as
+        # listener("countdown", vessel_id, whole seconds left) every second of a countdown.
+        # Called in order after the engine's lock is released, from one of the threads that
+        # caused events at a time, so a slow listener never holds up the engine.
+        self.listeners = []
+        self._events = [] # (kind, vessel_id, value) not yet passed to the listeners
+        self._delivering = threading.Lock()
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        '''
+        Advance the timers from a background thread (the only one, whatever the number of vessels).
+        '''
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.wheel.tick):
+            self.advance()
+
+    def advance(self, now=None):
+        with self._locked():
+            self.wheel.advance(time.monotonic() if now is None else now)
+
+    def status(self, vessel_id):
+        with self.lock:
+            vessel = self.vessels.get(vessel_id)
+            return vessel.status() if vessel else None
+
+    def seconds_to_gate(self, vessel_id, now=None):
+        '''
+        Locally interpolated time left until the vessel's safety gate, or None if unknown.
+        '''
+        with self.lock:
+            vessel = self.vessels.get(vessel_id)
+            if vessel is None or vessel.gate_at is None:
+                return None
+            return max(0.0, vessel.gate_at - (time.monotonic() if now is None else now))
+
+    def _vessel(self, vessel_id):
+        vessel = self.vessels.get(vessel_id)
+        if vessel is None:
+            vessel = self.vessels[vessel_id] = _Vessel(vessel_id)
+        return vessel
+
+    def _parse(self, vessel_id, text):
+        try:
+            return parse_handover_message(text, vessel_id)
+        except ValueError as e:
+            print(f"Ignoring malformed handover message from {vessel_id}: {e}")
+            return None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        '''
+        Hold the lock, then pass the events that came up meanwhile to the listeners.
+        '''
+        with self.lock:
+            yield
+        self._deliver()
+
+    def _notify(self, kind, vessel_id, value):
+        self._events.append((kind, vessel_id, value))
+
+    def _deliver(self):
+        '''
+        Call the listeners with the queued events, unless another thread is already doing so (it
+        then also delivers ours).
+        '''
+        while self._delivering.acquire(blocking=False):
+            try:
+                with self.lock:
+                    events, self._events = self._events, []
+                for kind, vessel_id, value in events:
+                    for listener in self.listeners:
+                        listener(kind, vessel_id, value)
+            finally:
+                self._delivering.release()
+            # Events queued after taking the batch, while their thread couldn't deliver them
+            with self.lock:
+                if not self._events:
+                    return
+
+    def _set_state(self, vessel, state, reason=None):
+        vessel.state = state
+        vessel.reason = reason
+        self.wheel.cancel(vessel.timeout_timer)
+        vessel.timeout_timer = None
+        self._notify("handover", vessel.vessel_id, vessel.status())
+
+
+    # -------------------------------------------------------------------
+    # INPUTS (callable from any thread)
+    # -------------------------------------------------------------------
+
+    def on_request(self, vessel_id, text):
+        '''
+        Handle a handover request from the ship.
+        '''
+        message = self._parse(vessel_id, text)
+        if message is None:
+            return
+        with self._locked():
+            vessel = self._vessel(vessel_id)
+            vessel.from_roc = message.from_roc
+            vessel.to_roc = message.to_roc
+            vessel.safety_gate = message.safety_gate
+            self._set_state(vessel, REQUESTED)
+
+    def on_state(self, vessel_id, text):
+        '''
+        Handle the ship's confirmation that the handover is done.
+        '''
+        message = self._parse(vessel_id, text)
+        if message is None:
+            return
+        with self._locked():
+            vessel = self._vessel(vessel_id)
+            vessel.from_roc = message.from_roc or vessel.from_roc
+            vessel.to_roc = message.to_roc or vessel.to_roc
+            self._set_state(vessel, COMPLETED)
+
+    def on_command(self, vessel_id, command):
+        '''
+        Note that this ROC sent a relinquish or takeover command, starting the confirmation timeout.
+        '''
+        with self._locked():
+            vessel = self._vessel(vessel_id)
+            if vessel.state != REQUESTED:
+                return
+            self._set_state(vessel, AWAITING_CONFIRMATION, f"{command} sent")
+            vessel.timeout_timer = self.wheel.schedule(
+                time.monotonic() + self.confirmation_timeout,
+                lambda: self._timed_out(vessel, f"no confirmation within {self.confirmation_timeout:g} s"))
+
+    def on_remote_time(self, vessel_id, seconds, now=None):
+        '''
+        Correct the vessel's safety-gate countdown with the time left reported by the ship.
+        '''
+        now = time.monotonic() if now is None else now
+        with self._locked():
+            vessel = self._vessel(vessel_id)
+            vessel.gate_at = now + max(0.0, seconds)
+            self.wheel.cancel(vessel.countdown_timer)
+            self._countdown_tick(vessel, now)
+
+
+    # -------------------------------------------------------------------
+    # TIMERS (called from advance(), with the lock held)
+    # -------------------------------------------------------------------
+
+    def _countdown_tick(self, vessel, now=None):
+        now = time.monotonic() if now is None else now
+        left = max(0.0, vessel.gate_at - now)
+        whole = math.ceil(left - 1e-6)
+        self._notify("countdown", vessel.vessel_id, whole)
+
+        if whole <= 0:
+            vessel.countdown_timer = None
+            if vessel.state in (REQUESTED, AWAITING_CONFIRMATION):
+                self._timed_out(vessel, "safety gate reached")
+            return
+
+        # Next whole second of the countdown
+        next_at = vessel.gate_at - (whole - 1)
+        vessel.countdown_timer = self.wheel.schedule(next_at, lambda: self._countdown_tick(vessel))
+
+    def _timed_out(self, vessel, reason):
+        if vessel.state in (REQUESTED, AWAITING_CONFIRMATION):
+            self._set_state(vessel, TIMED_OUT, reason)
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
@@ -0,0 +1,384 @@
+'''
+This module contains the headless ROC runtime, running the ROCController and ShipTelemetryMonitor
+without any GUI (and without importing Tk), e.g. on a server or in a container.
+
+Telemetry is emitted as a stream of JSON lines, at most frame_rate updates per field and vessel per
+second (older values are coalesced just like in the GUI), for example:
+
+    {"type": "state", "vessel": "MASS_0", "field": "cog", "value": 123.4, "received": 1718000000.123}
+    {"type": "command", "command": "cog", "value": 90.0, "seq": 7}
+    {"type": "effect", "command": "COG", "seq": 7, "value": 90.0, "response_s": 3.1, "converged_s": 41.0}
+    {"type": "startup", "milestone": "first telemetry processed", "elapsed_s": 0.412}
+    {"type": "handover", "vessel": "MASS_0", "state": "requested", "from": "ROC_1", "to": "ROC_2",
+     "safety_gate": "safety-gate-1", "reason": null, "seconds_to_gate": 812.4}
+    {"type": "collision_alerts", "alerts": [{"vessels": ["MASS_0", "MASS_7"], "cpa_nm": 0.21,
+     "tcpa_s": 312.0, "distance_nm": 1.9}]}
+
+Commands are read one per line from stdin (and from socket clients), either as text or JSON:
+
+    cog 90                      {"command": "cog", "value": 90}
+    sog 5.5                     {"command": "sog", "value": 5.5}
+    halt                        {"command": "halt"}
+    takeover                    {"command": "takeover"}
+    relinquish                  {"command": "relinquish"}
+    quit                        {"command": "quit"}
+'''
+
+import json
+import queue
+import signal
+import socket
+import sys
+import threading
+
+from google.protobuf.json_format import MessageToDict
+
+from gui_pump import LatestValueSlots, DEFAULT_FRAME_RATE
+from ship_monitor import TOPICS
+
+# Lines queued per output stream, at most. A state socket client falling further behind is
+# disconnected, while writing to stdout waits for room.
+OUTPUT_QUEUE_LINES = 10000
+
+
+def to_json_value(value):
+    '''
+    Convert a VesselState field value to something json can serialize.
+    '''
+    if hasattr(value, "DESCRIPTOR"):
+        return MessageToDict(value)
+    return value
+
+
+class _StreamWriter:
+    '''
+    Writes the lines queued for one stream from its own thread, so a slow reader only holds up
+    its own stream.
+    '''
+    def __init__(self, stream, disconnect, on_closed):
+        self.stream = stream
+        self.disconnect = disconnect
+        self.on_closed = on_closed
+        self.lines = queue.Queue(OUTPUT_QUEUE_LINES)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, line):
+        if not self.disconnect:
+            self.lines.put(line)
+            return
+        try:
+            self.lines.put_nowait(line)
+        except queue.Full:
+            self.close()
+
+    def run(self):
+        while not self.closed:
+            line = self.lines.get()
+            if line is None:
+                return
+            try:
+                self.stream.write(line)
+                self.stream.flush()
+            except (OSError, ValueError):
+                self.close()
+
+    def close(self):
+        '''
+        Stop writing to the stream and drop it. A client is also disconnected, which fails a write
+        stuck on it.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.on_closed(self)
+        if self.disconnect:
+            try:
+                self.disconnect()
+            except OSError:
+                pass
+
+    def finish(self, timeout):
+        '''
+        Wait up to timeout seconds for the queued lines to be written.
+        '''
+        try:
+            self.lines.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+
+class JsonLinesOutput:
+    '''
+    Writes JSON lines to a set of text streams, each from its own thread through a queue of at
+    most OUTPUT_QUEUE_LINES lines, so a slow client never blocks the threads producing the lines.
+    Streams that fail (e.g. disconnected clients) are dropped, and so are clients falling behind.
+    '''
+    def __init__(self, streams=()):
+        self.lock = threading.Lock()
+        self.writers = []
+        for stream in streams:
+            self.add(stream)
+
+    def add(self, stream, disconnect=None):
+        '''
+        Add a stream. If it falls behind, disconnect() is called and it is dropped, or without
+        disconnect (e.g. for stdout) writing waits for it.
+        '''
+        writer = _StreamWriter(stream, disconnect, self._remove)
+        with self.lock:
+            self.writers.append(writer)
+
+    def _remove(self, writer):
+        with self.lock:
+            if writer in self.writers:
+                self.writers.remove(writer)
+
+    def write(self, obj):
+        line = json.dumps(obj) + "\n"
+        with self.lock:
+            writers = list(self.writers)
+        for writer in writers:
+            writer.put(line)
+
+    def close(self, timeout=1.0):
+        '''
+        Write what is still queued (waiting up to timeout seconds per stream), then stop.
+        '''
+        with self.lock:
+            writers = list(self.writers)
+        for writer in writers:
+            writer.finish(timeout)
+
+
+class HeadlessRoc:
+    def __init__(self, roc_controller, output, fleet=False, frame_rate=DEFAULT_FRAME_RATE, state_socket=None,
+                 handover=None, screening=None):
+        '''
+        Emit telemetry and command results as JSON lines to the output stream, or to clients of a
+        TCP server at state_socket = (host, port) instead if given. Handover state changes of the
+        HandoverEngine handover are emitted as they happen, and the alerts of the CollisionScreening
+        screening after every screening that has any.
+        '''
+        self.roc_controller = roc_controller
+        self.ship_id = roc_controller.ship_id
+        self.fleet = fleet
+        self.frame_interval = 1.0 / frame_rate
+
+        # Telemetry callbacks write (vessel, field) slots, the flush thread emits them
+        self.slots = LatestValueSlots()
+        self.stopped = threading.Event()
+        self.roc_controller.effect_listeners.append(self.on_effect)
+        self.handover = handover
+        if handover:
+            handover.listeners.append(self.on_handover_event)
+        self.screening = screening
+        if screening:
+            screening.listeners.append(self.on_collision_alerts)
+
+        # Set to the monitor so it can be closed on exit
+        self.monitor = None
+
+        self.output = JsonLinesOutput()
+        self.server = None
+        if state_socket:
+            self.server = socket.create_server(state_socket)
+            threading.Thread(target=self.accept_clients, daemon=True).start()
+            print(f"{self.__class__.__name__} streaming state on {state_socket[0]}:{self.server.getsockname()[1]}")
+        else:
+            self.output.add(output)
+
+        print(f"{self.__class__.__name__} initialized.")
+
+    def callbacks(self):
+        '''
+        Monitor callbacks for every topic, writing into the slots. COG and SOG of the controlled
+        ship are also passed to the controller, for its command effect tracking, and the handover
+        topics of every vessel to the handover engine.
+        '''
+        observers = {"cog": self.roc_controller.observe_cog, "sog": self.roc_controller.observe_sog}
+        handover_inputs = {}
+        if self.handover:
+            handover_inputs = {
+                "remote_time": self.handover.on_remote_time,
+                "handover_request": self.handover.on_request,
+                "handover_state": self.handover.on_state,
+            }
+
+        def updater(field):
+            observe = observers.get(field)
+            handover_input = handover_inputs.get(field)
+            def update(vessel_id, *args):
+                self.slots.put((vessel_id, field), *args)
+                if observe and vessel_id == self.ship_id:
+                    observe(*args)
+                if handover_input:
+                    handover_input(vessel_id, *args)
+            if self.fleet:
+                return update
+            return lambda *args: update(self.ship_id, *args)
+        return {callback_name: updater(field) for _, _, _, field, callback_name in TOPICS}
+
+    def on_startup(self, milestone, elapsed):
+        self.output.write({"type": "startup", "milestone": milestone, "elapsed_s": round(elapsed, 6)})
+
+    def on_effect(self, effect):
+        self.output.write({
+            "type": "effect",
+            "command": effect.command.name,
+            "seq": effect.command.seq,
+            "value": effect.command.value,
+            "response_s": effect.response_s,
+            "converged_s": effect.converged_s,
+        })
+
+    def on_handover_event(self, kind, vessel_id, value):
+        # Countdown seconds are left out, they would be a line per vessel per second
+        if kind != "handover":
+            return
+        seconds_to_gate = self.handover.seconds_to_gate(vessel_id)
+        self.output.write({
+            "type": "handover",
+            "vessel": vessel_id,
+            "state": value.state,
+            "from": value.from_roc,
+            "to": value.to_roc,
+            "safety_gate": value.safety_gate,
+            "reason": value.reason,
+            "seconds_to_gate": None if seconds_to_gate is None else round(seconds_to_gate, 1),
+        })
+
+    def on_collision_alerts(self, alerts):
+        self.output.write({
+            "type": "collision_alerts",
+            "alerts": [{
+                "vessels": [alert.vessel_a, alert.vessel_b],
+                "cpa_nm": round(alert.cpa_nm, 3),
+                "tcpa_s": round(alert.tcpa_s, 1),
+                "distance_nm": round(alert.distance_nm, 3),
+            } for alert in alerts],
+        })
+
+
+    # -------------------------------------------------------
+    # Main loop
+    # -------------------------------------------------------
+    def run(self):
+        '''
+        Run until quit is commanded, or on SIGINT/SIGTERM. Blocks, so call this last.
+        '''
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopped.set())
+        threading.Thread(target=self.read_commands, args=(sys.stdin,), daemon=True).start()
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+        try:
+            # Waiting with a timeout keeps the main thread responsive to Ctrl-C
+            while not self.stopped.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.close()
+
+    def close(self):
+        if self.monitor:
+            self.monitor.close()
+        if self.handover:
+            self.handover.stop()
+        if self.screening:
+            self.screening.stop()
+        self.roc_controller.close()
+        self.flush()
+        self.output.close()
+        if self.server:
+            self.server.close()
+
+    def flush_loop(self):
+        while not self.stopped.wait(self.frame_interval):
+            self.flush()
+
+    def flush(self):
+        for (vessel_id, field), (received_ns, args) in self.slots.drain().items():
+            value = list(args) if len(args) > 1 else to_json_value(args[0])
+            self.output.write({
+                "type": "state",
+                "vessel": vessel_id,
+                "field": field,
+                "value": value,
+                "received": received_ns / 1e9,
+            })
+            if self.monitor:
+                self.monitor.record_render(vessel_id, field, received_ns)
+
+
+    # -------------------------------------------------------
+    # Commands
+    # -------------------------------------------------------
+    def read_commands(self, stream):
+        '''
+        Handle command lines from a stream until it ends. The end of stdin does not stop the
+        runtime, so it can run detached with stdin closed.
+        '''
+        for line in stream:
+            line = line.strip()
+            if line:
+                self.handle_command(line)
+
+    def handle_command(self, line):
+        try:
+            if line.startswith("{"):
+                request = json.loads(line)
+                name, value = request["command"], request.get("value")
+            else:
+                name, _, value = line.partition(" ")
+                value = value.strip() or None
+
+            if name == "cog":
+                command = self.roc_controller.send_cog(float(value))
+            elif name == "sog":
+                command = self.roc_controller.send_sog(float(value))
+            elif name == "halt":
+                command = self.roc_controller.send_sog(0.0)
+            elif name == "takeover":
+                command = self.roc_controller.send_takeover()
+            elif name == "relinquish":
+                command = self.roc_controller.send_relinquish()
+            elif name == "quit":
+                self.stopped.set()
+                return
+            else:
+                raise ValueError(f"unknown command {name!r}")
+        except (ValueError, TypeError, KeyError) as e:
+            self.output.write({"type": "error", "command": line, "error": str(e)})
+            return
+
+        self.output.write({"type": "command", "command": name, "value": command.value, "seq": command.seq})
+        if self.handover and name in ("takeover", "relinquish"):
+            self.handover.on_command(self.ship_id, name)
+
+    def accept_clients(self):
+        '''
+        Stream state to every client connecting to the state socket, and take commands from them.
+        '''
+        while not self.stopped.is_set():
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            self.output.add(connection.makefile("w", encoding="utf-8"),
+                            disconnect=lambda connection=connection: connection.shutdown(socket.SHUT_RDWR))
+            commands = connection.makefile("r", encoding="utf-8")
+            threading.Thread(target=self.read_commands, args=(commands,), daemon=True).start()
+
+
+def parse_address(text):
+    '''
+    Parse "host:port" (or just "port", for localhost) into a (host, port) tuple.
+    '''
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
@@ -0,0 +1,267 @@
+'''
+This module contains the telemetry history of the ROC: per vessel and signal ring buffers of
+receive times (int64 ns) and values (float64), within a fixed memory budget.
+
+The budget is shared evenly between the series seen so far, so it is fully used however many
+vessels there are. Buffers start small and grow by doubling up to their share, and are shrunk
+(dropping their oldest samples) when new series lower it. Once a buffer is full, it overwrites its
+oldest samples. When shares would get below MIN_CAPACITY samples, the series updated least
+recently is evicted instead, except for those of reserved vessels (the controlled ship).
+Range queries can downsample to a target number of points, returning per time bucket the min,
+max and mean, so a plot of hours of data still shows every peak.
+
+Memory: a single valued sample takes 16 bytes, a position 24 bytes. With the default budget of
+64 MiB and 40 vessels with position, COG and SOG (120 series), a series keeps ~35000 values
+(58 minutes at 10 Hz) or ~23000 positions (39 minutes at 10 Hz). Up to ~2700 series fit.
+'''
+
+import sys
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+# Default memory budget of the whole store (bytes)
+DEFAULT_HISTORY_BUDGET = 64 * 1024 * 1024
+
+# Initial capacity of a buffer, doubled whenever it fills up until it reaches its share of the budget
+INITIAL_CAPACITY = 1024
+
+# Fewest samples a series is shrunk to, further series evict the one updated least recently
+MIN_CAPACITY = 1024
+
+# VesselState fields kept in the history, and their number of values per sample
+HISTORY_FIELDS = {
+    "location": 2, # latitude, longitude
+    "cog": 1,
+    "sog": 1,
+}
+
+# Query results. Raw: times and values (one row per sample, one column per value).
+# Downsampled: per non-empty bucket the mean time, number of samples and min/max/mean per column.
+HistoryRange = namedtuple("HistoryRange", ["times", "values"])
+HistoryBuckets = namedtuple("HistoryBuckets", ["times", "counts", "min", "max", "mean"])
+
+
+class RingBuffer:
+    '''
+    Samples of one series, in arrival order. Not thread safe on its own.
+    '''
+    def __init__(self, columns, capacity):
+        self.columns = columns
+        self.capacity = capacity
+        size = min(INITIAL_CAPACITY, capacity)
+        self.times = np.empty(size, dtype=np.int64)
+        self.values = np.empty((size, columns), dtype=np.float64)
+        self.start = 0 # Index of the oldest sample
+        self.length = 0
+        self.last_ns = None # Time of the newest sample
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.values.nbytes
+
+    def append(self, time_ns, values):
+        size = len(self.times)
+        if self.length == size and size < self.capacity:
+            self._grow(min(size * 2, self.capacity))
+            size = len(self.times)
+
+        index = (self.start + self.length) % size
+        self.times[index] = time_ns
+        self.values[index] = values
+        if self.length < size:
+            self.length += 1
+        else:
+            self.start = (self.start + 1) % size
+        self.last_ns = time_ns
+
+    def _grow(self, size):
+        times, values = self.ordered()
+        self.times = np.empty(size, dtype=np.int64)
+        self.values = np.empty((size, self.columns), dtype=np.float64)
+        self.times[:self.length] = times
+        self.values[:self.length] = values
+        self.start = 0
+
+    def set_capacity(self, capacity):
+        '''
+        Change the capacity, dropping the oldest samples if they no longer fit.
+        '''
+        self.capacity = capacity
+        if len(self.times) <= capacity:
+            return
+        times, values = self.ordered()
+        self.length = min(self.length, capacity)
+        self.times = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty((capacity, self.columns), dtype=np.float64)
+        self.times[:self.length] = times[len(times) - self.length:]
+        self.values[:self.length] = values[len(values) - self.length:]
+        self.start = 0
+
+    def _parts(self):
+        '''
+        The (up to two) contiguous slices holding the samples, oldest first.
+        '''
+        end = self.start + self.length
+        size = len(self.times)
+        if end <= size:
+            return [slice(self.start, end)]
+        return [slice(self.start, size), slice(0, end - size)]
+
+    def ordered(self):
+        parts = self._parts()
+        if len(parts) == 1:
+            return self.times[parts[0]], self.values[parts[0]]
+        return (np.concatenate([self.times[part] for part in parts]),
+                np.concatenate([self.values[part] for part in parts]))
+
+    def range(self, start_ns=None, end_ns=None):
+        '''
+        Copy of the samples with start_ns <= time < end_ns, oldest first.
+        '''
+        times = []
+        values = []
+        for part in self._parts():
+            part_times = self.times[part]
+            first = 0 if start_ns is None else np.searchsorted(part_times, start_ns, side="left")
+            last = len(part_times) if end_ns is None else np.searchsorted(part_times, end_ns, side="left")
+            if first < last:
+                times.append(part_times[first:last])
+                values.append(self.values[part][first:last])
+        if not times:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.columns), dtype=np.float64)
+        return np.concatenate(times), np.concatenate(values)
+
+
+def downsample(times, values, points, start_ns, end_ns):
+    '''
+    Reduce samples to at most points equally long time buckets between start_ns and end_ns, with
+    min/max/mean per bucket. Empty buckets are left out.
+    '''
+    span = max(1, end_ns - start_ns)
+    buckets = (times - start_ns) * points // span
+    np.clip(buckets, 0, points - 1, out=buckets)
+
+    # Samples are in time order, so every bucket is one contiguous run
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    counts = np.diff(np.append(starts, len(times)))
+    sums = np.add.reduceat(values, starts, axis=0)
+    return HistoryBuckets(
+        times=np.add.reduceat(times - start_ns, starts) // counts + start_ns,
+        counts=counts,
+        min=np.minimum.reduceat(values, starts, axis=0),
+        max=np.maximum.reduceat(values, starts, axis=0),
+        mean=sums / counts[:, None],
+    )
+
+
+class HistoryStore:
+    def __init__(self, budget_bytes=DEFAULT_HISTORY_BUDGET, reserved_vessels=()):
+        '''
+        Keep history within budget_bytes, shared evenly between the series seen. The series of
+        reserved_vessels are never evicted.
+        '''
+        self.budget_bytes = budget_bytes
+        self.reserved_vessels = frozenset(reserved_vessels)
+        self.lock = threading.Lock()
+
+        # (vessel id, field) -> (lock, RingBuffer)
+        self.buffers = {}
+        self.series_budget = budget_bytes # Share of the budget of each series (bytes)
+        self.evicted = 0 # Series evicted to make room for newer ones
+        self.dropped = 0 # Samples of series that didn't fit in the budget
+
+    def record(self, vessel_id, field, time_ns, value):
+        '''
+        Add a sample. Fields not in HISTORY_FIELDS are ignored, so every field can be passed in.
+        Called from zenoh threads.
+        '''
+        entry = self.buffers.get((vessel_id, field))
+        if entry is None:
+            if field not in HISTORY_FIELDS:
+                return
+            entry = self._create(vessel_id, field)
+            if entry is None:
+                self.dropped += 1
+                return
+        lock, buffer = entry
+        with lock:
+            buffer.append(time_ns, value)
+
+    def _create(self, vessel_id, field):
+        with self.lock:
+            entry = self.buffers.get((vessel_id, field))
+            if entry is not None:
+                return entry
+
+            max_sample_bytes = 8 + 8 * max(HISTORY_FIELDS.values())
+            if self.budget_bytes // (len(self.buffers) + 1) < MIN_CAPACITY * max_sample_bytes:
+                if not self._evict(vessel_id):
+                    return None
+
+            columns = HISTORY_FIELDS[field]
+            entry = (threading.Lock(), RingBuffer(columns, MIN_CAPACITY))
+            self.buffers[(vessel_id, field)] = entry
+            self._reshare()
+            return entry
+
+    def _evict(self, vessel_id):
+        '''
+        Remove the series updated least recently, other than those of reserved vessels (unless
+        vessel_id is reserved too). Returns False if there is none. Called with the store lock held.
+        '''
+        candidates = [
+            (buffer.last_ns or 0, key) for key, (_, buffer) in self.buffers.items()
+            if key[0] not in self.reserved_vessels or vessel_id in self.reserved_vessels
+        ]
+        if not candidates:
+            return False
+        _, key = min(candidates)
+        del self.buffers[key]
+        self.evicted += 1
+        return True
+
+    def _reshare(self):
+        '''
+        Give every series an equal share of the budget. Called with the store lock held.
+        '''
+        self.series_budget = self.budget_bytes // len(self.buffers)
+        for lock, buffer in self.buffers.values():
+            capacity = self.series_budget // (8 + 8 * buffer.columns)
+            if capacity != buffer.capacity:
+                with lock:
+                    buffer.set_capacity(capacity)
+
+    def series(self):
+        return sorted(self.buffers)
+
+    def query(self, vessel_id, field, start_ns=None, end_ns=None, points=None):
+        '''
+        Samples of a series with start_ns <= time < end_ns (None for unbounded). Returns a
+        HistoryRange, or HistoryBuckets if points is given and there are more samples than that.
+        Returns None for an unknown series.
+        '''
+        entry = self.buffers.get((vessel_id, field))
+        if entry is None:
+            return None
+        lock, buffer = entry
+        with lock:
+            times, values = buffer.range(start_ns, end_ns)
+
+        if points is None or len(times) <= points:
+            return HistoryRange(times, values)
+        first = times[0] if start_ns is None else start_ns
+        last = times[-1] + 1 if end_ns is None else end_ns
+        return downsample(times, values, points, first, last)
+
+    def memory_used(self):
+        '''
+        Bytes currently allocated by all buffers (at most budget_bytes).
+        '''
+        return sum(buffer.nbytes for _, buffer in self.buffers.values())
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
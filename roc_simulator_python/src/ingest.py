@@ -0,0 +1,269 @@
+'''
+This module contains the two sides of a ROC split into processes:
+
+- IngestServer runs in the ingest process with the monitor, controller, history and handover engine.
+  It writes the latest state of every vessel into a shared memory block (see shared_state.py) and
+  takes commands from viewers over a local socket.
+- IngestClient is what a viewer process (e.g. the GUI) uses instead of a ROCController: it sends the
+  commands to the ingest process, and reads the block on the viewer's own refresh tick.
+
+Decode bursts in the ingest process then never hold the GIL of a viewer, and any number of viewers
+can watch one ingest process. The socket carries small pickled tuples: the server first sends
+("hello", info dict), then the client sends (command, value) tuples, e.g. ("cog", 90.0).
+'''
+
+import json
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Client, Listener
+
+from keelson.payloads.ROCStatus_pb2 import ROCStatus
+
+from handover import HandoverStatus
+from roc_controller import SETPOINT_HISTORY_LENGTH
+from shared_state import DEFAULT_STATE_VESSELS, SharedStateReader, SharedStateWriter
+from ship_monitor import TOPICS
+
+# Authentication key of the command socket. The socket is a file only this user can open, so the
+# key only guards against connecting to something else by mistake.
+INGEST_AUTHKEY = b"roc-simulator-ingest"
+
+# How long a viewer waits for the ingest process to start listening (time in seconds)
+CONNECT_TIMEOUT = 30.0
+
+# Commands viewers may send
+INGEST_COMMANDS = ("cog", "sog", "takeover", "relinquish")
+
+
+def to_state_value(field, value):
+    '''
+    Convert a VesselState field value to what the shared state block stores.
+    '''
+    if field == "roc_status":
+        return value.SerializeToString()
+    return value
+
+
+class IngestServer:
+    def __init__(self, roc_controller, address, fleet=False, handover=None, max_vessels=DEFAULT_STATE_VESSELS):
+        '''
+        Serve the state to viewers connecting to the unix socket at address.
+        '''
+        self.roc_controller = roc_controller
+        self.ship_id = roc_controller.ship_id
+        self.fleet = fleet
+        self.handover = handover
+        self.stopped = threading.Event()
+
+        # Set to the monitor so it can be closed on exit
+        self.monitor = None
+
+        self.state = SharedStateWriter(max_vessels)
+        if handover:
+            handover.listeners.append(self.on_handover_event)
+
+        self.listener = Listener(address, family="AF_UNIX", authkey=INGEST_AUTHKEY)
+        self.viewers = 0
+        threading.Thread(target=self.accept_viewers, daemon=True).start()
+
+        print(f"{self.__class__.__name__} serving state block {self.state.name} to viewers on {address}")
+
+    def callbacks(self):
+        '''
+        Monitor callbacks for every topic, writing into the state block. COG and SOG of the
+        controlled ship are also passed to the controller, and the handover topics to the engine.
+        '''
+        observers = {"cog": self.roc_controller.observe_cog, "sog": self.roc_controller.observe_sog}
+        handover_inputs = {}
+        if self.handover:
+            handover_inputs = {
+                "remote_time": self.handover.on_remote_time,
+                "handover_request": self.handover.on_request,
+                "handover_state": self.handover.on_state,
+            }
+
+        def updater(field):
+            observe = observers.get(field)
+            handover_input = handover_inputs.get(field)
+            def update(vessel_id, *args):
+                self.state.write(vessel_id, field, to_state_value(field, args if len(args) > 1 else args[0]))
+                if observe and vessel_id == self.ship_id:
+                    observe(*args)
+                if handover_input:
+                    handover_input(vessel_id, *args)
+            if self.fleet:
+                return update
+            return lambda *args: update(self.ship_id, *args)
+        return {callback_name: updater(field) for _, _, _, field, callback_name in TOPICS}
+
+    def on_handover_event(self, kind, vessel_id, value):
+        if kind == "handover":
+            self.state.write(vessel_id, "handover", json.dumps(value._asdict()))
+        else:
+            self.state.write(vessel_id, "countdown", float(value))
+
+
+    # -------------------------------------------------------
+    # Main loop
+    # -------------------------------------------------------
+    def run(self):
+        '''
+        Run until SIGINT/SIGTERM. Blocks, so call this last.
+        '''
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopped.set())
+        try:
+            # Waiting with a timeout keeps the main thread responsive to Ctrl-C
+            while not self.stopped.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.close()
+
+    def close(self):
+        self.stopped.set()
+        self.listener.close()
+        if self.monitor:
+            self.monitor.close()
+        if self.handover:
+            self.handover.stop()
+        self.roc_controller.close()
+        if self.state.dropped:
+            print(f"{self.__class__.__name__}: {self.state.dropped} values didn't fit in the state block")
+        self.state.close()
+
+
+    # -------------------------------------------------------
+    # Viewers
+    # -------------------------------------------------------
+    def accept_viewers(self):
+        while not self.stopped.is_set():
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError):
+                if self.stopped.is_set():
+                    return
+                continue
+            self.viewers += 1
+            threading.Thread(target=self.serve_viewer, args=(connection,), daemon=True).start()
+
+    def serve_viewer(self, connection):
+        '''
+        Say hello to a viewer, then run the commands it sends until it disconnects.
+        '''
+        with connection:
+            try:
+                connection.send(("hello", {
+                    "state_block": self.state.name,
+                    "roc_id": self.roc_controller.roc_id,
+                    "ship_id": self.ship_id,
+                    "fleet": self.fleet,
+                }))
+                while True:
+                    name, value = connection.recv()
+                    self.handle_command(name, value)
+            except (EOFError, OSError):
+                pass
+        self.viewers -= 1
+
+    def handle_command(self, name, value):
+        if name not in INGEST_COMMANDS:
+            print(f"[WARN] Ignoring unknown command {name!r} from a viewer")
+            return
+        try:
+            if name in ("cog", "sog"):
+                value = float(value)
+        except (TypeError, ValueError):
+            print(f"[WARN] Ignoring {name} command with invalid value {value!r} from a viewer")
+            return
+
+        if name == "cog":
+            self.roc_controller.send_cog(value)
+        elif name == "sog":
+            self.roc_controller.send_sog(value)
+        elif name == "takeover":
+            self.roc_controller.send_takeover()
+        elif name == "relinquish":
+            self.roc_controller.send_relinquish()
+        if self.handover and name in ("takeover", "relinquish"):
+            self.handover.on_command(self.ship_id, name)
+
+
+class IngestClient:
+    '''
+    Stands in for a ROCController in a viewer process, see the module docstring.
+    '''
+    def __init__(self, address, timeout=CONNECT_TIMEOUT, shared_tracker=False):
+        '''
+        Connect to the ingest process serving on address. shared_tracker: see SharedStateReader.
+        '''
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.connection = Client(address, family="AF_UNIX", authkey=INGEST_AUTHKEY)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+        kind, info = self.connection.recv()
+        if kind != "hello":
+            raise ValueError(f"Unexpected greeting {kind!r} from the ingest process")
+        self.roc_id = info["roc_id"]
+        self.ship_id = info["ship_id"]
+        self.state = SharedStateReader(info["state_block"], shared_tracker)
+        self.lock = threading.Lock()
+
+        # Setpoints sent from this viewer, like ROCController.setpoints
+        self.setpoints = {name: deque(maxlen=SETPOINT_HISTORY_LENGTH) for name in ("COG", "SOG")}
+
+        print(f"{self.__class__.__name__} viewing {self.ship_id} as {self.roc_id}")
+
+    def _send(self, name, value=None):
+        with self.lock:
+            self.connection.send((name, value))
+
+    def send_cog(self, value):
+        self._send("cog", float(value))
+        self.setpoints["COG"].append((time.time_ns(), float(value)))
+
+    def send_sog(self, value):
+        self._send("sog", float(value))
+        self.setpoints["SOG"].append((time.time_ns(), float(value)))
+
+    def send_relinquish(self):
+        self._send("relinquish")
+
+    def send_takeover(self):
+        self._send("takeover")
+
+    def poll(self, slots, fields):
+        '''
+        Put the fields of our ship that changed since the last poll into slots, in the form the
+        GUI renderers take. Call from the viewer's refresh tick.
+        '''
+        for field, value in self.state.changes(self.ship_id, fields).items():
+            if field == "location":
+                slots.put(field, *value)
+            elif field == "roc_status":
+                slots.put(field, ROCStatus.FromString(value))
+            elif field == "handover":
+                slots.put(field, HandoverStatus(**json.loads(value)))
+            elif field == "countdown":
+                slots.put(field, int(value))
+            elif isinstance(value, bytes):
+                slots.put(field, value.decode())
+            else:
+                slots.put(field, value)
+
+    def close(self):
+        self.connection.close()
+        self.state.close()
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
@@ -0,0 +1,218 @@
+'''
+This module contains the ROC's built-in performance instrumentation:
+
+- ThreadProfiler (--profile DIR) profiles the CPU time of every thread with cProfile, including
+  the zenoh callback threads, which aren't Python threads and so can't be reached through
+  threading.setprofile(): subscriber callbacks are wrapped with profiled() instead. The profiles
+  are written to DIR on exit and whenever the process receives SIGUSR1, one file per thread plus
+  their sum, to be read with e.g. "python3 -m pstats DIR/<pid>-all.prof". From Python 3.12 on,
+  cProfile profiles through sys.monitoring, which sees every thread but allows only one enabled
+  profile per process, so a single profile of the whole process is kept instead.
+- EventLoopLagProbe schedules a tick on the Tk event loop every LAG_PROBE_INTERVAL_MS and records
+  how late it fires. Work on the Tk thread is run through the probe under a name, so every late
+  tick (a lag spike) comes with the handlers and widget updates that ran while it was waiting.
+'''
+
+import atexit
+import marshal
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+from telemetry_stats import LogHistogram
+
+# Interval of the event loop lag probe's ticks (time in milliseconds)
+LAG_PROBE_INTERVAL_MS = 50
+
+# Ticks firing at least this late are kept as lag spikes (time in milliseconds)
+LAG_SPIKE_MS = 100
+
+# Number of lag spikes kept, and of the longest activities kept per spike
+LAG_SPIKE_HISTORY = 50
+LAG_SPIKE_ACTIVITIES = 3
+
+# Late tick, with [(activity, milliseconds)] of the longest activities that ran since the tick before
+LagSpike = namedtuple("LagSpike", ["time", "lag_ms", "activities"])
+
+# cProfile uses sys.monitoring: one profile covers all threads, and a second one can't be enabled
+PROCESS_WIDE_PROFILE = sys.version_info >= (3, 12)
+
+# The running ThreadProfiler, if any
+_active_profiler = None
+
+
+def profiled(callback):
+    '''
+    callback, profiled by the running ThreadProfiler in whichever thread it is called from.
+    Returns callback itself when not profiling.
+    '''
+    if _active_profiler is None:
+        return callback
+    return _active_profiler.wrap(callback)
+
+
+class ThreadProfiler:
+    def __init__(self, directory):
+        '''
+        Profile every thread of this process once started, writing the profiles to directory.
+        '''
+        # Only imported when profiling, pstats alone takes longer to import than most of the ROC
+        import cProfile
+        self.profile_class = cProfile.Profile
+
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.profiles = {} # Thread ident -> (thread name, profile, enabled for the whole thread)
+
+    def start(self):
+        global _active_profiler
+        _active_profiler = self
+
+        # Python threads started from now on get their profile on their first profiled event
+        if not PROCESS_WIDE_PROFILE:
+            threading.setprofile(self._bootstrap)
+        if not self._enable(self._thread_profile(whole_thread=True)[1]):
+            threading.setprofile(None)
+            _active_profiler = None
+            return
+
+        atexit.register(self.dump)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump())
+        print(f"{self.__class__.__name__} profiling all threads, kill -USR1 {os.getpid()} "
+              f"writes the profiles to {self.directory}")
+
+    def _thread_profile(self, whole_thread=False):
+        '''
+        The calling thread's profile. Keyed by OS thread ident, not thread local: zenoh may give the
+        same OS thread a new Python thread state for every callback.
+        '''
+        ident = 0 if PROCESS_WIDE_PROFILE else threading.get_ident()
+        entry = self.profiles.get(ident)
+        if entry is None:
+            with self.lock:
+                entry = self.profiles.setdefault(
+                    ident, ("process" if PROCESS_WIDE_PROFILE else threading.current_thread().name,
+                            self.profile_class(), whole_thread))
+        return entry
+
+    def _enable(self, profile):
+        '''
+        Enable profile, returning False instead of raising if another profiler is already active.
+        '''
+        try:
+            profile.enable()
+            return True
+        except ValueError as e:
+            print(f"[WARN] {self.__class__.__name__} can't profile {threading.current_thread().name}: {e}")
+            return False
+
+    def _bootstrap(self, frame, event, arg):
+        # Installed by threading.setprofile(), runs once per new thread: the thread's cProfile
+        # replaces it
+        sys.setprofile(None)
+        self._enable(self._thread_profile(whole_thread=True)[1])
+
+    def wrap(self, callback):
+        if PROCESS_WIDE_PROFILE:
+            # The process wide profile already sees zenoh's threads
+            return callback
+
+        def profiled_callback(*args):
+            _, profile, whole_thread = self._thread_profile()
+            if whole_thread or not self._enable(profile):
+                return callback(*args)
+            try:
+                return callback(*args)
+            finally:
+                profile.disable()
+        return profiled_callback
+
+    def dump(self):
+        '''
+        Write the profiles collected so far, one per thread and their sum. Profiling continues.
+        '''
+        import pstats
+
+        os.makedirs(self.directory, exist_ok=True)
+        pid = os.getpid()
+        with self.lock:
+            profiles = list(self.profiles.items())
+
+        paths = []
+        for ident, (name, profile, _) in profiles:
+            # snapshot_stats() rather than create_stats(), which would disable the calling
+            # thread's profile, whichever thread the profile belongs to
+            profile.snapshot_stats()
+            if not profile.stats:
+                continue
+            safe_name = re.sub(r"[^\w.-]", "_", name)
+            path = os.path.join(self.directory, f"{pid}-{safe_name}-{ident}.prof")
+            with open(path, "wb") as f:
+                marshal.dump(profile.stats, f)
+            paths.append(path)
+
+        if paths:
+            pstats.Stats(*paths).dump_stats(os.path.join(self.directory, f"{pid}-all.prof"))
+        print(f"{self.__class__.__name__} wrote {len(paths)} thread profiles to {self.directory}", file=sys.stderr)
+
+
+class EventLoopLagProbe:
+    def __init__(self, interval_ms=LAG_PROBE_INTERVAL_MS, spike_ms=LAG_SPIKE_MS):
+        self.interval_ms = interval_ms
+        self.spike_ms = spike_ms
+        self.lag = LogHistogram() # In ns
+        self.spikes = deque(maxlen=LAG_SPIKE_HISTORY)
+        self.spike_count = 0
+
+        self.after = None
+        self.expected = None # time.perf_counter() the next tick is due at
+        self.activities = {} # Activity -> seconds spent in it since the last tick
+
+    def start(self, after):
+        '''
+        Start ticking, with after(ms, callback) scheduling on the event loop (e.g. Tk's root.after).
+        '''
+        self.after = after
+        self._schedule(time.perf_counter())
+
+    def _schedule(self, now):
+        self.expected = now + self.interval_ms / 1000
+        self.after(self.interval_ms, self._tick)
+
+    def _tick(self):
+        now = time.perf_counter()
+        lag = max(0.0, now - self.expected)
+        self.lag.record(lag * 1e9)
+        if lag * 1000 >= self.spike_ms:
+            longest = sorted(self.activities.items(), key=lambda item: item[1], reverse=True)
+            self.spikes.append(LagSpike(time.time(), lag * 1000,
+                                        [(name, seconds * 1000) for name, seconds in longest[:LAG_SPIKE_ACTIVITIES]]))
+            self.spike_count += 1
+        self.activities = {}
+        self._schedule(now)
+
+    def run(self, activity, function, *args):
+        '''
+        Call function(*args) on the event loop thread, accounting its time to activity.
+        '''
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.activities[activity] = self.activities.get(activity, 0.0) + time.perf_counter() - start
+
+    def tracked(self, activity, function):
+        '''
+        function, run through run() under activity whenever called, e.g. as a button command.
+        '''
+        return lambda *args: self.run(activity, function, *args)
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
@@ -1,49 +1,277 @@
 '''
 This module contains the interface for sending control messages to a ship.
+
+Commands are queued and sent from a background thread, so the GUI never waits on the transport.
+Per setpoint only the latest queued value is sent (send-latest-wins), at most max_command_rate
+times per second. Every command gets a sequence number, sent along as zenoh attachment, and sent
+COG/SOG setpoints are matched against the telemetry received afterwards to measure how long the
+vessel took to respond and converge.
 '''
 
+import asyncio
+import itertools
 import sys
+import threading
 import time
-import zenoh as Zenoh
-from zenoh import Config
+from collections import deque
+from concurrent.futures import Future
 from keelson import enclose
 from keelson.payloads.Primitives_pb2 import TimestampedFloat
 
+from zenoh_session import SessionManager
+
+# Default maximum rate at which each setpoint is sent to the ship (commands per second)
+DEFAULT_MAX_COMMAND_RATE = 5.0
+
+# A setpoint counts as reached once the telemetry is within this of it
+SETPOINT_TOLERANCE = {"COG": 2.0, "SOG": 0.2}
+
+# Stop tracking a setpoint that hasn't been reached after this long (time in seconds)
+EFFECT_TIMEOUT = 600
+
+# Number of sent setpoints kept per setpoint name, e.g. for plotting
+SETPOINT_HISTORY_LENGTH = 1000
+
+
+class Command:
+    __slots__ = ("seq", "name", "value", "queued_ns", "future")
+
+    def __init__(self, seq, name, value):
+        self.seq = seq
+        self.name = name
+        self.value = value
+        self.queued_ns = time.time_ns()
+        # Resolved with the sequence number once sent, or None if superseded by a newer command
+        self.future = Future()
+
+
+class SetpointEffect:
+    '''
+    Tracks how the vessel responds to one sent setpoint.
+    '''
+    def __init__(self, command, sent_ns):
+        self.command = command
+        self.sent_ns = sent_ns
+        self.initial_error = None
+        self.response_s = None # Until the error first shrank by more than the tolerance
+        self.converged_s = None # Until the telemetry was within tolerance of the setpoint
+
+
+def setpoint_error(name, target, value):
+    if name == "COG":
+        # Shortest way around the compass
+        return (value - target + 180.0) % 360.0 - 180.0
+    return value - target
+
 
 class ROCController:
-    def __init__(self, roc_id, ship_id):
+    def __init__(self, roc_id, ship_id, session_manager=None, max_command_rate=DEFAULT_MAX_COMMAND_RATE):
         self.roc_id = roc_id # For example "ROC_1"
         self.ship_id = ship_id # For example "MASS_0"
 
-        cfg = Config()
-        self.zenoh = Zenoh.open(cfg)
+        # Share the session with the rest of the process if given one
+        self.session_manager = session_manager or SessionManager()
+        self.zenoh = self.session_manager.acquire()
+
+        self.pub_cog = self.session_manager.declare_publisher(f"{self.ship_id}/control/roc/{self.roc_id}/COG")
+        self.pub_sog = self.session_manager.declare_publisher(f"{self.ship_id}/control/roc/{self.roc_id}/SOG")
+        self.pub_relinquish = self.session_manager.declare_publisher(f"{self.ship_id}/handover/relinquish")
+        self.pub_takeover = self.session_manager.declare_publisher(f"{self.ship_id}/handover/takeover")
+
+        self.publishers = {
+            "COG": self.pub_cog,
+            "SOG": self.pub_sog,
+            "relinquish": self.pub_relinquish,
+            "takeover": self.pub_takeover,
+        }
+
+        # Command queue: latest command per name, sent by the sender thread
+        self.min_command_interval = 1.0 / max_command_rate
+        self._sequence = itertools.count(1)
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._last_sent = {}
+        self._running = True
+        self.sent = 0
+        self.superseded = 0
+        self.failed = 0
+
+        # Setpoint name -> (sent time in ns, value) of the setpoints sent
+        self.setpoints = {name: deque(maxlen=SETPOINT_HISTORY_LENGTH) for name in SETPOINT_TOLERANCE}
+
+        # Setpoint name -> SetpointEffect of the last sent setpoint. Replaced by the sender thread
+        # and removed from zenoh threads, both under _condition.
+        self.effects = {}
+        self.effect_listeners = []
+
+        self._sender = threading.Thread(target=self._send_loop, daemon=True)
+        self._sender.start()
+
+    def close(self):
+        '''
+        Send what is still queued, then release the zenoh session.
+        '''
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._sender.join(timeout=2.0)
+        self.session_manager.release()
+        print(f"[{self.roc_id}] {self.sent} commands sent, {self.superseded} superseded before sending, "
+              f"{self.failed} failed")
 
-        self.pub_cog = self.zenoh.declare_publisher(f"{self.ship_id}/control/roc/{self.roc_id}/COG")
-        self.pub_sog = self.zenoh.declare_publisher(f"{self.ship_id}/control/roc/{self.roc_id}/SOG")
-        self.pub_relinquish = self.zenoh.declare_publisher(f"{self.ship_id}/handover/relinquish")
-        self.pub_takeover = self.zenoh.declare_publisher(f"{self.ship_id}/handover/takeover")
+
+    # -------------------------------------------------------------------
+    # COMMANDS (non-blocking, callable from any thread)
+    # -------------------------------------------------------------------
 
     def send_cog(self, value):
-        msg = TimestampedFloat()
-        msg.timestamp.FromNanoseconds(time.time_ns())
-        msg.value = float(value)
-        self.pub_cog.put(enclose(msg.SerializeToString()))
-        print(f"[{self.roc_id}] Sent COG={value}")
+        return self.queue("COG", float(value))
 
     def send_sog(self, value):
-        msg = TimestampedFloat()
-        msg.timestamp.FromNanoseconds(time.time_ns())
-        msg.value = float(value)
-        self.pub_sog.put(enclose(msg.SerializeToString()))
-        print(f"[{self.roc_id}] Sent SOG={value}")
+        return self.queue("SOG", float(value))
 
     def send_relinquish(self):
-        self.pub_relinquish.put(self.roc_id)
-        print(f"[{self.roc_id}] Sent relinquish")
+        print(f"[{self.roc_id}] Sending relinquish")
+        return self.queue("relinquish", None)
 
     def send_takeover(self):
-        self.pub_takeover.put(self.roc_id)
-        print(f"[{self.roc_id}] Sent takeover")
+        print(f"[{self.roc_id}] Sending takeover")
+        return self.queue("takeover", None)
+
+    # Awaitable versions, resolving to the sequence number once sent (None if superseded), raising
+    # what sending raised if it failed
+    async def send_cog_async(self, value):
+        return await asyncio.wrap_future(self.send_cog(value).future)
+
+    async def send_sog_async(self, value):
+        return await asyncio.wrap_future(self.send_sog(value).future)
+
+    async def send_relinquish_async(self):
+        return await asyncio.wrap_future(self.send_relinquish().future)
+
+    async def send_takeover_async(self):
+        return await asyncio.wrap_future(self.send_takeover().future)
+
+    def queue(self, name, value):
+        '''
+        Queue a command, replacing a queued but not yet sent one of the same name.
+        Returns the Command, whose future resolves once it is sent.
+        '''
+        with self._condition:
+            command = Command(next(self._sequence), name, value)
+            superseded = self._pending.get(name)
+            self._pending[name] = command
+            if superseded:
+                self.superseded += 1
+            self._condition.notify()
+        if superseded and not superseded.future.done():
+            superseded.future.set_result(None)
+        return command
+
+
+    # -------------------------------------------------------------------
+    # SENDER THREAD
+    # -------------------------------------------------------------------
+
+    def _send_loop(self):
+        while True:
+            with self._condition:
+                command = None
+                while command is None:
+                    if not self._pending and not self._running:
+                        return
+                    command, wait = self._next_due()
+                    if command is None:
+                        # While closing, flush without waiting for the rate limit
+                        if not self._running:
+                            command = self._pending.pop(next(iter(self._pending)))
+                            break
+                        self._condition.wait(wait)
+                self._last_sent[command.name] = time.monotonic()
+
+            # A failed command must neither stop the sender nor leave its future pending
+            try:
+                self._send(command)
+            except Exception as e:
+                self.failed += 1
+                print(f"[WARN] [{self.roc_id}] Sending {command.name} #{command.seq} failed: {e!r}")
+                if not command.future.done():
+                    command.future.set_exception(e)
+
+    def _next_due(self):
+        '''
+        Pop a pending command whose rate limit allows sending it now. Otherwise return None and
+        how long to wait until one does (None for until notified).
+        '''
+        now = time.monotonic()
+        wait = None
+        for name in self._pending:
+            due = self._last_sent.get(name, 0.0) + self.min_command_interval
+            if due <= now:
+                return self._pending.pop(name), None
+            wait = due - now if wait is None else min(wait, due - now)
+        return None, wait
+
+    def _send(self, command):
+        publisher = self.publishers[command.name]
+        attachment = str(command.seq)
+        payload = self.session_manager.payload
+        if command.value is None:
+            publisher.put(payload(self.roc_id), attachment=attachment)
+        else:
+            msg = TimestampedFloat()
+            msg.timestamp.FromNanoseconds(time.time_ns())
+            msg.value = command.value
+            publisher.put(payload(enclose(msg.SerializeToString())), attachment=attachment)
+            sent_ns = time.time_ns()
+            self.setpoints[command.name].append((sent_ns, command.value))
+            with self._condition:
+                self.effects[command.name] = SetpointEffect(command, sent_ns)
+
+        self.sent += 1
+        if not command.future.done(): # e.g. cancelled by an awaiting coroutine
+            command.future.set_result(command.seq)
+
+
+    # -------------------------------------------------------------------
+    # COMMAND EFFECT TRACKING (fed with telemetry from the monitor)
+    # -------------------------------------------------------------------
+
+    def observe_cog(self, value):
+        self._observe("COG", value)
+
+    def observe_sog(self, value):
+        self._observe("SOG", value)
+
+    def _observe(self, name, value):
+        effect = self.effects.get(name)
+        if effect is None or effect.converged_s is not None:
+            return
+
+        elapsed = (time.time_ns() - effect.sent_ns) / 1e9
+        if elapsed > EFFECT_TIMEOUT:
+            print(f"[{self.roc_id}] {name} #{effect.command.seq} = {effect.command.value} "
+                  f"not reached within {EFFECT_TIMEOUT} s")
+            with self._condition:
+                # Unless a newer setpoint was sent meanwhile
+                if self.effects.get(name) is effect:
+                    del self.effects[name]
+            return
+
+        tolerance = SETPOINT_TOLERANCE[name]
+        error = abs(setpoint_error(name, effect.command.value, value))
+        if effect.initial_error is None:
+            effect.initial_error = error
+        if effect.response_s is None and error < effect.initial_error - tolerance:
+            effect.response_s = elapsed
+        if error <= tolerance:
+            if effect.response_s is None:
+                effect.response_s = elapsed
+            effect.converged_s = elapsed
+            print(f"[{self.roc_id}] {name} #{effect.command.seq} = {effect.command.value} reached after "
+                  f"{elapsed:.1f} s (first response after {effect.response_s:.1f} s)")
+            for listener in self.effect_listeners:
+                listener(effect)
 
 if __name__ == '__main__':
     print("Please run roc_main.py instead.")
@@ -1,24 +1,54 @@
 import datetime
+import threading
 import time
 import tkinter as tk
 import sys
 
 from tkinter import ttk
 from tkinter.scrolledtext import ScrolledText
-from tkintermapview import TkinterMapView
 
-# Don't update map widget more often than this to avoid flickering
-# (time in seconds)
-MAP_WIDGET_UPDATE_CAP = 5
+from gui_pump import LatestValueSlots, DEFAULT_FRAME_RATE
+from handover import IDLE, REQUESTED, AWAITING_CONFIRMATION, COMPLETED, TIMED_OUT
+from profiler import EventLoopLagProbe
+from tile_cache import LRUTileCache, TileStore, tiles_along_track
+from track import TILE_SIZE, TrackHistory, to_map_pixels
 
-# Some enums
-HANDOVER_STATE_PENDING = 0
-HANDOVER_STATE_READY = 1
-HANDOVER_STATE_COMPLETED = 2
+# Only recenter the map once the vessel is closer than this fraction of the map size to its edge
+MAP_RECENTER_MARGIN = 0.15
+
+# The map refresh interval adapts so that redrawing it takes at most this fraction of the GUI
+# thread's time, within the given bounds (time in seconds)
+MAP_REDRAW_BUDGET = 0.1
+MAP_REDRAW_MIN_INTERVAL = 0.05
+MAP_REDRAW_MAX_INTERVAL = 2.0
+
+# Number of positions kept in the vessel's track trail, and the tolerance (in pixels at the
+# current zoom level) the trail is simplified to before drawing
+TRACK_HISTORY_LENGTH = 5000
+TRACK_TOLERANCE_PX = 1.5
+
+# Zoom levels warmed by "Prefetch tiles along track"
+TRACK_PREFETCH_ZOOM_LEVELS = range(6, 14)
+
+# Refresh interval of the diagnostics panel (time in milliseconds)
+DIAGNOSTICS_REFRESH_MS = 1000
+
+# Most collision alerts listed at once, those of our own vessel first
+COLLISION_ALERTS_SHOWN = 100
 
 
 class RocGui:
-    def __init__(self, roc_controller):
+    def __init__(self, roc_controller, frame_rate=DEFAULT_FRAME_RATE, tile_db=None, offline=False, timeline=None,
+                 handover=None, screening=None):
+        '''
+        Only the window and placeholder panels are created here. The real panels are built one per
+        event loop turn once the window is shown, the map (the slowest) last, and telemetry that
+        arrives for a panel that isn't built yet is held until it is.
+
+        The handover status and safety-gate countdown are shown as the HandoverEngine handover
+        reports them for our ship, and the alerts of the CollisionScreening screening (if any) are
+        listed in the ROC information panel.
+        '''
         self.roc_controller = roc_controller
         self.roc_id = roc_controller.roc_id
         self.roc_id_num = int(self.roc_id[-1])
@@ -27,7 +57,13 @@ class RocGui:
         self.ship_id = roc_controller.ship_id
         # Hack!! TODO: have the ship tell us its controlling ROC instead.
         self.controlling_roc = "ROC_1"
-        self.handover_state = HANDOVER_STATE_PENDING
+        self.handover_state = IDLE
+        self.handover = handover
+        if handover:
+            handover.listeners.append(self.on_handover_event)
+        self.screening = screening
+        if screening:
+            screening.listeners.append(self.on_collision_alerts)
 
 
         # -------------------------------------------------------
@@ -46,8 +82,6 @@ class RocGui:
         # Set up a tall first row and two smaller ones
         root.rowconfigure(0, weight=3)
         root.rowconfigure(1, weight=1)
-        # TODO: Third row actually empty for now, but looks nice as padding.
-        # Should probably add content or replace with actual padding.
         root.rowconfigure(2, weight=1)
 
         # Should exit main loop on closing window
@@ -57,24 +91,60 @@ class RocGui:
         self.label_font = ("Arial", 10)
         self.value_font = ("Arial", 10, "bold")
 
+        # Telemetry callbacks only write into these slots (from any thread), they are rendered
+        # from the Tk thread by the update pump at most frame_rate times per second.
+        self.slots = LatestValueSlots()
+        # The same for the positions of the other vessels of the fleet, by vessel id
+        self.fleet_slots = LatestValueSlots()
+        self.frame_interval_ms = max(1, int(1000 / frame_rate))
+
+        # Field -> (renderer, panels it draws on). Fields are only rendered once all their panels
+        # are built, until then the latest value is held in held_updates.
+        self.field_renderers = {
+            "location": (self.render_map_position, ("map", "vessel_info")),
+            "cog": (self.render_cog_out, ("control",)),
+            "sog": (self.render_sog_out, ("control",)),
+            "name": (self.render_ship_name, ("vessel_info",)),
+            "mmsi": (self.render_mmsi, ("vessel_info",)),
+            "imo": (self.render_imo, ("vessel_info",)),
+            "remote_status": (self.render_remote_status, ("control",)),
+            "countdown": (self.render_countdown, ("control",)),
+            "roc_status": (self.render_roc_status, ("control",)),
+            "handover": (self.render_handover, ("control",)),
+            "collision_alerts": (self.render_collision_alerts, ("roc_info",)),
+        }
+        self.renderers = {}
+        self.held_updates = {}
+        # Called on every refresh tick before the slots are drained, e.g. to fill them from the
+        # shared state of an ingest process
+        self.update_sources = []
+        # Label -> last rendered (text, options), to skip config() calls that change nothing
+        self.rendered_labels = {}
+        self.renders = 0
+        self.renders_skipped = 0
+
+        # Records how late the Tk event loop runs. Everything the GUI does on the Tk thread is run
+        # through it, so lag spikes show what held the event loop up.
+        self.lag_probe = EventLoopLagProbe()
+
 
         # -------------------------------------------------------
-        # First column setup
+        # Panel setup
         # -------------------------------------------------------
 
         # Top left corner: Add pretty live map.
         self.marker = None
+        self.track_path = None
+        self.shown_trail = None # Last trail drawn, the track returns the same list until it changes
+        self.track = TrackHistory(TRACK_HISTORY_LENGTH)
         self.map_widget = None
-        self.map_widget_last_updated_time = 0
-        self.setup_vehicle_map_panel()
-
-        # Bottom left corner: Add ROC information (static for now, doesn't change after init).
-        self.setup_roc_information_panel()
-
-
-        # -------------------------------------------------------
-        # Second column setup
-        # -------------------------------------------------------
+        # Position of our vessel last shown, dead reckoned between fixes if the monitor does so
+        self.shown_position = None
+        self.tile_db = tile_db
+        self.offline = offline
+        self.map_redraw_interval = MAP_REDRAW_MIN_INTERVAL
+        self.map_next_redraw_time = 0
+        self.map_redraw_scheduled = False
 
         # Top middle: Vessel controls
         self.roc_status_label = None
@@ -90,7 +160,6 @@ class RocGui:
         self.relinquish_button = None
         self.takeover_button = None
         self.halt_button = None
-        self.setup_vessel_control_panel()
 
         # Bottom middle: Further vessel information
         self.ship_id_label = None
@@ -98,53 +167,143 @@ class RocGui:
         self.imo_label = None
         self.lat_label = None
         self.lon_label = None
-        self.setup_vessel_info_panel()
 
-
-        # -------------------------------------------------------
-        # Third column setup
-        # -------------------------------------------------------
+        # Bottom left: Collision alerts, in the ROC information panel
+        self.collision_alerts_tree = None
 
         # Top right: Interactive checklist
         # TODO: This is not connected to any real functionality at the moment.
         # But at least you can click the boxes, that's always fun!
         self.checklist_variables = None
-        self.setup_interactive_checklist_panel()
 
         # Bottom right: Arbitrary notes editor
         # TODO: Not connected to any real functionality yet either.
         self.notes_field = None
-        self.setup_notes_panel()
+
+        # Bottom row: Telemetry link and event loop diagnostics
+        self.diagnostics_tree = None
+        self.lag_label = None
+        self.prediction_label = None
+        self.lag_spikes_tree = None
+        self.lag_spikes_shown = 0
+
+        # In the vessel control panel: SOG/COG strip charts
+        self.frame_control = None
+        self.strip_chart = None
+
+        # Panels in the order they are built: (name, title, grid cell, setup method).
+        # Bottom left corner is the ROC information (static for now, doesn't change after init).
+        self.pending_panels = [
+            ("control", "Vessel control", (0, 1), self.setup_vessel_control_panel),
+            ("vessel_info", "Vessel information", (1, 1), self.setup_vessel_info_panel),
+            ("roc_info", "ROC information", (1, 0), self.setup_roc_information_panel),
+            ("checklist", "Bridge Checklist", (0, 2), self.setup_interactive_checklist_panel),
+            ("notes", "(Optional) remarks about ship status for next ROC", (1, 2), self.setup_notes_panel),
+            ("diagnostics", "Telemetry diagnostics", (2, 0), self.setup_diagnostics_panel),
+            ("map", "Vessel position map", (0, 0), self.setup_vehicle_map_panel),
+            ("charts", None, None, self.setup_strip_charts),
+        ]
+        self.built_panels = set()
+        self.placeholders = {}
+        for name, title, cell, _ in self.pending_panels:
+            if cell is None:
+                continue
+            row, column = cell
+            placeholder = tk.LabelFrame(root, text=title)
+            placeholder.grid(row=row, column=column, columnspan=3 if name == "diagnostics" else 1,
+                             sticky="nsew", padx=10, pady=10)
+            tk.Label(placeholder, text="Loading...", font=self.label_font, fg="gray").pack(expand=True)
+            self.placeholders[name] = placeholder
 
 
         # -------------------------------------------------------
         # Finalize setup
         # -------------------------------------------------------
-        self.conditionally_enable_elements()
-
         # Bit of an ugly hack - but if we get handed this we can properly close
         # the zenoh session and thus properly exit on closing the window.
         self.monitor = None
 
+        # Startup milestones are marked on this startup.StartupTimeline, if given
+        self.timeline = timeline
+        self.awaiting_first_render = True
+
+        # after_idle runs once the window has been drawn, the after(0) then lets it process
+        # anything queued behind that before the first panel is built
+        self.root.after_idle(lambda: self.root.after(0, self.build_next_panel))
+        self.root.after(self.frame_interval_ms, self.pump_updates)
+        self.root.after(DIAGNOSTICS_REFRESH_MS, self.refresh_diagnostics)
+        self.root.after(self.frame_interval_ms, self.animate_own_vessel)
+        self.lag_probe.start(self.root.after)
+
         print(f"{self.__class__.__name__} initialized.")
 
 
     # -------------------------------------------------------
     # Setup methods
     # -------------------------------------------------------
+    def build_next_panel(self):
+        '''
+        Replace the next placeholder with its real panel, then let Tk redraw before the next one.
+        '''
+        if not self.pending_panels:
+            return
+        if not self.built_panels:
+            self.mark_startup("first frame")
+
+        name, _, _, setup = self.pending_panels.pop(0)
+        self.lag_probe.run(f"build {name} panel", setup)
+        placeholder = self.placeholders.pop(name, None)
+        if placeholder:
+            placeholder.destroy()
+        self.built_panels.add(name)
+
+        # Fields can be rendered once every panel they draw on exists
+        for field, (renderer, panels) in self.field_renderers.items():
+            if field not in self.renderers and self.built_panels.issuperset(panels):
+                self.renderers[field] = renderer
+        if name == "control":
+            self.conditionally_enable_elements()
+
+        if self.pending_panels:
+            self.root.after(1, self.build_next_panel)
+        else:
+            self.mark_startup("GUI panels built")
+
+    def build_all_panels(self):
+        '''
+        Build all panels not built yet right away, e.g. when not running the event loop.
+        '''
+        while self.pending_panels:
+            self.build_next_panel()
+
+    def mark_startup(self, milestone):
+        if self.timeline:
+            self.timeline.mark(milestone)
+
     def setup_vehicle_map_panel(self):
         '''
-        Set up interactive live map showing vessel and ROC location.
+        Set up interactive live map showing vessel and ROC location, and in fleet mode all
+        other vessels (see fleet_map.py).
         '''
+        # The map widget is by far the slowest import, so it is only imported once the window shows
+        from fleet_map import FleetMapView
+
         frame_map = tk.LabelFrame(self.root, text="Vessel position map")
         frame_map.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
 
-        map_widget = TkinterMapView(frame_map, width=600, height=500, corner_radius=0)
+        # Tiles are read from the local tile file first if we have one (and only from there if offline)
+        if self.tile_db:
+            TileStore(self.tile_db)
+        map_widget = FleetMapView(frame_map, width=600, height=500, corner_radius=0,
+                                  database_path=self.tile_db, use_database_only=self.offline)
+        map_widget.tile_image_cache = LRUTileCache()
         map_widget.set_position(59.3293, 18.0686)  # Stockholm example
         map_widget.set_zoom(4)
         map_widget.pack(expand=True, fill="both")
         map_widget.set_marker(63.0888, 21.5617, text="ROC Vaasa", marker_color_circle="white", marker_color_outside="cyan")
         map_widget.set_marker(63.7045, 20.3530, text="ROC Umeå", marker_color_circle="yellow", marker_color_outside="cyan")
+        if self.tile_db and not self.offline:
+            map_widget.add_right_click_menu_command("Prefetch tiles along track", self.prefetch_track_tiles)
 
         self.map_widget = map_widget
 
@@ -174,6 +333,22 @@ class RocGui:
         roc_location_label = tk.Label(frame_roc, text=self.roc_location, font=self.value_font, anchor="w")
         roc_location_label.grid(row=2, column=1, sticky="w")
 
+        # Collision alerts of the fleet
+        if self.screening:
+            ttk.Separator(frame_roc, orient="horizontal").grid(row=3, column=0, columnspan=2, sticky="ew", pady=10)
+            tk.Label(frame_roc, text=f"Collision alerts (CPA < {self.screening.cpa_alert_nm:g} nm):",
+                     font=self.label_font, anchor="w").grid(row=4, column=0, columnspan=2, sticky="w")
+            tree = ttk.Treeview(frame_roc, columns=["cpa", "tcpa", "distance"], height=4)
+            tree.heading("#0", text="Vessels", anchor="w")
+            tree.column("#0", width=160, stretch=True)
+            for column, title in (("cpa", "CPA (nm)"), ("tcpa", "TCPA"), ("distance", "Now (nm)")):
+                tree.heading(column, text=title)
+                tree.column(column, width=70, anchor="e", stretch=False)
+            tree.tag_configure("own", foreground="red")
+            tree.grid(row=5, column=0, columnspan=2, sticky="nsew")
+            frame_roc.rowconfigure(5, weight=1)
+            self.collision_alerts_tree = tree
+
     def setup_vessel_control_panel(self):
         '''
         Set up vessel COG/SOG and handover controls.
@@ -219,7 +394,7 @@ class RocGui:
 
         sog_entry = tk.Entry(frame_control)
         sog_entry.grid(row=5, column=0, columnspan=2, sticky="ew", pady=2)
-        sog_button = tk.Button(frame_control, text="Set new SOG", command=self.send_sog)
+        sog_button = tk.Button(frame_control, text="Set new SOG", command=self.lag_probe.tracked("send SOG", self.send_sog))
         sog_button.grid(row=5, column=2, sticky="ew", padx=(5, 0))
 
         self.sog_button = sog_button
@@ -230,7 +405,7 @@ class RocGui:
         self.default_bgcol = sog_button.cget("background")
         self.default_abgcol = sog_button.cget("activebackground")
 
-        halt_button = tk.Button(frame_control, text="Halt ship", fg="red", command=self.halt_ship)
+        halt_button = tk.Button(frame_control, text="Halt ship", fg="red", command=self.lag_probe.tracked("halt ship", self.halt_ship))
         halt_button.grid(row=6, column=2, sticky="ew", pady=5)
 
         self.halt_button = halt_button
@@ -253,7 +428,7 @@ class RocGui:
 
         cog_entry = tk.Entry(frame_control)
         cog_entry.grid(row=10, column=0, columnspan=2, sticky="ew", pady=2)
-        cog_button = tk.Button(frame_control, text="Set new COG", command=self.send_cog)
+        cog_button = tk.Button(frame_control, text="Set new COG", command=self.lag_probe.tracked("send COG", self.send_cog))
         cog_button.grid(row=10, column=2, sticky="ew", padx=(5, 0))
 
         self.cog_button = cog_button
@@ -289,15 +464,33 @@ class RocGui:
 
         self.verify_button = verify_button
 
-        relinquish_button = tk.Button(frame_control, text="Relinquish control", command=self.on_relinquish, state="disabled")
+        relinquish_button = tk.Button(frame_control, text="Relinquish control", command=self.lag_probe.tracked("relinquish", self.on_relinquish), state="disabled")
         relinquish_button.grid(row=16, column=0, columnspan=3, sticky="ew", pady=5)
 
         self.relinquish_button = relinquish_button
 
-        takeover_button = tk.Button(frame_control, text="Request control", command=self.on_request, state="disabled")
+        takeover_button = tk.Button(frame_control, text="Request control", command=self.lag_probe.tracked("takeover", self.on_request), state="disabled")
         takeover_button.grid(row=17, column=0, columnspan=3, sticky="ew", pady=5)
 
         self.takeover_button = takeover_button
+        self.frame_control = frame_control
+
+    def setup_strip_charts(self):
+        '''
+        Add SOG/COG strip charts, with the sent setpoints, to the bottom of the vessel control panel.
+        '''
+        # matplotlib is only imported once the rest of the window is up
+        from strip_chart import StripChart, CHART_REFRESH_MS
+
+        ttk.Separator(self.frame_control, orient="horizontal").grid(
+            row=18, column=0, columnspan=3, sticky="ew", pady=10
+        )
+        self.strip_chart = StripChart(self.frame_control, self.ship_id, self.roc_controller.setpoints)
+        self.strip_chart.widget.grid(row=19, column=0, columnspan=3, sticky="nsew")
+        self.frame_control.rowconfigure(19, weight=1)
+
+        self.chart_refresh_ms = CHART_REFRESH_MS
+        self.root.after(self.chart_refresh_ms, self.refresh_charts)
 
     def setup_vessel_info_panel(self):
         '''
@@ -410,6 +603,56 @@ class RocGui:
 
         self.notes_field = notes_field
 
+    def setup_diagnostics_panel(self):
+        '''
+        Set up table of per topic telemetry rate, jitter and latencies, and the event loop lag
+        with the latest lag spikes.
+        '''
+        frame_diagnostics = tk.LabelFrame(self.root, text="Telemetry diagnostics")
+        frame_diagnostics.grid(row=2, column=0, columnspan=3, sticky="nsew", padx=10, pady=(0, 10))
+
+        lag_label = tk.Label(frame_diagnostics, text="Event loop lag: -", font=self.label_font, anchor="w")
+        lag_label.pack(side="top", fill="x")
+        prediction_label = tk.Label(frame_diagnostics, text="Position prediction error: -", font=self.label_font,
+                                    anchor="w")
+        prediction_label.pack(side="top", fill="x")
+
+        spikes = ttk.Treeview(frame_diagnostics, columns=["lag", "during"], height=4)
+        spikes.heading("#0", text="Lag spike", anchor="w")
+        spikes.column("#0", width=80, stretch=False)
+        spikes.heading("lag", text="Lag (ms)")
+        spikes.column("lag", width=70, anchor="e", stretch=False)
+        spikes.heading("during", text="Longest activities meanwhile (ms)", anchor="w")
+        spikes.column("during", width=420, stretch=False)
+        spikes.pack(side="right", fill="y", padx=(10, 0))
+
+        columns = {
+            "rate": "Rate (Hz)",
+            "jitter": "Jitter (ms)",
+            "pub_p50": "Link p50 (ms)",
+            "pub_p99": "Link p99 (ms)",
+            "pub_max": "Link max (ms)",
+            "render_p50": "Render p50 (ms)",
+            "render_p99": "Render p99 (ms)",
+            "render_max": "Render max (ms)",
+        }
+        tree = ttk.Treeview(frame_diagnostics, columns=list(columns), height=4)
+        tree.heading("#0", text="Key expression", anchor="w")
+        tree.column("#0", width=380, stretch=True)
+        for column, title in columns.items():
+            tree.heading(column, text=title)
+            tree.column(column, width=90, anchor="e", stretch=False)
+
+        scrollbar = tk.Scrollbar(frame_diagnostics, orient="vertical", command=tree.yview)
+        scrollbar.pack(side="right", fill="y")
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(expand=True, fill="both")
+
+        self.diagnostics_tree = tree
+        self.lag_label = lag_label
+        self.prediction_label = prediction_label
+        self.lag_spikes_tree = spikes
+
 
     # -------------------------------------------------------
     # Methods called from GUI actions
@@ -418,26 +661,36 @@ class RocGui:
         '''
         Called upon window close, all cleanup needs to happen here.
         '''
-        # Close zenoh session properly at exit
+        # Close zenoh session properly at exit (it is closed once both have released it)
         if self.monitor:
-            self.monitor.session.close()
+            self.monitor.close()
+        if self.handover:
+            self.handover.stop()
+        if self.screening:
+            self.screening.stop()
+        self.roc_controller.close()
+
+        print(f"GUI updates: {self.slots.writes} received, {self.slots.coalesced} coalesced, "
+              f"{self.renders} rendered, {self.renders_skipped} skipped as unchanged")
 
         self.root.quit()
         self.root.destroy()
 
     def on_relinquish(self):
         '''
-        Send relinquish control zenoh message and display a helpful GUI message.
+        Send relinquish control zenoh message, the handover engine then awaits its confirmation.
         '''
-        self.handover_status_label.configure(text="Awaiting confirmation...", fg="blue")
         self.roc_controller.send_relinquish()
+        if self.handover:
+            self.handover.on_command(self.ship_id, "relinquish")
 
     def on_request(self):
         '''
-        Send request control zenoh message and display a helpful GUI message.
+        Send request control zenoh message, the handover engine then awaits its confirmation.
         '''
-        self.handover_status_label.configure(text="Awaiting confirmation...", fg="blue")
         self.roc_controller.send_takeover()
+        if self.handover:
+            self.handover.on_command(self.ship_id, "takeover")
 
     def send_cog(self):
         '''
@@ -464,6 +717,19 @@ class RocGui:
         print("\n!!! HALT BUTTON PRESSED !!!")
         self.roc_controller.send_sog(0)
 
+    def prefetch_track_tiles(self):
+        '''
+        Warm the tile file along the vessel's recent track, in the background.
+        '''
+        tiles = tiles_along_track(list(self.track.points), TRACK_PREFETCH_ZOOM_LEVELS)
+        print(f"Prefetching {len(tiles)} map tiles along track...")
+
+        def prefetch():
+            stored = TileStore(self.tile_db).fetch(tiles)
+            print(f"Prefetched {stored} new map tiles.")
+
+        threading.Thread(target=prefetch, daemon=True).start()
+
     def print_checklist_status(self):
         '''
         Do something with the interactive checklist.
@@ -475,24 +741,134 @@ class RocGui:
             print(f"{item}: {'✓' if var.get() else '✗'}")
         print("-------------------------\n")
 
-    def update_map_position(self, lat_val, lon_val):
+    def render_map_position(self, lat_val, lon_val):
         '''
         Update map position to given lat/long value.
         '''
+        self.track.append(lat_val, lon_val)
+        self.show_own_position()
+
+    def own_position(self):
+        '''
+        Position of our vessel to show now: dead reckoned if the monitor does so, else the latest fix.
+        '''
+        dead_reckoning = self.monitor.dead_reckoning if self.monitor else None
+        if dead_reckoning:
+            position = dead_reckoning.position(self.ship_id, time.time_ns())
+            if position:
+                return position
+        return self.track.points[-1]
+
+    def show_own_position(self):
+        '''
+        Show the position of our vessel in the labels, and on the map once it's time to redraw it.
+        '''
+        lat_val, lon_val = self.own_position()
+        self.set_label_text(self.lat_label, f"{lat_val:.6f}")
+        self.set_label_text(self.lon_label, f"{lon_val:.6f}")
+        self.request_map_redraw()
+
+    def animate_own_vessel(self):
+        '''
+        Move our vessel between location fixes at the display rate, then reschedule.
+        '''
+        if (self.monitor and self.monitor.dead_reckoning and self.track
+                and "location" in self.renderers and self.own_position() != self.shown_position):
+            self.lag_probe.run("dead reckoning", self.show_own_position)
+        self.root.after(self.frame_interval_ms, self.animate_own_vessel)
+
+    def render_fleet_positions(self, updates):
+        '''
+        Move the other vessels of the fleet on the map, given {vessel id: (time, (lat, lon))}.
+        '''
+        fleet = self.map_widget.fleet
+        for vessel_id, (_, (lat_val, lon_val)) in updates.items():
+            fleet.update(vessel_id, lat_val, lon_val)
+        self.request_map_redraw()
+
+    def request_map_redraw(self):
+        '''
+        Redraw the map now, or once it's time to.
+        '''
+        # The map is redrawn at an adaptive rate, if it's not yet time make sure the latest
+        # positions get drawn once it is.
+        now = time.time()
+        if now >= self.map_next_redraw_time:
+            self.lag_probe.run("map redraw", self.redraw_map)
+        elif not self.map_redraw_scheduled:
+            self.map_redraw_scheduled = True
+            delay_ms = int((self.map_next_redraw_time - now) * 1000) + 1
+            self.root.after(delay_ms, self.lag_probe.tracked("map redraw", self.redraw_map))
+
+    def redraw_map(self):
+        '''
+        Move the vessel marker and track trail to the latest position, in place, and the fleet's
+        vessels if any moved.
+        '''
+        self.map_redraw_scheduled = False
+
+        start = time.time()
+        if self.track:
+            self.redraw_own_vessel()
+        fleet = self.map_widget.fleet
+        if fleet.dirty:
+            fleet.draw()
+
+        # Slow redraws (e.g. many tiles coming in after recentering) back off the refresh rate
+        elapsed = time.time() - start
+        self.map_redraw_interval = min(MAP_REDRAW_MAX_INTERVAL,
+                                       max(MAP_REDRAW_MIN_INTERVAL, elapsed / MAP_REDRAW_BUDGET))
+        self.map_next_redraw_time = start + self.map_redraw_interval
+
+    def redraw_own_vessel(self):
+        lat_val, lon_val = self.shown_position = self.own_position()
         try:
-            self.lat_label.config(text=f"{lat_val:.6f}")
-            self.lon_label.config(text=f"{lon_val:.6f}")
-
-            # To counter flickering, set a limit to map widget update frequency
-            if time.time() > self.map_widget_last_updated_time + MAP_WIDGET_UPDATE_CAP:
-                if self.marker:
-                    self.marker.delete()
-                self.marker = self.map_widget.set_marker(lat_val, lon_val, text="MASS_0")
+            if self.marker:
+                self.marker.set_position(lat_val, lon_val)
+            else:
+                self.marker = self.map_widget.set_marker(lat_val, lon_val, text=self.ship_id)
+
+            if not self.is_within_map_margin(lat_val, lon_val):
                 self.map_widget.set_position(lat_val, lon_val)
-                self.map_widget_last_updated_time = time.time()
+
+            trail = self.track.simplified(round(self.map_widget.zoom), TRACK_TOLERANCE_PX)
+            if len(trail) >= 2 and trail is not self.shown_trail:
+                if self.track_path:
+                    self.track_path.set_position_list(trail)
+                else:
+                    self.track_path = self.map_widget.set_path(trail, width=2, color="#3E69CB")
+                self.shown_trail = trail
         except ValueError:
             pass
 
+    def is_within_map_margin(self, lat_val, lon_val):
+        '''
+        Check if a position is inside the visible map area, minus MAP_RECENTER_MARGIN on each side.
+        '''
+        map_widget = self.map_widget
+        pixel_x, pixel_y = to_map_pixels(lat_val, lon_val, round(map_widget.zoom))
+        tile_x, tile_y = pixel_x / TILE_SIZE, pixel_y / TILE_SIZE
+        (left, top), (right, bottom) = map_widget.upper_left_tile_pos, map_widget.lower_right_tile_pos
+        if right <= left or bottom <= top:
+            return False
+
+        rel_x = (tile_x - left) / (right - left)
+        rel_y = (tile_y - top) / (bottom - top)
+        return (MAP_RECENTER_MARGIN <= rel_x <= 1 - MAP_RECENTER_MARGIN
+                and MAP_RECENTER_MARGIN <= rel_y <= 1 - MAP_RECENTER_MARGIN)
+
+    def set_label_text(self, label, text, **options):
+        '''
+        Configure label with text and options, unless that is what it already shows.
+        '''
+        rendered = (text, options)
+        if self.rendered_labels.get(label) == rendered:
+            self.renders_skipped += 1
+            return
+        label.config(text=text, **options)
+        self.rendered_labels[label] = rendered
+        self.renders += 1
+
     def conditionally_enable_elements(self):
         '''
         Enable or disable certain elements, depending on handover status and whether we're the controling ROC.
@@ -507,10 +883,10 @@ class RocGui:
                 element.config(state="disabled")
 
         # Handover elements
-        if self.handover_state in [HANDOVER_STATE_PENDING, HANDOVER_STATE_COMPLETED]:
+        if self.handover_state != REQUESTED:
             self.relinquish_button.config(state="disabled", bg=self.default_bgcol, activebackground=self.default_abgcol)
             self.takeover_button.config(state="disabled", bg=self.default_bgcol, activebackground=self.default_abgcol)
-        elif self.handover_state == HANDOVER_STATE_READY:
+        else:
             if self.roc_id == self.controlling_roc:
                 self.relinquish_button.config(state="normal", bg="green", activebackground="lightgreen")
                 self.takeover_button.config(state="disabled")
@@ -520,81 +896,244 @@ class RocGui:
 
 
     # -------------------------------------------------------
-    # Callbacks for ship updates
+    # Callbacks for ship updates (may be called from any thread)
     # -------------------------------------------------------
-    def on_handover_request(self, value):
+    def on_handover_event(self, kind, vessel_id, value):
         '''
-        React to handover ready message from ship.
+        HandoverEngine listener: "handover" events carry a HandoverStatus, "countdown" events the
+        whole seconds left until the safety gate.
         '''
-        self.handover_state = HANDOVER_STATE_READY
-        self.handover_status_label.config(text="Ready for handover", fg="green")
-        self.conditionally_enable_elements()
+        if vessel_id == self.ship_id:
+            self.slots.put(kind, value)
+
+    def on_collision_alerts(self, alerts):
+        self.slots.put("collision_alerts", alerts)
+
+    def update_map_position(self, lat_val, lon_val):
+        self.slots.put("location", lat_val, lon_val)
+
+    def update_fleet_position(self, vessel_id, lat_val, lon_val):
+        # Our own vessel has its own marker and track
+        if vessel_id != self.ship_id:
+            self.fleet_slots.put(vessel_id, lat_val, lon_val)
+
+    def update_cog_out(self, value):
+        self.slots.put("cog", value)
+
+    def update_sog_out(self, value):
+        self.slots.put("sog", value)
+
+    def update_roc_status(self, value):
+        self.slots.put("roc_status", value)
+
+    def update_mmsi(self, value):
+        self.slots.put("mmsi", value)
 
-    def on_handover_state(self, value):
+    def update_imo(self, value):
+        self.slots.put("imo", value)
+
+    def update_remote_status(self, value):
+        self.slots.put("remote_status", value)
+
+    def update_ship_name(self, value):
+        self.slots.put("name", value)
+
+
+    # -------------------------------------------------------
+    # Rendering of ship updates (Tk thread only)
+    # -------------------------------------------------------
+    def pump_updates(self):
+        '''
+        Render the latest value of every field updated since the last frame, then reschedule.
+        '''
+        for source in self.update_sources:
+            self.lag_probe.run("update source", source)
+        updates = self.slots.drain()
+        if self.held_updates:
+            # Newer values replace held ones
+            held, self.held_updates = self.held_updates, {}
+            held.update(updates)
+            updates = held
+
+        for field, (received_ns, args) in updates.items():
+            renderer = self.renderers.get(field)
+            if renderer is None:
+                # Its panel isn't built yet, keep the latest value until it is
+                self.held_updates[field] = (received_ns, args)
+                continue
+            self.lag_probe.run(f"render {field}", renderer, *args)
+            if self.monitor:
+                self.monitor.record_render(self.ship_id, field, received_ns)
+            if self.awaiting_first_render:
+                self.awaiting_first_render = False
+                self.mark_startup("first telemetry rendered")
+
+        # Fleet positions wait in their slots until the map is built
+        if "map" in self.built_panels:
+            fleet_updates = self.fleet_slots.drain()
+            if fleet_updates:
+                self.lag_probe.run("render fleet", self.render_fleet_positions, fleet_updates)
+        self.root.after(self.frame_interval_ms, self.pump_updates)
+
+    def refresh_diagnostics(self):
+        '''
+        Show the monitor's latest per topic statistics, then reschedule.
+        '''
+        def ms(value_ns):
+            return "-" if value_ns is None else f"{value_ns / 1e6:.1f}"
+
+        if self.monitor and self.diagnostics_tree:
+            tree = self.diagnostics_tree
+            for key_expr, topic in self.monitor.stats.snapshot():
+                link = topic.publish_to_receive
+                render = topic.receive_to_render
+                values = (
+                    "-" if topic.rate_hz is None else f"{topic.rate_hz:.1f}",
+                    ms(topic.jitter_ns),
+                    ms(link.percentile(0.5)), ms(link.percentile(0.99)), ms(link.max if link.count else None),
+                    ms(render.percentile(0.5)), ms(render.percentile(0.99)), ms(render.max if render.count else None),
+                )
+                if tree.exists(key_expr):
+                    tree.item(key_expr, values=values)
+                else:
+                    tree.insert("", "end", iid=key_expr, text=key_expr, values=values)
+
+        if self.lag_label:
+            self.show_event_loop_lag()
+        if self.prediction_label and self.monitor and self.monitor.dead_reckoning:
+            self.show_prediction_error(self.monitor.dead_reckoning)
+
+        self.root.after(DIAGNOSTICS_REFRESH_MS, self.refresh_diagnostics)
+
+    def show_event_loop_lag(self):
+        '''
+        Show the lag probe's statistics, and the lag spikes recorded since the last refresh.
         '''
-        React to handover completed message from ship.
+        probe = self.lag_probe
+        lag = probe.lag
+        if lag.count:
+            self.set_label_text(self.lag_label,
+                                f"Event loop lag: p50 {lag.percentile(0.5) / 1e6:.1f} ms, "
+                                f"p99 {lag.percentile(0.99) / 1e6:.1f} ms, max {lag.max / 1e6:.1f} ms, "
+                                f"{probe.spike_count} spikes over {probe.spike_ms} ms")
+
+        new_spikes = min(probe.spike_count - self.lag_spikes_shown, len(probe.spikes))
+        self.lag_spikes_shown = probe.spike_count
+        if new_spikes:
+            tree = self.lag_spikes_tree
+            for spike in list(probe.spikes)[-new_spikes:]:
+                during = ", ".join(f"{name} {ms:.0f}" for name, ms in spike.activities) or "untracked (Tk, or other threads)"
+                tree.insert("", 0, text=datetime.datetime.fromtimestamp(spike.time).strftime("%H:%M:%S"),
+                            values=(f"{spike.lag_ms:.0f}", during))
+            # Keep as many as the probe does
+            for item in tree.get_children()[len(probe.spikes):]:
+                tree.delete(item)
+
+    def show_prediction_error(self, dead_reckoning):
         '''
-        self.handover_state = HANDOVER_STATE_COMPLETED
-        self.handover_status_label.config(text="Handover completed.", fg="green")
-        self.time_until_label.config(text="N/A")
+        Show how far location fixes were from where dead reckoning projected them.
+        '''
+        errors = dead_reckoning.errors
+        if errors.count:
+            self.set_label_text(self.prediction_label,
+                                f"Position prediction error: p50 {dead_reckoning.error_percentile(0.5):.1f} m, "
+                                f"p99 {dead_reckoning.error_percentile(0.99):.1f} m, "
+                                f"max {dead_reckoning.error_percentile(1.0):.1f} m over {errors.count} fixes")
+
+    def refresh_charts(self):
+        '''
+        Redraw the strip charts from the telemetry history, then reschedule. This runs at its own
+        rate, however often telemetry arrives.
+        '''
+        self.lag_probe.run("strip charts", self.strip_chart.refresh, self.monitor.history if self.monitor else None)
+        self.root.after(self.chart_refresh_ms, self.refresh_charts)
 
-        # TODO: AWFUL HACK (but quick)
-        priority_roc = "ROC_2" if "new_priority=ROC_2" in value else "ROC_1"
-        self.controlling_roc = priority_roc
-        self.roc_status_label.config(text=priority_roc)
+    def render_handover(self, status):
+        '''
+        React to a change of our ship's handover state.
+        '''
+        self.handover_state = status.state
+        if status.state == REQUESTED:
+            self.set_label_text(self.handover_status_label, "Ready for handover", fg="green")
+        elif status.state == AWAITING_CONFIRMATION:
+            self.set_label_text(self.handover_status_label, "Awaiting confirmation...", fg="blue")
+        elif status.state == COMPLETED:
+            self.set_label_text(self.handover_status_label, "Handover completed.", fg="green")
+            self.set_label_text(self.time_until_label, "N/A")
+            if status.to_roc:
+                self.controlling_roc = status.to_roc
+                self.set_label_text(self.roc_status_label, status.to_roc)
+        elif status.state == TIMED_OUT:
+            self.set_label_text(self.handover_status_label, f"Handover failed: {status.reason}", fg="red")
         self.conditionally_enable_elements()
 
-    def update_cog_out(self, value):
+    def render_collision_alerts(self, alerts):
+        '''
+        List the latest collision alerts, those of our own vessel first and highlighted.
+        '''
+        tree = self.collision_alerts_tree
+        if tree is None:
+            return
+        tree.delete(*tree.get_children())
+        own = [alert for alert in alerts if self.ship_id in (alert.vessel_a, alert.vessel_b)]
+        others = [alert for alert in alerts if self.ship_id not in (alert.vessel_a, alert.vessel_b)]
+        for alert in (own + others)[:COLLISION_ALERTS_SHOWN]:
+            minutes, seconds = divmod(int(alert.tcpa_s), 60)
+            tree.insert("", "end", text=f"{alert.vessel_a} – {alert.vessel_b}",
+                        values=(f"{alert.cpa_nm:.2f}", f"{minutes}:{seconds:02d}", f"{alert.distance_nm:.2f}"),
+                        tags=("own",) if alert in own else ())
+
+    def render_cog_out(self, value):
         '''
         React to cog message from ship.
         '''
-        self.cog_label.config(text=f"{value:.2f}")
+        self.set_label_text(self.cog_label, f"{value:.2f}")
 
-    def update_sog_out(self, value):
+    def render_sog_out(self, value):
         '''
         React to sog message from ship.
         '''
-        self.sog_label.config(text=f"{value:.2f}")
+        self.set_label_text(self.sog_label, f"{value:.2f}")
 
-    def update_roc_status(self, value):
+    def render_roc_status(self, value):
         '''
         React to roc status message from ship.
         '''
         # TODO: fix when we can get has_priority as well
-        # self.roc_status_label.config(text=value)
+        # self.set_label_text(self.roc_status_label, value)
         pass
 
-    def update_mmsi(self, value):
+    def render_mmsi(self, value):
         '''
         React to MMSI message from ship.
         '''
-        self.mmsi_label.config(text=value)
+        self.set_label_text(self.mmsi_label, value)
 
-    def update_imo(self, value):
+    def render_imo(self, value):
         '''
         React to IMO message from ship.
         '''
-        self.imo_label.config(text=value)
+        self.set_label_text(self.imo_label, value)
 
-    def update_remote_status(self, value):
+    def render_remote_status(self, value):
         '''
         React to remote status message from ship.
         '''
-        self.ship_status_label.config(text=value)
+        self.set_label_text(self.ship_status_label, value)
 
-    def update_remote_time(self, value):
+    def render_countdown(self, value):
         '''
-        React to remote time message from ship.
+        React to a second passing on the countdown to the safety gate.
         '''
         ## Format into hh:mm:ss at one second precision
         time_fmt = str(datetime.timedelta(seconds=int(value)))
-        self.time_until_label.config(text=time_fmt)
+        self.set_label_text(self.time_until_label, time_fmt)
 
-    def update_ship_name(self, value):
+    def render_ship_name(self, value):
         '''
         React to ship name message from ship.
         '''
-        self.ship_id_label.config(text=value)
+        self.set_label_text(self.ship_id_label, value)
 
 
     # -------------------------------------------------------
@@ -2,13 +2,71 @@
 
 '''
 Main entry point for the ROC simulator.
+
+The GUI modules (Tk and the map widget) are only imported when the GUI is actually started, so
+--headless starts faster and runs without a display or Tk installed. Likewise the modules of
+optional features (collision screening, history, dead reckoning, flight recorder, metrics) are
+only imported when their feature is enabled, numpy with the first of them that needs it.
+
+With --split, telemetry ingest runs in a separate process from the GUI (see ingest.py). The two
+halves can also be started on their own: --ingest-only SOCKET runs the ingest process, and
+--attach SOCKET opens a GUI viewer on it (any number of them).
 '''
 
+import time
+STARTED = time.perf_counter()
+
 import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
 
+from gui_pump import DEFAULT_FRAME_RATE
+from profiler import ThreadProfiler
 from ship_monitor import ShipTelemetryMonitor
-from roc_controller import ROCController
-from roc_gui import RocGui
+from roc_controller import ROCController, DEFAULT_MAX_COMMAND_RATE
+from startup import StartupTimeline
+from zenoh_session import SessionConfig, SessionManager
+
+def only_vessel(vessel_id, callback):
+    '''
+    Wrap a single ship callback for use with a fleet monitor, dropping updates from other vessels.
+    '''
+    def wrapper(sender_id, *args):
+        if sender_id == vessel_id:
+            callback(*args)
+    return wrapper
+
+def for_vessel(vessel_id, callback):
+    '''
+    Wrap a callback taking the vessel id for use with a single ship monitor, passing it that ship.
+    '''
+    def wrapper(*args):
+        callback(vessel_id, *args)
+    return wrapper
+
+def with_screening(callbacks, screening):
+    '''
+    Also pass the positions, COGs and SOGs of every vessel in fleet monitor callbacks to the
+    collision screening, if any.
+    '''
+    if screening:
+        for name, observe in (('handle_location', screening.observe_location),
+                              ('handle_cog', screening.observe_cog),
+                              ('handle_sog', screening.observe_sog)):
+            callbacks[name] = chain(callbacks[name], observe) if name in callbacks else observe
+    return callbacks
+
+def chain(*callbacks):
+    '''
+    Combine callbacks into one calling each of them in turn.
+    '''
+    def wrapper(*args):
+        for callback in callbacks:
+            callback(*args)
+    return wrapper
 
 def main():
     parser = argparse.ArgumentParser(description="ROC simulator")
@@ -19,32 +77,271 @@ def main():
     parser.add_argument("-s", "--ship",
                         type=str,
                         default="MASS_0")
+    parser.add_argument("--fleet",
+                        action="store_true",
+                        help="monitor every vessel, not only --ship")
+    parser.add_argument("--fps",
+                        type=float,
+                        default=DEFAULT_FRAME_RATE,
+                        help="maximum rate at which telemetry is rendered in the GUI (or emitted when headless)")
+    parser.add_argument("--tile-db",
+                        help="SQLite map tile file to read tiles from first (see tile_cache.py)")
+    parser.add_argument("--offline",
+                        action="store_true",
+                        help="only use map tiles from --tile-db, never the network")
+    parser.add_argument("--record",
+                        metavar="LOG",
+                        help="record all received telemetry to this flight recorder log")
+    parser.add_argument("--replay",
+                        metavar="LOG",
+                        help="replay telemetry from this flight recorder log instead of receiving it live")
+    parser.add_argument("--replay-speed",
+                        type=float,
+                        default=1.0,
+                        help="replay speed factor, 0 for as fast as possible")
+    parser.add_argument("--replay-start",
+                        type=float,
+                        default=0.0,
+                        help="seconds into the log to start replaying from")
+    parser.add_argument("--metrics-port",
+                        type=int,
+                        help="serve telemetry statistics for Prometheus on this local port")
+    # Options of features imported only when enabled default to None, for the feature's own default
+    parser.add_argument("--history-budget",
+                        type=float,
+                        metavar="MIB",
+                        help="memory for the telemetry history (in MiB, 64 by default), 0 to keep no history")
+    parser.add_argument("--dead-reckoning",
+                        action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="move vessels between location fixes along their COG and SOG, or only on fixes")
+    parser.add_argument("--location-rate",
+                        type=float,
+                        metavar="HZ",
+                        help="take at most this many location fixes per second from each vessel (dead reckoning in between)")
+    parser.add_argument("--max-command-rate",
+                        type=float,
+                        default=DEFAULT_MAX_COMMAND_RATE,
+                        help="maximum rate at which each setpoint is sent to the ship, newer ones replace queued ones")
+    parser.add_argument("--headless",
+                        action="store_true",
+                        help="run without GUI, emitting state as JSON lines and reading commands from stdin")
+    parser.add_argument("--state-socket",
+                        metavar="[HOST:]PORT",
+                        help="when headless, stream state to (and take commands from) TCP clients on this address instead of stdout")
+    parser.add_argument("--split",
+                        action="store_true",
+                        help="run telemetry ingest in a separate process from the GUI")
+    parser.add_argument("--ingest-only",
+                        metavar="SOCKET",
+                        help="only run telemetry ingest, serving GUI viewers on this unix socket path")
+    parser.add_argument("--attach",
+                        metavar="SOCKET",
+                        help="only run a GUI viewer of the ingest process serving on this unix socket path")
+    parser.add_argument("--cpa-alert",
+                        type=float,
+                        metavar="NM",
+                        help="with --fleet, alert on vessels coming closer than this (in nautical miles, 0.5 by default)")
+    parser.add_argument("--tcpa-alert",
+                        type=float,
+                        metavar="MINUTES",
+                        help="with --fleet, alert on vessels coming closer than --cpa-alert within this time (12 by default)")
+    parser.add_argument("--profile",
+                        metavar="DIR",
+                        help="profile every thread, writing the profiles to this directory on exit and on SIGUSR1")
+    SessionConfig.add_arguments(parser)
     args = parser.parse_args()
+    if args.offline and not args.tile_db:
+        parser.error("--offline requires --tile-db")
+    if sum(map(bool, (args.headless, args.split, args.ingest_only, args.attach))) > 1:
+        parser.error("--headless, --split, --ingest-only and --attach exclude each other")
+
+    if args.split:
+        run_split(args)
+    elif args.attach:
+        run_viewer(args, args.attach)
+    else:
+        run(args)
+
+def start_profiler(args):
+    '''
+    With --profile, profile this process from here on, including the threads started later.
+    '''
+    if args.profile:
+        ThreadProfiler(args.profile).start()
+
+def run(args):
+    '''
+    Run the ROC in this process: GUI or headless, or only its ingest half with --ingest-only.
+    '''
+    # When headless, stdout carries the JSON lines, so send everything else that is printed to stderr
+    output = sys.stdout
+    if args.headless:
+        sys.stdout = sys.stderr
+
+    start_profiler(args)
+
+    timeline = StartupTimeline(STARTED)
+    timeline.mark("imports done")
+
+    # One zenoh session shared by everything in this process
+    session_manager = SessionManager(SessionConfig.from_args(args))
 
     # Initialize ROC controller (thing sending commands to ship)
-    roc_controller = ROCController(args.roc, args.ship)
+    roc_controller = ROCController(args.roc, args.ship, session_manager, args.max_command_rate)
+    timeline.mark("zenoh session open")
+
+    # Handover states and safety-gate countdowns of every vessel, on a single timer thread
+    from handover import HandoverEngine
+    handover = HandoverEngine(args.roc)
+    handover.start()
+
+    # Collision screening of every vessel, on its own thread, when watching a fleet
+    screening = None
+    if args.fleet and not args.ingest_only:
+        from collision import DEFAULT_CPA_ALERT_NM, DEFAULT_TCPA_ALERT_S, CollisionScreening
+        cpa_alert_nm = DEFAULT_CPA_ALERT_NM if args.cpa_alert is None else args.cpa_alert
+        tcpa_alert_s = DEFAULT_TCPA_ALERT_S if args.tcpa_alert is None else args.tcpa_alert * 60
+        screening = CollisionScreening(cpa_alert_nm, tcpa_alert_s)
+        screening.start()
+
+    if args.ingest_only:
+        run_ingest(args, timeline, session_manager, roc_controller, handover)
+    elif args.headless:
+        run_headless(args, timeline, session_manager, roc_controller, handover, screening, output)
+    else:
+        run_gui(args, timeline, session_manager, roc_controller, handover, screening)
+
+def start_monitor(args, timeline, session_manager, callbacks):
+    '''
+    Initialize telemetry monitor with the given callbacks
+    (thing receiving Zenoh/keelson messages from ship)
+    '''
+    monitor = ShipTelemetryMonitor(args.ship, callbacks, fleet=args.fleet, session_manager=session_manager,
+                                   live=not args.replay)
+    timeline.mark("telemetry monitor started")
+    timeline.when(monitor.first_sample, "first telemetry processed")
+    if args.history_budget != 0:
+        from history import DEFAULT_HISTORY_BUDGET, HistoryStore
+        budget = DEFAULT_HISTORY_BUDGET if args.history_budget is None else int(args.history_budget * 2**20)
+        monitor.history = HistoryStore(budget, reserved_vessels=[args.ship])
+    if args.dead_reckoning:
+        from dead_reckoning import DeadReckoning
+        monitor.dead_reckoning = DeadReckoning()
+    monitor.set_location_rate(args.location_rate)
+    if args.record:
+        from flight_recorder import FlightRecorder
+        monitor.recorder = FlightRecorder(args.record)
+    if args.replay:
+        from flight_recorder import ReplaySource
+        ReplaySource(args.replay, monitor, args.replay_speed, args.replay_start).start()
+
+    if args.metrics_port:
+        from telemetry_stats import MetricsServer
+        MetricsServer(monitor, args.metrics_port)
+    return monitor
+
+def run_headless(args, timeline, session_manager, roc_controller, handover, screening, output):
+    from headless import HeadlessRoc, parse_address
 
-    # Initialize GUI (clicky thing for human operator)
-    gui = RocGui(roc_controller)
+    state_socket = parse_address(args.state_socket) if args.state_socket else None
+    headless = HeadlessRoc(roc_controller, output, fleet=args.fleet, frame_rate=args.fps, state_socket=state_socket,
+                           handover=handover, screening=screening)
+    timeline.subscribe(headless.on_startup)
 
-    # Add extra callbacks to update GUI components from telemetry monitor
+    # Unlike the GUI, the headless runtime emits the state of every vessel in fleet mode
+    headless.monitor = start_monitor(args, timeline, session_manager, with_screening(headless.callbacks(), screening))
+
+    # !! This blocks and must thus be done last !!
+    headless.run()
+
+def run_ingest(args, timeline, session_manager, roc_controller, handover):
+    from ingest import IngestServer
+
+    server = IngestServer(roc_controller, args.ingest_only, fleet=args.fleet, handover=handover)
+    # Like headless, the state of every vessel is kept in fleet mode
+    server.monitor = start_monitor(args, timeline, session_manager, server.callbacks())
+
+    # !! This blocks and must thus be done last !!
+    server.run()
+
+def run_split(args):
+    '''
+    Start the ingest half in a child process, and a GUI viewer of it in this one.
+    '''
+    address = os.path.join(tempfile.mkdtemp(prefix="roc-"), "ingest.sock")
+    ingest_args = argparse.Namespace(**{**vars(args), "split": False, "ingest_only": address})
+
+    # Spawned rather than forked, zenoh sessions don't survive a fork
+    ingest = multiprocessing.get_context("spawn").Process(target=run, args=(ingest_args,), name="ingest")
+    ingest.start()
+    try:
+        run_viewer(args, address, shared_tracker=True)
+    finally:
+        ingest.terminate()
+        ingest.join()
+        shutil.rmtree(os.path.dirname(address), ignore_errors=True)
+
+def run_viewer(args, address, shared_tracker=False):
+    '''
+    Run a GUI showing the state of an ingest process, sending it the operator's commands.
+    '''
+    from ingest import IngestClient
+    from roc_gui import RocGui
+
+    start_profiler(args)
+    timeline = StartupTimeline(STARTED)
+    client = IngestClient(address, shared_tracker=shared_tracker)
+    timeline.mark("ingest process connected")
+
+    gui = RocGui(client, frame_rate=args.fps, tile_db=args.tile_db, offline=args.offline, timeline=timeline)
+    timeline.mark("GUI window created")
+    gui.update_sources.append(lambda: client.poll(gui.slots, gui.field_renderers))
+
+    # !! This blocks and must thus be done last !!
+    gui.mainloop()
+
+def run_gui(args, timeline, session_manager, roc_controller, handover, screening):
+    from roc_gui import RocGui
+    timeline.mark("GUI imported")
+
+    # Initialize GUI (clicky thing for human operator). This only creates the window, its panels
+    # are built from the event loop while telemetry is already coming in.
+    gui = RocGui(roc_controller, frame_rate=args.fps, tile_db=args.tile_db, offline=args.offline,
+                 timeline=timeline, handover=handover, screening=screening)
+    timeline.mark("GUI window created")
+
+    # Add extra callbacks to update GUI components from telemetry monitor.
+    # These are called on zenoh threads, the GUI renders them on its own refresh tick.
     callbacks = {}
     callbacks['handle_location'] = gui.update_map_position
-    callbacks['handle_cog'] = gui.update_cog_out
-    callbacks['handle_sog'] = gui.update_sog_out
+    # The controller matches COG/SOG telemetry against the setpoints it sent
+    callbacks['handle_cog'] = chain(gui.update_cog_out, roc_controller.observe_cog)
+    callbacks['handle_sog'] = chain(gui.update_sog_out, roc_controller.observe_sog)
     callbacks['handle_name'] = gui.update_ship_name
     callbacks['handle_mmsi'] = gui.update_mmsi
     callbacks['handle_imo'] = gui.update_imo
     callbacks['handle_remote_status'] = gui.update_remote_status
-    callbacks['handle_remote_time'] = gui.update_remote_time
     callbacks['handle_roc_status'] = gui.update_roc_status
-    callbacks['handle_handover_request'] = gui.on_handover_request
-    callbacks['handle_handover_state'] = gui.on_handover_state
 
-    # Initialize telemetry monitor with added callbacks to GUI
-    # (thing receiving Zenoh/keelson messages from ship)
-    monitor = ShipTelemetryMonitor(args.ship, callbacks)
-    gui.monitor = monitor
+    # In fleet mode the monitor tracks all vessels, but the GUI only shows the one we control
+    if args.fleet:
+        callbacks = {name: only_vessel(args.ship, callback) for name, callback in callbacks.items()}
+        # ... and the positions of all others on the map
+        callbacks['handle_location'] = chain(callbacks['handle_location'], gui.update_fleet_position)
+
+    # The handover engine tracks every vessel, the GUI shows what it reports for ours
+    handover_callbacks = {
+        'handle_remote_time': handover.on_remote_time,
+        'handle_handover_request': handover.on_request,
+        'handle_handover_state': handover.on_state,
+    }
+    if not args.fleet:
+        handover_callbacks = {name: for_vessel(args.ship, callback) for name, callback in handover_callbacks.items()}
+    callbacks.update(handover_callbacks)
+    with_screening(callbacks, screening)
+
+    gui.monitor = start_monitor(args, timeline, session_manager, callbacks)
 
     # !! This blocks and must thus be done last !!
     gui.mainloop()
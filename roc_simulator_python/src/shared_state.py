@@ -0,0 +1,278 @@
+'''
+This module contains the shared memory state snapshot used to split ingest and GUI into separate
+processes: the ingest process writes the latest value of every field of every vessel into a block
+of fixed layout, and any number of viewer processes read it whenever they like, without locks and
+without ever blocking the writer.
+
+Layout (little endian):
+
+    header:  magic (8s), layout version (u32), max vessels (u32), vessel count (u32), record size (u32)
+    records: one per vessel, in the order vessels were first seen:
+             version (u64), vessel id (32s, utf-8, NUL padded), then per field of STATE_FIELDS:
+             received time in ns (i64, 0 if never received), then the value:
+             "f64"/"i64" fields: count 8 byte numbers; "bytes" fields: length (u32) and size bytes
+
+Every record is guarded by a seqlock: the writer makes the version odd before changing the record
+and even again after, and a reader retries its copy of the record until it read the same even
+version before and after copying. There is a single writer per block (writes are serialized by a
+lock in the ingest process). The protocol relies on 8 byte aligned stores being atomic and stores
+becoming visible in order, which holds on x86 and, for the purposes of a display, on ARM.
+'''
+
+import struct
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+# Magic and version of the block layout, checked by readers
+STATE_MAGIC = b"ROCSTATE"
+STATE_LAYOUT_VERSION = 1
+
+# Default number of vessels a block has room for
+DEFAULT_STATE_VESSELS = 1024
+
+# Longest vessel id (bytes)
+VESSEL_ID_SIZE = 32
+
+# Give up reading a record that keeps changing for this long, e.g. a writer died mid-write (time in seconds)
+SEQLOCK_TIMEOUT = 1.0
+
+# Fields kept per vessel: (field, kind, count for numbers or maximum size in bytes). These are the
+# VesselState fields, plus "handover" (HandoverStatus as JSON) and "countdown" (seconds until the
+# safety gate) from the handover engine.
+STATE_FIELDS = [
+    ("location", "f64", 2),
+    ("cog", "f64", 1),
+    ("sog", "f64", 1),
+    ("remote_time", "f64", 1),
+    ("countdown", "f64", 1),
+    ("mmsi", "i64", 1),
+    ("imo", "i64", 1),
+    ("name", "bytes", 128),
+    ("nav_status", "bytes", 64),
+    ("remote_status", "bytes", 128),
+    ("roc_status", "bytes", 256), # Serialized ROCStatus
+    ("handover_request", "bytes", 512),
+    ("handover_state", "bytes", 512),
+    ("handover", "bytes", 512),
+]
+
+HEADER = struct.Struct("<8sIIII")
+VERSION = struct.Struct("<Q")
+VESSEL_ID = struct.Struct(f"<{VESSEL_ID_SIZE}s")
+RECEIVED = struct.Struct("<q")
+LENGTH = struct.Struct("<I")
+
+
+class _FieldLayout:
+    __slots__ = ("name", "kind", "offset", "value", "size")
+
+    def __init__(self, name, kind, offset, count):
+        self.name = name
+        self.kind = kind
+        self.offset = offset # Of the receive time, relative to the record
+        if kind == "bytes":
+            self.value = LENGTH
+            self.size = count
+        else:
+            self.value = struct.Struct(f"<{count}{'d' if kind == 'f64' else 'q'}")
+            self.size = 0
+
+
+def _layout():
+    '''
+    (field name -> _FieldLayout, record size), with every field 8 byte aligned.
+    '''
+    fields = {}
+    offset = VERSION.size + VESSEL_ID.size
+    for name, kind, count in STATE_FIELDS:
+        field = _FieldLayout(name, kind, offset, count)
+        fields[name] = field
+        offset += RECEIVED.size + field.value.size + field.size
+        offset = (offset + 7) // 8 * 8
+    return fields, offset
+
+
+class SharedStateWriter:
+    def __init__(self, max_vessels=DEFAULT_STATE_VESSELS):
+        '''
+        Create a new block for max_vessels vessels. Its name, for readers, is in self.name.
+        '''
+        self.fields, self.record_size = _layout()
+        self.max_vessels = max_vessels
+        self.shm = shared_memory.SharedMemory(create=True, size=HEADER.size + max_vessels * self.record_size)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        HEADER.pack_into(self.buf, 0, STATE_MAGIC, STATE_LAYOUT_VERSION, max_vessels, 0, self.record_size)
+
+        self.lock = threading.Lock()
+        self.records = {} # Vessel id -> record offset
+        self.dropped = 0 # Writes that didn't fit (too many vessels, value too long)
+
+    def write(self, vessel_id, field, value, received_ns=None):
+        '''
+        Store the latest value of a field of a vessel. Called from zenoh threads.
+        '''
+        layout = self.fields.get(field)
+        if layout is None:
+            return
+        received_ns = received_ns or time.time_ns()
+        if layout.kind == "bytes":
+            data = value.encode() if isinstance(value, str) else bytes(value)
+            if len(data) > layout.size:
+                self.dropped += 1
+                return
+        else:
+            data = value if isinstance(value, tuple) else (value,)
+
+        with self.lock:
+            offset = self.records.get(vessel_id)
+            if offset is None:
+                offset = self._add_vessel(vessel_id)
+                if offset is None:
+                    self.dropped += 1
+                    return
+
+            buf = self.buf
+            version = VERSION.unpack_from(buf, offset)[0] + 1
+            VERSION.pack_into(buf, offset, version) # Odd: record changing
+            at = offset + layout.offset
+            RECEIVED.pack_into(buf, at, received_ns)
+            at += RECEIVED.size
+            if layout.kind == "bytes":
+                LENGTH.pack_into(buf, at, len(data))
+                at += LENGTH.size
+                buf[at:at + len(data)] = data
+            else:
+                layout.value.pack_into(buf, at, *data)
+            VERSION.pack_into(buf, offset, version + 1) # Even: record consistent
+
+    def _add_vessel(self, vessel_id):
+        encoded = vessel_id.encode()
+        count = len(self.records)
+        if count == self.max_vessels or len(encoded) > VESSEL_ID_SIZE:
+            return None
+        offset = HEADER.size + count * self.record_size
+        VESSEL_ID.pack_into(self.buf, offset + VERSION.size, encoded)
+        self.records[vessel_id] = offset
+        # Published last, so readers never see a vessel without its id
+        HEADER.pack_into(self.buf, 0, STATE_MAGIC, STATE_LAYOUT_VERSION, self.max_vessels, count + 1,
+                         self.record_size)
+        return offset
+
+    def close(self):
+        '''
+        Release and remove the block. Readers that have it open keep their mapping.
+        '''
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedStateReader:
+    def __init__(self, name, shared_tracker=False):
+        '''
+        Open the block written by a SharedStateWriter under name. Set shared_tracker when the
+        writer is a multiprocessing child of this process, which shares this process' resource
+        tracker.
+        '''
+        self.shm = shared_memory.SharedMemory(name=name)
+        # Python < 3.13 registers attached blocks too, and would remove the block when this
+        # process exits, although the writer owns it. A shared tracker only has the writer's entry.
+        if not shared_tracker:
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.buf = self.shm.buf
+
+        magic, layout_version, self.max_vessels, _, record_size = HEADER.unpack_from(self.buf, 0)
+        self.fields, self.record_size = _layout()
+        if magic != STATE_MAGIC or layout_version != STATE_LAYOUT_VERSION or record_size != self.record_size:
+            self.shm.close()
+            raise ValueError(f"Shared state block {name} has an incompatible layout")
+
+        self.records = {} # Vessel id -> record offset, of the vessels seen so far
+        self.seen = {} # (vessel id, field) -> receive time of the last value returned by changes()
+        self.retries = 0
+
+    def vessels(self):
+        '''
+        Ids of all vessels in the block.
+        '''
+        count = HEADER.unpack_from(self.buf, 0)[3]
+        for index in range(len(self.records), count):
+            offset = HEADER.size + index * self.record_size
+            vessel_id = VESSEL_ID.unpack_from(self.buf, offset + VERSION.size)[0].rstrip(b"\0").decode()
+            self.records[vessel_id] = offset
+        return list(self.records)
+
+    def snapshot(self, vessel_id):
+        '''
+        Consistent copy of a vessel's record, or None if the vessel isn't in the block (yet).
+        '''
+        offset = self.records.get(vessel_id)
+        if offset is None:
+            self.vessels()
+            offset = self.records.get(vessel_id)
+            if offset is None:
+                return None
+
+        buf = self.buf
+        deadline = None
+        while True:
+            before = VERSION.unpack_from(buf, offset)[0]
+            if not before & 1:
+                record = bytes(buf[offset:offset + self.record_size])
+                if VERSION.unpack_from(buf, offset)[0] == before:
+                    return record
+            self.retries += 1
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + SEQLOCK_TIMEOUT
+            elif now > deadline:
+                break
+            time.sleep(0) # Let the writer finish
+        raise TimeoutError(f"Record of {vessel_id} never became consistent")
+
+    def value(self, record, field):
+        '''
+        (receive time in ns, value) of a field in a record from snapshot(). The receive time is 0
+        for a field never written. Values of "f64" and "i64" fields with a count of 1 are numbers,
+        others tuples, "bytes" values are bytes.
+        '''
+        layout = self.fields[field]
+        at = layout.offset
+        received_ns = RECEIVED.unpack_from(record, at)[0]
+        at += RECEIVED.size
+        if layout.kind == "bytes":
+            length = LENGTH.unpack_from(record, at)[0]
+            at += LENGTH.size
+            return received_ns, record[at:at + length]
+        value = layout.value.unpack_from(record, at)
+        return received_ns, value[0] if len(value) == 1 else value
+
+    def changes(self, vessel_id, fields=None):
+        '''
+        {field: value} of the fields of a vessel written since the last call (all fields, or the
+        given ones). Given fields the block doesn't hold, like those only a GUI renders, are skipped.
+        '''
+        record = self.snapshot(vessel_id)
+        if record is None:
+            return {}
+        changed = {}
+        for field in self.fields if fields is None else fields:
+            if field not in self.fields:
+                continue
+            received_ns, value = self.value(record, field)
+            if received_ns and self.seen.get((vessel_id, field)) != received_ns:
+                self.seen[(vessel_id, field)] = received_ns
+                changed[field] = value
+        return changed
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
@@ -4,200 +4,438 @@ with the addition of accepting extra arbitrary callback methods in the construct
 
 The intent of the module is to act as a listener for Zenoh/keelson messages received from the ship
 simulator and then react by triggering various handlers as appropriate.
+
+In fleet mode a single monitor watches every vessel publishing under the base path, using one
+wildcard subscription per key space instead of one subscriber per topic and ship.
+
+Every topic is described by one row of TOPICS. At construction the rows are resolved into routes
+(message type, value extractor, state field, callback), so handling a sample is a single table
+lookup, and decode errors are counted per topic and only reported periodically.
+
+A payload is copied out of zenoh once, as bytes (ZBytes exposes no buffer to view instead), and
+that copy is all the recorder and decoders see. Rather than parsing the keelson Envelope and then
+its payload from a copy, each message type is parsed straight from the received bytes as the
+payload field of an Envelope twin declaring that field as the message (see enveloped()), and raw
+topics are converted straight from the bytes. Decoded messages are reused, but only for
+DECODE_MESSAGE_REUSE parses, as a reused message keeps all the memory it ever parsed into.
 '''
 
 import sys
+import threading
 import time
-import zenoh
 from datetime import datetime
 
-from keelson import uncover, construct_pubsub_key
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from keelson.Envelope_pb2 import Envelope
 from keelson.payloads.foxglove.LocationFix_pb2 import LocationFix
 from keelson.payloads.Primitives_pb2 import TimestampedFloat, TimestampedInt, TimestampedString
 from keelson.payloads.VesselNavStatus_pb2 import VesselNavStatus
 from keelson.payloads.ROCStatus_pb2 import ROCStatus
 
-
-class ShipTelemetryMonitor:
-    def __init__(self, ship_name, extra_callbacks):
-        self.ship = ship_name
-        self.extra_callbacks = extra_callbacks
-
-        # Latest telemetry
+from telemetry_stats import TelemetryStats
+from telemetry_stream import DEFAULT_STREAM_MAXSIZE, TelemetryStream, TelemetryUpdate
+from zenoh_session import SessionManager
+
+
+BASE_PATH = "rise/@v0"
+
+# Report decode errors of a topic at most this often (time in seconds), counting the rest
+DECODE_ERROR_REPORT_INTERVAL = 10.0
+
+# Field number of the enclosed payload in a keelson Envelope (field 1 is its enclosed_at timestamp)
+ENVELOPE_PAYLOAD_FIELD = 2
+
+# Package of the Envelope twins made by enveloped()
+ENVELOPED_PACKAGE = "roc_enveloped"
+
+# Messages reused for decoding are replaced after this many parses, as protobuf
+# (upb) only frees what a message parsed into when the message itself is freed
+DECODE_MESSAGE_REUSE = 256
+
+_enveloped_classes = {}
+_enveloped_lock = threading.Lock()
+
+
+def enveloped(cls):
+    '''
+    Message class of a keelson Envelope enclosing a cls message, i.e. an Envelope whose payload
+    field is declared as cls instead of bytes. Both are length delimited on the wire, so a
+    serialized Envelope parses into it in a single pass, with the enclosed message as its payload
+    and no copy of the payload bytes. Made once per cls.
+    '''
+    with _enveloped_lock:
+        enveloped_cls = _enveloped_classes.get(cls)
+        if enveloped_cls is None:
+            envelope = Envelope.DESCRIPTOR
+            name = cls.DESCRIPTOR.full_name.replace(".", "_")
+            file_proto = descriptor_pb2.FileDescriptorProto(
+                name=f"{ENVELOPED_PACKAGE}/{name}.proto", package=ENVELOPED_PACKAGE, syntax="proto3")
+            file_proto.dependency.extend(
+                dict.fromkeys([dep.name for dep in envelope.file.dependencies] + [cls.DESCRIPTOR.file.name]))
+            message_proto = file_proto.message_type.add()
+            envelope.CopyToProto(message_proto)
+            message_proto.name = name
+            for field in message_proto.field:
+                if field.number == ENVELOPE_PAYLOAD_FIELD:
+                    field.type = descriptor_pb2.FieldDescriptorProto.TYPE_MESSAGE
+                    field.type_name = f".{cls.DESCRIPTOR.full_name}"
+
+            pool = descriptor_pool.Default()
+            pool.AddSerializedFile(file_proto.SerializeToString())
+            descriptor = pool.FindMessageTypeByName(f"{ENVELOPED_PACKAGE}.{name}")
+            enveloped_cls = _enveloped_classes[cls] = message_factory.GetMessageClass(descriptor)
+        return enveloped_cls
+
+
+def _text(payload):
+    return payload.decode()
+
+
+def _copy_of(cls):
+    '''
+    Extractor keeping a copy of the whole message, since decoded messages are reused.
+    '''
+    def extract(msg):
+        value = cls()
+        value.CopyFrom(msg)
+        return value
+    return extract
+
+
+# Everything the monitor handles, one row per topic, where the topic is the part of the key after
+# "<base>/<vessel>/":
+# (topic, message type or None for RAW zenoh strings, value extractor, VesselState field, callback name)
+# The extractor of a RAW topic is given the payload bytes.
+TOPICS = [
+    ("pubsub/location_fix/gnss/0", LocationFix,
+     lambda msg: (msg.latitude, msg.longitude), "location", 'handle_location'),
+    ("pubsub/course_over_ground_deg/gnss/0", TimestampedFloat,
+     lambda msg: msg.value, "cog", 'handle_cog'),
+    ("pubsub/speed_over_ground_knots/gnss/0", TimestampedFloat,
+     lambda msg: msg.value, "sog", 'handle_sog'),
+    ("pubsub/name/registrar/0", TimestampedString,
+     lambda msg: msg.value, "name", 'handle_name'),
+    ("pubsub/mmsi_number/registrar/0", TimestampedInt,
+     lambda msg: msg.value, "mmsi", 'handle_mmsi'),
+    ("pubsub/imo_number/registrar/0", TimestampedInt,
+     lambda msg: msg.value, "imo", 'handle_imo'),
+    ("pubsub/nav_status/bridge/0", VesselNavStatus,
+     lambda msg: VesselNavStatus.NavigationStatus.Name(msg.navigation_status), "nav_status", 'handle_nav_status'),
+    ("pubsub/roc_status/bridge/0", ROCStatus,
+     _copy_of(ROCStatus), "roc_status", 'handle_roc_status'),
+    ("pubsub/remote_status/bridge/0", None,
+     _text, "remote_status", 'handle_remote_status'),
+    ("pubsub/remote_time/bridge/1", None,
+     float, "remote_time", 'handle_remote_time'),
+    ("handover/request", None,
+     _text, "handover_request", 'handle_handover_request'),
+    ("handover/state", None,
+     _text, "handover_state", 'handle_handover_state'),
+]
+
+
+class _Route:
+    '''
+    Resolved TOPICS row, plus the decode error bookkeeping of its topic.
+    '''
+    __slots__ = ("topic", "message_cls", "extractor", "field", "notify", "fleet_key",
+                 "errors", "unreported_errors", "last_error_report")
+
+    def __init__(self, topic, message_cls, extractor, field, notify):
+        self.topic = topic
+        self.fleet_key = f"{BASE_PATH}/*/{topic}" # Statistics key of the topic for other vessels
+        self.message_cls = message_cls
+        self.extractor = extractor
+        self.field = field
+        self.notify = notify
+        self.errors = 0
+        self.unreported_errors = 0
+        self.last_error_report = 0.0
+
+
+class _DecodeBuffers(threading.local):
+    '''
+    Envelope twins (see enveloped()) reused for decoding, one per message type and thread, as
+    samples may arrive on several zenoh threads at once.
+    '''
+    def __init__(self):
+        self.messages = {} # Message type -> [Envelope twin, parses left before it is replaced]
+
+
+class VesselState:
+    '''
+    Latest telemetry received from a single vessel.
+    '''
+    def __init__(self, vessel_id):
+        self.vessel_id = vessel_id
+        self.name = None
         self.location = None
         self.cog = None
         self.sog = None
         self.remote_status = None
         self.remote_time = None
         self.nav_status = None
+        self.roc_status = None
         self.mmsi = None
         self.imo = None
+        self.handover_request = None
+        self.handover_state = None
 
-        cfg = zenoh.Config()
-        self.session = zenoh.open(cfg)
-
-        self.base = "rise/@v0"
-
-        # ----------- ALL SUBSCRIPTIONS NOW USING construct_pubsub_key() -------------
-
-        self.session.declare_subscriber(
-            construct_pubsub_key(self.base, self.ship, "location_fix", "gnss/0"),
-            self._handle_location)
-
-        self.session.declare_subscriber(
-            construct_pubsub_key(self.base, self.ship, "course_over_ground_deg", "gnss/0"),
-            self._handle_cog)
-
-        self.session.declare_subscriber(
-            construct_pubsub_key(self.base, self.ship, "speed_over_ground_knots", "gnss/0"),
-            self._handle_sog)
-
-        self.session.declare_subscriber(
-            construct_pubsub_key(self.base, self.ship, "name", "registrar/0"),
-            self._handle_name)
-
-        self.session.declare_subscriber(
-            construct_pubsub_key(self.base, self.ship, "mmsi_number", "registrar/0"),
-            self._handle_mmsi)
-
-        self.session.declare_subscriber(
-            construct_pubsub_key(self.base, self.ship, "imo_number", "registrar/0"),
-            self._handle_imo)
-
-        self.session.declare_subscriber(
-            construct_pubsub_key(self.base, self.ship, "nav_status", "bridge/0"),
-            self._handle_nav_status)
 
-        self.session.declare_subscriber(
-            construct_pubsub_key(self.base, self.ship, "roc_status", "bridge/0"),
-            self._handle_roc_status)
+def _latest(field):
+    '''
+    Expose a field of the monitored ship's VesselState as a monitor attribute,
+    so single ship code can keep reading e.g. monitor.cog.
+    '''
+    return property(lambda self: getattr(self.vessels.get(self.ship), field, None))
 
-        # RAW zenoh strings (not keelson)
-        self.session.declare_subscriber(
-            f"{self.base}/{self.ship}/pubsub/remote_status/bridge/0",
-            self._handle_remote_status)
 
-        self.session.declare_subscriber(
-            f"{self.base}/{self.ship}/pubsub/remote_time/bridge/1",
-            self._handle_remote_time)
-
-        self.session.declare_subscriber(
-            f"{self.base}/{self.ship}/handover/request",
-            self._handle_handover_request)
-
-        self.session.declare_subscriber(
-            f"{self.base}/{self.ship}/handover/state",
-            self._handle_handover_state)
+class ShipTelemetryMonitor:
+    location = _latest("location")
+    cog = _latest("cog")
+    sog = _latest("sog")
+    remote_status = _latest("remote_status")
+    remote_time = _latest("remote_time")
+    nav_status = _latest("nav_status")
+    roc_status = _latest("roc_status")
+    mmsi = _latest("mmsi")
+    imo = _latest("imo")
+    handover_request = _latest("handover_request")
+    handover_state = _latest("handover_state")
+
+    def __init__(self, ship_name, extra_callbacks, fleet=False, session_manager=None, live=True):
+        '''
+        Monitor telemetry from ship_name, or from every vessel under BASE_PATH if
+        fleet is set. In fleet mode the extra callbacks receive the vessel id as
+        their first argument.
+
+        If live is not set, nothing is subscribed and samples only arrive through
+        on_sample(), e.g. from a flight_recorder.ReplaySource.
+        '''
+        self.ship = ship_name
+        self.fleet = fleet
+        self.extra_callbacks = extra_callbacks
+        self.live = live
+
+        # Latest telemetry, per vessel id
+        self.vessels = {}
+
+        # If set, every received sample is written to this flight_recorder.FlightRecorder
+        self.recorder = None
+
+        # If set, numeric telemetry is also kept in this history.HistoryStore
+        self.history = None
+
+        # If set, positions, COGs and SOGs are also fed to this dead_reckoning.DeadReckoning
+        self.dead_reckoning = None
+
+        # If set, location fixes arriving sooner than this after the last one taken from the same
+        # vessel are dropped before decoding (time in ns), see set_location_rate()
+        self.location_interval_ns = 0
+        self._location_taken_ns = {} # Vessel id -> receive time of the last location fix taken
+
+        # Latency, rate and jitter per key expression of our ship, and per topic for all other
+        # vessels together (under "<base>/*/<topic>"), so their number doesn't grow with the fleet
+        self.stats = TelemetryStats()
+
+        # Set once the first sample has been processed
+        self.first_sample = threading.Event()
+
+        self.base = BASE_PATH
+
+        # Samples are routed on everything after "<base>/<vessel>/", e.g.
+        # "pubsub/location_fix/gnss/0" or "handover/request".
+        self._routes = {
+            topic: _Route(topic, message_cls, extractor, field, self._resolve_callback(callback_name))
+            for topic, message_cls, extractor, field, callback_name in TOPICS
+        }
+        self._buffers = _DecodeBuffers()
+        for route in self._routes.values():
+            if route.message_cls:
+                enveloped(route.message_cls)
+        self._field_topics = {field: topic for topic, _, _, field, _ in TOPICS}
+
+        # Open asyncio streams, replaced rather than mutated so on_sample can iterate without locking
+        self._streams = ()
+        self._streams_lock = threading.Lock()
+
+        # Two wildcard subscriptions cover every topic of every monitored vessel
+        vessel = "*" if fleet else self.ship
+        self.key_exprs = [f"{self.base}/{vessel}/pubsub/**", f"{self.base}/{vessel}/handover/*"]
+        self.session_manager = None
+        self.session = None
+        if live:
+            # Share the session with the rest of the process if given one
+            self.session_manager = session_manager or SessionManager()
+            self.session = self.session_manager.acquire()
+            for key_expr in self.key_exprs:
+                self.session_manager.declare_subscriber(key_expr, self.on_sample)
 
         print(f"{self.__class__.__name__} initialized.")
 
+    def close(self):
+        '''
+        Stop receiving telemetry and release the zenoh session.
+        '''
+        if self.session_manager:
+            for key_expr in self.key_exprs:
+                self.session_manager.undeclare_subscriber(key_expr, self.on_sample)
+            self.session_manager.release()
+        if self.recorder:
+            self.recorder.close()
+        for stream in self._streams:
+            stream.close()
+
+    def _resolve_callback(self, name):
+        '''
+        Look up the extra callback registered under name, adapted to be called as
+        notify(vessel_id, value...). Returns None if there is none.
+        '''
+        callback = self.extra_callbacks.get(name)
+        if callback is None or self.fleet:
+            return callback
+        return lambda vessel_id, *args: callback(*args)
+
+    def on_sample(self, sample):
+        '''
+        Route a sample (received live or replayed) to its handler based on the vessel id and topic
+        in its key.
+        '''
+        received_ns = time.time_ns()
+        key_expr = str(sample.key_expr)
+        # The only copy of the payload
+        payload = sample.payload.to_bytes()
+        if self.recorder:
+            self.recorder.record(key_expr, payload)
+
+        vessel_id, _, topic = key_expr[len(self.base) + 1:].partition("/")
+        if not self.fleet and vessel_id != self.ship:
+            # Replayed fleet recordings hold every vessel, live subscriptions only ours
+            return
+        route = self._routes.get(topic)
+        if route is None:
+            return
+        if route.field == "location" and self.location_interval_ns:
+            taken_ns = self._location_taken_ns.get(vessel_id)
+            if taken_ns is not None and received_ns - taken_ns < self.location_interval_ns:
+                return
+            self._location_taken_ns[vessel_id] = received_ns
 
-    # -------------------------------------------------------------------
-    # DECODING HELPERS
-    # -------------------------------------------------------------------
-
-    def _decode(self, sample, cls):
         try:
-            _, _, payload = uncover(sample.payload.to_bytes())
-            return cls.FromString(payload)
+            if route.message_cls is None:
+                value = route.extractor(payload)
+                published_ns = None
+            else:
+                msg = self._decode(payload, route.message_cls)
+                value = route.extractor(msg)
+                # Every keelson payload we handle carries the publisher's timestamp
+                published_ns = msg.timestamp.ToNanoseconds()
         except Exception as e:
-            print(f"[WARN] Decode failed for {cls.__name__}: {e}")
-            return None
+            self._decode_failed(route, e)
+            return
+
+        stats_key = key_expr if vessel_id == self.ship else route.fleet_key
+        self.stats.topic(stats_key).record_receive(received_ns, published_ns)
+
+        vessel = self.vessels.get(vessel_id)
+        if vessel is None:
+            vessel = self.vessels.setdefault(vessel_id, VesselState(vessel_id))
+        setattr(vessel, route.field, value)
+        if self.history:
+            self.history.record(vessel_id, route.field, received_ns, value)
+        if self.dead_reckoning:
+            self.dead_reckoning.record(vessel_id, route.field, received_ns, value)
+
+        if route.notify:
+            if route.field == "location":
+                route.notify(vessel_id, *value)
+            else:
+                route.notify(vessel_id, value)
+
+        if self._streams:
+            update = TelemetryUpdate(vessel_id, route.field, value, received_ns)
+            for stream in self._streams:
+                if stream.wants(vessel_id, route.field):
+                    stream.offer(update)
+
+        if not self.first_sample.is_set():
+            self.first_sample.set()
+
+    def set_location_rate(self, rate):
+        '''
+        Take at most rate location fixes per second from each vessel, None or 0 to take them all.
+        The limit is kept per vessel, so in fleet mode every vessel still gets its share.
+        '''
+        self.location_interval_ns = int(1e9 / rate) if rate else 0
+
+    def stream(self, topics=None, vessels=None, maxsize=DEFAULT_STREAM_MAXSIZE, policy="drop_oldest"):
+        '''
+        Open an asyncio stream of TelemetryUpdates, for use as "async for update in monitor.stream()"
+        from a coroutine. topics are VesselState fields (e.g. "cog") or topics (e.g.
+        "pubsub/course_over_ground_deg/gnss/0"), None for all. See telemetry_stream for the policies.
+        '''
+        fields = None
+        if topics is not None:
+            fields = [self._routes[topic].field if topic in self._routes else topic for topic in topics]
+            unknown = set(fields) - set(self._field_topics)
+            if unknown:
+                raise ValueError(f"Unknown telemetry topics: {sorted(unknown)}")
+
+        stream = TelemetryStream(fields, vessels, maxsize, policy, on_close=self._remove_stream)
+        with self._streams_lock:
+            self._streams = self._streams + (stream,)
+        return stream
+
+    def _remove_stream(self, stream):
+        with self._streams_lock:
+            self._streams = tuple(s for s in self._streams if s is not stream)
+
+    def record_render(self, vessel_id, field, received_ns):
+        '''
+        Record that the GUI has now shown the VesselState field of a vessel received at received_ns.
+        '''
+        topic = self._field_topics.get(field)
+        if topic:
+            vessel = vessel_id if vessel_id == self.ship else "*"
+            self.stats.topic(f"{self.base}/{vessel}/{topic}").record_render(received_ns, time.time_ns())
+
+    def decode_errors(self):
+        '''
+        Number of samples that failed to decode so far, per topic.
+        '''
+        return {route.topic: route.errors for route in self._routes.values() if route.errors}
 
 
     # -------------------------------------------------------------------
-    # MESSAGE CALLBACKS
+    # DECODING HELPERS
     # -------------------------------------------------------------------
 
-    def _handle_location(self, sample):
-        msg = self._decode(sample, LocationFix)
-        if msg:
-            self.location = (msg.latitude, msg.longitude)
-            if 'handle_location' in self.extra_callbacks:
-                self.extra_callbacks['handle_location'](self.location[0], self.location[1])
-
-    def _handle_cog(self, sample):
-        msg = self._decode(sample, TimestampedFloat)
-        if msg:
-            self.cog = msg.value
-            if 'handle_cog' in self.extra_callbacks:
-                self.extra_callbacks['handle_cog'](self.cog)
-
-    def _handle_sog(self, sample):
-        msg = self._decode(sample, TimestampedFloat)
-        if msg:
-            self.sog = msg.value
-            if 'handle_sog' in self.extra_callbacks:
-                self.extra_callbacks['handle_sog'](self.sog)
-
-    def _handle_name(self, sample):
-        msg = self._decode(sample, TimestampedString)
-        if msg:
-            if 'handle_name' in self.extra_callbacks:
-                self.extra_callbacks['handle_name'](msg.value)
-
-    def _handle_mmsi(self, sample):
-        msg = self._decode(sample, TimestampedInt)
-        if msg:
-            self.mmsi = msg.value
-            if 'handle_mmsi' in self.extra_callbacks:
-                self.extra_callbacks['handle_mmsi'](self.mmsi)
-
-    def _handle_imo(self, sample):
-        msg = self._decode(sample, TimestampedInt)
-        if msg:
-            self.imo = msg.value
-            if 'handle_imo' in self.extra_callbacks:
-                self.extra_callbacks['handle_imo'](self.imo)
-
-    def _handle_nav_status(self, sample):
-        msg = self._decode(sample, VesselNavStatus)
-        if msg:
-            self.nav_status = VesselNavStatus.NavigationStatus.Name(msg.navigation_status)
-            if 'handle_nav_status' in self.extra_callbacks:
-                self.extra_callbacks['handle_nav_status'](self.nav_status)
-
-    def _handle_roc_status(self, sample):
-        msg = self._decode(sample, ROCStatus)
-        if msg:
-            self.roc_status = msg
-            if 'handle_roc_status' in self.extra_callbacks:
-                self.extra_callbacks['handle_roc_status'](self.roc_status)
-
-    def _handle_remote_status(self, sample):
-        try:
-            self.remote_status = sample.payload.to_string()
-            if 'handle_remote_status' in self.extra_callbacks:
-                self.extra_callbacks['handle_remote_status'](self.remote_status)
-        except:
-            self.remote_status = None
-
-    def _handle_remote_time(self, sample):
-        try:
-            self.remote_time = float(sample.payload.to_string())
-            if 'handle_remote_time' in self.extra_callbacks:
-                self.extra_callbacks['handle_remote_time'](self.remote_time)
-        except:
-            self.remote_time = None
-
-    def _handle_handover_request(self, sample):
-        try:
-            self.handover_request = sample.payload.to_string()
-            print(self.handover_request)
-            if 'handle_handover_request' in self.extra_callbacks:
-                self.extra_callbacks['handle_handover_request'](self.handover_request)
-        except:
-            self.handover_request = None
-
-    def _handle_handover_state(self, sample):
-        try:
-            self.handover_state = sample.payload.to_string()
-            print(self.handover_state)
-            if 'handle_handover_state' in self.extra_callbacks:
-                self.extra_callbacks['handle_handover_state'](self.handover_state)
-        except:
-            self.handover_state = None
-
+    def _decode(self, payload, cls):
+        '''
+        Decode a keelson enclosed message of type cls from the payload bytes. The returned message
+        is reused by the next call on the same thread, so extract what you need from it before that.
+        '''
+        messages = self._buffers.messages
+        entry = messages.get(cls)
+        if entry is None or not entry[1]:
+            entry = messages[cls] = [enveloped(cls)(), DECODE_MESSAGE_REUSE]
+        entry[1] -= 1
+        envelope = entry[0]
+        envelope.ParseFromString(payload)
+        return envelope.payload
+
+    def _decode_failed(self, route, error):
+        '''
+        Count a decode error, only printing a summary every DECODE_ERROR_REPORT_INTERVAL seconds
+        so a broken topic can't slow down ingest with console output.
+        '''
+        route.errors += 1
+        route.unreported_errors += 1
+        now = time.monotonic()
+        if now - route.last_error_report >= DECODE_ERROR_REPORT_INTERVAL:
+            print(f"[WARN] {route.unreported_errors} decode failure(s) on {route.topic}, last: {error!r}")
+            route.unreported_errors = 0
+            route.last_error_report = now
 
 if __name__ == '__main__':
     print("Please run roc_main.py instead.")
@@ -0,0 +1,60 @@
+'''
+This module contains the startup timeline of a ROC process: named milestones (imports done,
+session open, first telemetry processed, ...) with their time since the process started, so
+startup regressions can be spotted from the console output.
+'''
+
+import sys
+import threading
+import time
+
+
+class StartupTimeline:
+    def __init__(self, start=None):
+        # Reference point as a time.perf_counter() value, e.g. taken first thing in the entry point
+        self.start = time.perf_counter() if start is None else start
+        self.lock = threading.Lock()
+
+        # Milestone name -> seconds since start, in the order they were reached
+        self.marks = {}
+
+        # Called as listener(name, seconds) for every milestone, from the thread reaching it
+        self.listeners = []
+
+    def mark(self, name):
+        '''
+        Record that a milestone was reached now. Only the first time a milestone is reached counts.
+        '''
+        elapsed = time.perf_counter() - self.start
+        with self.lock:
+            if name in self.marks:
+                return
+            self.marks[name] = elapsed
+            listeners = list(self.listeners)
+        print(f"[startup] {name}: {elapsed * 1000:.1f} ms")
+        for listener in listeners:
+            listener(name, elapsed)
+
+    def subscribe(self, listener):
+        '''
+        Add a listener, first calling it with the milestones reached so far.
+        '''
+        with self.lock:
+            reached = list(self.marks.items())
+            self.listeners.append(listener)
+        for name, elapsed in reached:
+            listener(name, elapsed)
+
+    def when(self, event, name):
+        '''
+        Mark a milestone once a threading.Event is set, from a background thread.
+        '''
+        def wait():
+            event.wait()
+            self.mark(name)
+        threading.Thread(target=wait, daemon=True).start()
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
@@ -0,0 +1,202 @@
+'''
+This module contains the SOG/COG strip charts of the vessel control panel.
+
+The charts plot the vessel's telemetry history and the setpoints sent by the ROC over a sliding
+time window. To keep redraws cheap no matter how long the window is:
+
+- the history is queried downsampled to one min/max pair per horizontal pixel, so no more than
+  two points per pixel are ever drawn,
+- pixel buckets are aligned to absolute time, so a bucket once complete never changes and is
+  kept, and every refresh only queries the history since the last complete bucket,
+- the x axis is time relative to now and the y limits only change when the data leaves them, so
+  the axes, ticks and labels are drawn once and then restored from a cached background, and only
+  the lines are redrawn onto it (blitting).
+'''
+
+import sys
+import time
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+# Default time window shown by the charts (time in seconds)
+DEFAULT_CHART_WINDOW = 600
+
+# Refresh interval of the charts, independent of the telemetry rate (time in milliseconds)
+CHART_REFRESH_MS = 500
+
+# Extra room above the highest SOG when the y axis has to be rescaled (fraction of the maximum)
+SOG_HEADROOM = 0.25
+
+
+def min_max(result):
+    '''
+    (times, lows, highs) of a history query result, where raw samples are their own min and max.
+    '''
+    if hasattr(result, "counts"):
+        return result.times, result.min[:, 0], result.max[:, 0]
+    return result.times, result.values[:, 0], result.values[:, 0]
+
+
+class DecimatedSeries:
+    '''
+    One min/max pair per time bucket of a history series, where buckets are aligned to multiples
+    of bucket_ns. Complete buckets are cached, so each update only queries the latest samples.
+    '''
+    def __init__(self, vessel_id, field):
+        self.vessel_id = vessel_id
+        self.field = field
+        self.bucket_ns = None
+        self.complete_end_ns = None # End of the last complete (cached) bucket
+        self.times = np.empty(0, dtype=np.int64)
+        self.lows = np.empty(0)
+        self.highs = np.empty(0)
+
+    def update(self, history, start_ns, now_ns, bucket_ns):
+        '''
+        Bring the cache up to date and return (x in ns, y) of the min/max line from start_ns to now.
+        '''
+        if bucket_ns != self.bucket_ns:
+            # Resized or new window, start over
+            self.bucket_ns = bucket_ns
+            self.complete_end_ns = start_ns // bucket_ns * bucket_ns
+            self.times = np.empty(0, dtype=np.int64)
+            self.lows = self.highs = np.empty(0)
+
+        # Query from the last complete bucket up to the end of the current one
+        current_ns = now_ns // bucket_ns * bucket_ns
+        end_ns = current_ns + bucket_ns
+        query_start_ns = max(self.complete_end_ns, start_ns // bucket_ns * bucket_ns)
+        points = (end_ns - query_start_ns) // bucket_ns
+        result = history.query(self.vessel_id, self.field, query_start_ns, end_ns, points=points)
+        if result is None:
+            return np.empty(0), np.empty(0)
+        times, lows, highs = min_max(result)
+
+        # Buckets before the current one are complete, keep those
+        complete = np.searchsorted(times, current_ns)
+        keep = np.searchsorted(self.times, start_ns)
+        self.times = np.concatenate((self.times[keep:], times[:complete]))
+        self.lows = np.concatenate((self.lows[keep:], lows[:complete]))
+        self.highs = np.concatenate((self.highs[keep:], highs[:complete]))
+        self.complete_end_ns = current_ns
+
+        all_times = np.concatenate((self.times, times[complete:]))
+        y = np.column_stack((np.concatenate((self.lows, lows[complete:])),
+                             np.concatenate((self.highs, highs[complete:])))).ravel()
+        return np.repeat(all_times, 2), y
+
+
+class StripChart:
+    def __init__(self, parent, vessel_id, setpoints, window=DEFAULT_CHART_WINDOW):
+        '''
+        setpoints maps "SOG"/"COG" to a sequence of (sent time in ns, value), e.g. the
+        ROCController's setpoints.
+        '''
+        self.vessel_id = vessel_id
+        self.series = {field: DecimatedSeries(vessel_id, field) for field in ("sog", "cog")}
+        self.setpoints = setpoints
+        self.window = window
+
+        self.figure = Figure(figsize=(4, 2.6), dpi=100)
+        self.figure.subplots_adjust(left=0.14, right=0.97, top=0.95, bottom=0.15, hspace=0.15)
+        self.sog_axes = self.figure.add_subplot(2, 1, 1)
+        self.cog_axes = self.figure.add_subplot(2, 1, 2, sharex=self.sog_axes)
+
+        self.sog_axes.set_ylabel("SOG (kn)", fontsize=8)
+        self.sog_axes.set_ylim(0, 15)
+        self.cog_axes.set_ylabel("COG (°)", fontsize=8)
+        self.cog_axes.set_ylim(0, 360)
+        self.cog_axes.set_yticks([0, 90, 180, 270, 360])
+        self.cog_axes.set_xlim(-window, 0)
+        self.cog_axes.set_xlabel("Time (s)", fontsize=8)
+        for axes in (self.sog_axes, self.cog_axes):
+            axes.tick_params(labelsize=7)
+            axes.grid(True, alpha=0.3)
+        self.sog_axes.tick_params(labelbottom=False)
+
+        # Lines are animated, i.e. only drawn by us onto the cached background
+        self.lines = {
+            "sog": self.sog_axes.plot([], [], color="#3E69CB", linewidth=1, animated=True)[0],
+            "cog": self.cog_axes.plot([], [], color="#3E69CB", linewidth=1, animated=True)[0],
+            "SOG": self.sog_axes.plot([], [], color="orange", linewidth=1, drawstyle="steps-post", animated=True)[0],
+            "COG": self.cog_axes.plot([], [], color="orange", linewidth=1, drawstyle="steps-post", animated=True)[0],
+        }
+
+        self.canvas = FigureCanvasTkAgg(self.figure, master=parent)
+        self.widget = self.canvas.get_tk_widget()
+        self.background = None
+        # Every full draw (first show, resize, rescale) replaces the cached background
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+
+        # Counters
+        self.blits = 0
+        self.full_draws = 0
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.full_draws += 1
+        self.draw_lines()
+
+    def width_px(self):
+        '''
+        Width of the plot area in pixels, i.e. the number of min/max pairs worth drawing.
+        '''
+        return max(1, int(self.sog_axes.bbox.width))
+
+    def refresh(self, history):
+        '''
+        Update the lines with the latest history and setpoints, then blit them.
+        '''
+        if self.background is None:
+            return
+
+        now_ns = time.time_ns()
+        start_ns = now_ns - int(self.window * 1e9)
+        bucket_ns = max(1, int(self.window * 1e9) // self.width_px())
+        rescale = False
+
+        for field, series in self.series.items():
+            if history is None:
+                continue
+            x_ns, y = series.update(history, start_ns, now_ns, bucket_ns)
+            self.lines[field].set_data((x_ns - now_ns) / 1e9, y)
+            if len(y) == 0:
+                continue
+
+            if field == "sog":
+                top = self.sog_axes.get_ylim()[1]
+                highest = float(y.max())
+                new_top = max(1.0, highest * (1 + SOG_HEADROOM))
+                if highest > top or (highest < top / 3 and new_top < top):
+                    self.sog_axes.set_ylim(0, new_top)
+                    rescale = True
+
+        for name in ("SOG", "COG"):
+            sent = list(self.setpoints.get(name, ()))
+            if not sent:
+                continue
+            # Step line from the last setpoint before the window up to now
+            times = np.array([sent_ns for sent_ns, _ in sent] + [now_ns], dtype=np.int64)
+            values = np.array([value for _, value in sent] + [sent[-1][1]])
+            first = max(0, np.searchsorted(times, start_ns) - 1)
+            self.lines[name].set_data((np.maximum(times[first:], start_ns) - now_ns) / 1e9, values[first:])
+
+        if rescale:
+            # Axes changed, so the background has to be drawn again (on_draw then blits the lines)
+            self.canvas.draw_idle()
+        else:
+            self.draw_lines()
+
+    def draw_lines(self):
+        self.canvas.restore_region(self.background)
+        for line in self.lines.values():
+            line.axes.draw_artist(line)
+        self.canvas.blit(self.figure.bbox)
+        self.blits += 1
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
@@ -0,0 +1,218 @@
+'''
+This module contains the per topic telemetry statistics of the ROC: publish-to-receive and
+receive-to-render latency histograms, message rate and inter-arrival jitter.
+
+Histograms have logarithmic buckets (BUCKETS_PER_OCTAVE per doubling, so ~9% resolution), which
+keeps memory fixed per topic no matter how many samples are recorded. The statistics can be served
+in the Prometheus text format over HTTP on localhost.
+'''
+
+import math
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS_PER_OCTAVE = 8
+
+# Histogram range: 1 us .. ~275 s (in ns), values outside end up in the first/last bucket
+HISTOGRAM_MIN_OCTAVE = 10
+HISTOGRAM_MAX_OCTAVE = 38
+
+# Weight of the newest inter-arrival time in the rate and jitter averages (as in RFC 3550)
+ARRIVAL_SMOOTHING = 1 / 16
+
+
+class LogHistogram:
+    def __init__(self):
+        self.offset = HISTOGRAM_MIN_OCTAVE * BUCKETS_PER_OCTAVE
+        self.buckets = [0] * ((HISTOGRAM_MAX_OCTAVE - HISTOGRAM_MIN_OCTAVE) * BUCKETS_PER_OCTAVE)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.negative = 0 # e.g. publish times ahead of our clock
+
+    def record(self, value):
+        if value < 0:
+            self.negative += 1
+            value = 0
+        index = int(math.log2(value) * BUCKETS_PER_OCTAVE) - self.offset if value > 0 else 0
+        self.buckets[min(max(index, 0), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        '''
+        Approximate value below which the given fraction of the recorded values are, or None if empty.
+        '''
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                # Geometric middle of the bucket, but never more than what was actually seen
+                middle = 2 ** ((index + self.offset + 0.5) / BUCKETS_PER_OCTAVE)
+                return min(middle, self.max)
+        return self.max
+
+
+class TopicStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.publish_to_receive = LogHistogram()
+        self.receive_to_render = LogHistogram()
+        self.received = 0
+        self.last_received_ns = None
+        self.mean_interval_ns = None
+        self.jitter_ns = 0.0
+
+    def record_receive(self, received_ns, published_ns=None):
+        with self.lock:
+            self.received += 1
+            if published_ns:
+                self.publish_to_receive.record(received_ns - published_ns)
+
+            if self.last_received_ns is not None:
+                interval = received_ns - self.last_received_ns
+                if self.mean_interval_ns is None:
+                    self.mean_interval_ns = float(interval)
+                else:
+                    deviation = abs(interval - self.mean_interval_ns)
+                    self.jitter_ns += (deviation - self.jitter_ns) * ARRIVAL_SMOOTHING
+                    self.mean_interval_ns += (interval - self.mean_interval_ns) * ARRIVAL_SMOOTHING
+            self.last_received_ns = received_ns
+
+    def record_render(self, received_ns, rendered_ns):
+        with self.lock:
+            self.receive_to_render.record(rendered_ns - received_ns)
+
+    @property
+    def rate_hz(self):
+        if not self.mean_interval_ns:
+            return None
+        return 1e9 / self.mean_interval_ns
+
+
+class TelemetryStats:
+    '''
+    TopicStats per key expression (or key expression pattern, e.g. for a topic of a whole fleet).
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.topics = {}
+
+    def topic(self, key_expr):
+        stats = self.topics.get(key_expr)
+        if stats is None:
+            with self.lock:
+                stats = self.topics.setdefault(key_expr, TopicStats())
+        return stats
+
+    def snapshot(self):
+        '''
+        Sorted list of (key expression, TopicStats).
+        '''
+        with self.lock:
+            return sorted(self.topics.items())
+
+
+def format_prometheus(stats, decode_errors=None, dead_reckoning=None):
+    '''
+    Render the statistics in the Prometheus text exposition format, with the prediction errors of
+    the dead_reckoning.DeadReckoning dead_reckoning if given.
+    '''
+    lines = []
+    snapshot = stats.snapshot()
+
+    for name, attribute, help_text in (
+            ("roc_telemetry_publish_to_receive_seconds", "publish_to_receive",
+             "Time from the publisher's timestamp until the sample was received"),
+            ("roc_telemetry_receive_to_render_seconds", "receive_to_render",
+             "Time from receiving a sample until it was shown in the GUI")):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} summary")
+        for key_expr, topic in snapshot:
+            histogram = getattr(topic, attribute)
+            if histogram.count == 0:
+                continue
+            for quantile in (0.5, 0.99, 1.0):
+                value = histogram.percentile(quantile) / 1e9
+                lines.append(f'{name}{{key="{key_expr}",quantile="{quantile}"}} {value:.9f}')
+            lines.append(f'{name}_sum{{key="{key_expr}"}} {histogram.total / 1e9:.9f}')
+            lines.append(f'{name}_count{{key="{key_expr}"}} {histogram.count}')
+
+    lines.append("# HELP roc_telemetry_received_total Samples received")
+    lines.append("# TYPE roc_telemetry_received_total counter")
+    for key_expr, topic in snapshot:
+        lines.append(f'roc_telemetry_received_total{{key="{key_expr}"}} {topic.received}')
+
+    # Each family's samples must follow its own HELP and TYPE lines, without interleaving
+    lines.append("# HELP roc_telemetry_rate_hz Smoothed message rate")
+    lines.append("# TYPE roc_telemetry_rate_hz gauge")
+    for key_expr, topic in snapshot:
+        if topic.rate_hz is not None:
+            lines.append(f'roc_telemetry_rate_hz{{key="{key_expr}"}} {topic.rate_hz:.3f}')
+    lines.append("# HELP roc_telemetry_jitter_seconds Smoothed inter-arrival jitter")
+    lines.append("# TYPE roc_telemetry_jitter_seconds gauge")
+    for key_expr, topic in snapshot:
+        if topic.rate_hz is not None:
+            lines.append(f'roc_telemetry_jitter_seconds{{key="{key_expr}"}} {topic.jitter_ns / 1e9:.9f}')
+
+    if decode_errors is not None:
+        lines.append("# HELP roc_telemetry_decode_errors_total Samples that failed to decode")
+        lines.append("# TYPE roc_telemetry_decode_errors_total counter")
+        for topic, errors in sorted(decode_errors.items()):
+            lines.append(f'roc_telemetry_decode_errors_total{{topic="{topic}"}} {errors}')
+
+    if dead_reckoning is not None and dead_reckoning.errors.count:
+        name = "roc_position_prediction_error_meters"
+        errors = dead_reckoning.errors
+        lines.append(f"# HELP {name} Distance between each location fix and where dead reckoning projected it")
+        lines.append(f"# TYPE {name} summary")
+        for quantile in (0.5, 0.99, 1.0):
+            lines.append(f'{name}{{quantile="{quantile}"}} {dead_reckoning.error_percentile(quantile):.3f}')
+        lines.append(f"{name}_sum {errors.total / 1000:.3f}")
+        lines.append(f"{name}_count {errors.count}")
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    '''
+    Serves a monitor's statistics at http://127.0.0.1:<port>/metrics, from a background thread.
+    '''
+    def __init__(self, monitor, port):
+        monitor_ = monitor
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = format_prometheus(monitor_.stats, monitor_.decode_errors(), monitor_.dead_reckoning).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Don't spam the console with a line per scrape
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"{self.__class__.__name__} serving on http://127.0.0.1:{self.server.server_port}/metrics")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
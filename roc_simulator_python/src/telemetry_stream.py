@@ -0,0 +1,142 @@
+'''
+This module contains the asyncio streams of telemetry updates handed out by
+ShipTelemetryMonitor.stream().
+
+Every stream is a bounded queue of its own, filled from the monitor's single set of zenoh
+subscriptions, so any number of consumers can be added without another zenoh subscriber, and a
+slow consumer only ever loses its own updates:
+
+    drop_oldest  keep the newest maxsize updates, dropping the oldest when full
+    latest       keep only the latest update per vessel and field (maxsize is not used)
+
+Usage, from a coroutine:
+
+    async for update in monitor.stream(topics=["cog", "sog"], maxsize=100):
+        print(update.vessel_id, update.field, update.value)
+'''
+
+import asyncio
+import sys
+import threading
+from collections import deque, namedtuple
+
+TelemetryUpdate = namedtuple("TelemetryUpdate", ["vessel_id", "field", "value", "received_ns"])
+
+STREAM_POLICIES = ("drop_oldest", "latest")
+
+# Default number of updates a drop_oldest stream holds
+DEFAULT_STREAM_MAXSIZE = 1000
+
+
+class TelemetryStream:
+    def __init__(self, fields=None, vessels=None, maxsize=DEFAULT_STREAM_MAXSIZE, policy="drop_oldest",
+                 on_close=None):
+        '''
+        Stream of the updates of the given VesselState fields of the given vessels (None for all).
+        Must be created from the event loop that consumes it.
+        '''
+        if policy not in STREAM_POLICIES:
+            raise ValueError(f"Unknown stream policy {policy!r}, expected one of {STREAM_POLICIES}")
+        self.fields = frozenset(fields) if fields is not None else None
+        self.vessels = frozenset(vessels) if vessels is not None else None
+        self.policy = policy
+        self.on_close = on_close
+
+        self._loop = asyncio.get_running_loop()
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._waiting = False
+        self._closed = False
+        if policy == "latest":
+            self._queue = {} # (vessel id, field) -> latest update, in order of arrival
+        else:
+            self._queue = deque(maxlen=maxsize)
+
+        # Counters
+        self.offered = 0
+        self.dropped = 0
+
+    def wants(self, vessel_id, field):
+        return ((self.fields is None or field in self.fields)
+                and (self.vessels is None or vessel_id in self.vessels))
+
+    def offer(self, update):
+        '''
+        Queue an update, dropping one according to the policy if full. Called from zenoh threads.
+        '''
+        with self._lock:
+            if self._closed:
+                return
+            self.offered += 1
+            queue = self._queue
+            if self.policy == "latest":
+                key = (update.vessel_id, update.field)
+                if key in queue:
+                    # Move to the end, so updates keep coming out in the order they arrived
+                    del queue[key]
+                    self.dropped += 1
+                queue[key] = update
+            else:
+                if len(queue) == queue.maxlen:
+                    self.dropped += 1
+                queue.append(update)
+            wake = self._waiting
+            self._waiting = False
+
+        # Only bother the event loop when the consumer is actually waiting
+        if wake:
+            self._wake()
+
+    def close(self):
+        '''
+        Stop the stream. Updates already queued are still delivered. Safe to call from any thread.
+        '''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self.on_close:
+            self.on_close(self)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            # The consuming event loop is gone, so is the consumer
+            self._closed = True
+            if self.on_close:
+                self.on_close(self)
+
+    def _take(self):
+        with self._lock:
+            if self._queue:
+                if self.policy == "latest":
+                    return self._queue.pop(next(iter(self._queue)))
+                return self._queue.popleft()
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiting = True
+            self._wakeup.clear()
+            return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            update = self._take()
+            if update is not None:
+                return update
+            await self._wakeup.wait()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
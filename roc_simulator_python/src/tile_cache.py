@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+'''
+This module contains the offline map tile cache for the vessel map panel.
+
+Tiles are kept in an SQLite file in the format TkinterMapView reads through its database_path
+option, so the map panel looks there first and can run with no network at all (--offline) from a
+pre-seeded file. Decoded tile images are kept in a bounded in-memory LRU.
+
+Run this module directly to warm a tile file, either for a bounding box or along a track:
+
+    python3 tile_cache.py --db tiles.db --zoom 4-10 bbox 66.0 16.0 59.0 26.0
+    python3 tile_cache.py --db tiles.db --zoom 8-14 track track.csv
+'''
+
+import argparse
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TILE_SERVER = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+
+# Zoom levels warmed when none are given
+DEFAULT_ZOOM_LEVELS = range(4, 13)
+
+# Decoded tile images kept in memory by the map panel (a 256x256 tile is roughly 256 kB decoded, so
+# this is ~64 MB: a few screens' worth at each zoom level in use)
+DEFAULT_IMAGE_CACHE_SIZE = 256
+
+
+class LRUTileCache(OrderedDict):
+    '''
+    Drop-in replacement for TkinterMapView.tile_image_cache holding at most maxsize images.
+    TkinterMapView reads and writes it from its tile loading threads, hence the lock.
+    '''
+    def __init__(self, maxsize=DEFAULT_IMAGE_CACHE_SIZE):
+        super().__init__()
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = super().__getitem__(key)
+            self.move_to_end(key)
+            return value
+
+    def get(self, key, default=None):
+        '''
+        The image under key, or default. Unlike checking "in" then indexing, a tile evicted by
+        another thread in between can't raise KeyError.
+        '''
+        with self.lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+
+
+def tile_of(lat, lon, zoom):
+    '''
+    OSM tile (x, y) containing a position at the given zoom level.
+    '''
+    scale = 2 ** zoom
+    lat_rad = math.radians(max(-85.0511, min(85.0511, lat)))
+    x = int((lon + 180.0) / 360.0 * scale)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * scale)
+    return min(max(x, 0), scale - 1), min(max(y, 0), scale - 1)
+
+
+def tiles_for_bbox(top_left, bottom_right, zooms):
+    '''
+    All (zoom, x, y) tiles covering the box between two (lat, lon) corners.
+    '''
+    tiles = []
+    for zoom in zooms:
+        x1, y1 = tile_of(*top_left, zoom)
+        x2, y2 = tile_of(*bottom_right, zoom)
+        for x in range(min(x1, x2), max(x1, x2) + 1):
+            for y in range(min(y1, y2), max(y1, y2) + 1):
+                tiles.append((zoom, x, y))
+    return tiles
+
+
+def tiles_along_track(points, zooms, padding=1):
+    '''
+    The (zoom, x, y) tiles under a track of (lat, lon) points, plus padding tiles around each.
+    Consecutive points more than a tile apart are interpolated so no tile along the route is missed.
+    '''
+    tiles = set()
+    for zoom in zooms:
+        previous = None
+        for lat, lon in points:
+            x, y = tile_of(lat, lon, zoom)
+            steps = 1
+            if previous:
+                steps = max(1, abs(x - previous[0]), abs(y - previous[1]))
+            for step in range(1, steps + 1):
+                if previous:
+                    px = previous[0] + (x - previous[0]) * step // steps
+                    py = previous[1] + (y - previous[1]) * step // steps
+                else:
+                    px, py = x, y
+                for dx in range(-padding, padding + 1):
+                    for dy in range(-padding, padding + 1):
+                        if 0 <= px + dx < 2 ** zoom and 0 <= py + dy < 2 ** zoom:
+                            tiles.add((zoom, px + dx, py + dy))
+            previous = (x, y)
+    return sorted(tiles)
+
+
+class TileStore:
+    '''
+    SQLite tile file, using the same schema as tkintermapview.OfflineLoader.
+    '''
+    def __init__(self, path, tile_server=DEFAULT_TILE_SERVER, max_zoom=19):
+        self.path = path
+        self.tile_server = tile_server
+        self.max_zoom = max_zoom
+
+        with sqlite3.connect(self.path) as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS server (
+                              url VARCHAR(300) PRIMARY KEY NOT NULL,
+                              max_zoom INTEGER NOT NULL);""")
+            db.execute("""CREATE TABLE IF NOT EXISTS tiles (
+                              zoom INTEGER NOT NULL,
+                              x INTEGER NOT NULL,
+                              y INTEGER NOT NULL,
+                              server VARCHAR(300) NOT NULL,
+                              tile_image BLOB NOT NULL,
+                              CONSTRAINT fk_server FOREIGN KEY (server) REFERENCES server (url),
+                              CONSTRAINT pk_tiles PRIMARY KEY (zoom, x, y, server));""")
+            db.execute("""CREATE TABLE IF NOT EXISTS sections (
+                              position_a VARCHAR(100) NOT NULL,
+                              position_b VARCHAR(100) NOT NULL,
+                              zoom_a INTEGER NOT NULL,
+                              zoom_b INTEGER NOT NULL,
+                              server VARCHAR(300) NOT NULL,
+                              CONSTRAINT fk_server FOREIGN KEY (server) REFERENCES server (url),
+                              CONSTRAINT pk_tiles PRIMARY KEY (position_a, position_b, zoom_a, zoom_b, server));""")
+            db.execute("INSERT OR IGNORE INTO server (url, max_zoom) VALUES (?, ?);",
+                       (self.tile_server, self.max_zoom))
+
+    def missing(self, tiles):
+        '''
+        The subset of (zoom, x, y) tiles not yet in the store.
+        '''
+        with sqlite3.connect(self.path) as db:
+            present = set(db.execute("SELECT zoom, x, y FROM tiles WHERE server=?;", (self.tile_server,)))
+        return [tile for tile in tiles if tile not in present]
+
+    def fetch(self, tiles, workers=8, progress=None):
+        '''
+        Download the given tiles that are not in the store yet. Returns the number stored.
+        '''
+        import requests
+
+        def download(tile):
+            zoom, x, y = tile
+            url = self.tile_server.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
+            try:
+                response = requests.get(url, headers={"User-Agent": "TkinterMapView"}, timeout=10)
+                if response.ok:
+                    return tile, response.content
+            except requests.exceptions.RequestException:
+                pass
+            return tile, None
+
+        todo = self.missing(tiles)
+        stored = 0
+        with sqlite3.connect(self.path) as db, ThreadPoolExecutor(workers) as pool:
+            for done, (tile, image) in enumerate(pool.map(download, todo), start=1):
+                if image is not None:
+                    db.execute("INSERT OR IGNORE INTO tiles (zoom, x, y, server, tile_image) VALUES (?, ?, ?, ?, ?);",
+                               (*tile, self.tile_server, image))
+                    stored += 1
+                if progress:
+                    progress(done, len(todo))
+        return stored
+
+
+def parse_zoom_range(text):
+    '''
+    Parse "8" or "4-12" into a range of zoom levels.
+    '''
+    first, _, last = text.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+def read_track_file(path):
+    '''
+    Read a track file with one "lat,lon" pair per line.
+    '''
+    points = []
+    with open(path) as track_file:
+        for line in track_file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                lat, lon = line.split(",")[:2]
+                points.append((float(lat), float(lon)))
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm the offline map tile cache")
+    parser.add_argument("--db", required=True, help="tile file to fill")
+    parser.add_argument("--tile-server", default=DEFAULT_TILE_SERVER)
+    parser.add_argument("--zoom",
+                        type=parse_zoom_range,
+                        default=DEFAULT_ZOOM_LEVELS,
+                        help="zoom level or range of levels, e.g. 4-12")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    bbox = subparsers.add_parser("bbox", help="warm all tiles in a bounding box")
+    bbox.add_argument("lat1", type=float)
+    bbox.add_argument("lon1", type=float)
+    bbox.add_argument("lat2", type=float)
+    bbox.add_argument("lon2", type=float)
+
+    track = subparsers.add_parser("track", help="warm the tiles along a track")
+    track.add_argument("file", help="file with one lat,lon pair per line")
+    track.add_argument("--padding", type=int, default=1, help="tiles to add around the track")
+    args = parser.parse_args()
+
+    if args.command == "bbox":
+        tiles = tiles_for_bbox((args.lat1, args.lon1), (args.lat2, args.lon2), args.zoom)
+    else:
+        tiles = tiles_along_track(read_track_file(args.file), args.zoom, args.padding)
+
+    store = TileStore(args.db, args.tile_server)
+
+    def progress(done, total):
+        print(f"\r{done}/{total} tiles", end="", flush=True)
+
+    stored = store.fetch(tiles, progress=progress)
+    print(f"\n{stored} new tiles stored in {args.db} ({len(tiles)} requested)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''
+This module contains the bounded track history of a vessel, and the line simplification used to
+draw it on the map with no more points than are visible at the current zoom level.
+'''
+
+import math
+import sys
+from collections import deque
+from itertools import islice
+
+# Map tiles are this many pixels wide at every zoom level
+TILE_SIZE = 256
+
+# Tracks are simplified in chunks of this many positions, whose ends are always kept, so a new
+# position only has the last chunk simplified again (and the first, once old positions are dropped)
+SIMPLIFY_CHUNK = 256
+
+
+def to_map_pixels(lat, lon, zoom):
+    '''
+    Project a position to (web mercator) map pixel coordinates at the given zoom level.
+    '''
+    scale = TILE_SIZE * 2 ** zoom
+    lat_rad = math.radians(lat)
+    x = (lon + 180.0) / 360.0 * scale
+    y = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * scale
+    return x, y
+
+
+def douglas_peucker(points, tolerance):
+    '''
+    Simplify a polyline of (x, y) points, returning the indices of the points to keep.
+    No removed point is further than tolerance from the simplified line.
+    '''
+    count = len(points)
+    if count < 3:
+        return list(range(count))
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    tolerance_sq = tolerance * tolerance
+
+    # Iterative rather than recursive, long tracks would otherwise hit the recursion limit
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first]
+        x2, y2 = points[last]
+        dx = x2 - x1
+        dy = y2 - y1
+        length_sq = dx * dx + dy * dy
+
+        max_dist_sq = -1.0
+        max_index = first
+        for i in range(first + 1, last):
+            px, py = points[i]
+            # Squared distance from the segment between first and last, so points beyond its ends
+            # (e.g. the far end of an out and back leg) are measured to the nearest end
+            t = 0.0
+            if length_sq:
+                t = min(max(((px - x1) * dx + (py - y1) * dy) / length_sq, 0.0), 1.0)
+            dist_sq = (px - x1 - t * dx) ** 2 + (py - y1 - t * dy) ** 2
+            if dist_sq > max_dist_sq:
+                max_dist_sq = dist_sq
+                max_index = i
+
+        if max_dist_sq > tolerance_sq:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+
+    return [i for i in range(count) if keep[i]]
+
+
+class TrackHistory:
+    '''
+    The most recent positions of one vessel, in a ring buffer of fixed length.
+    '''
+    def __init__(self, maxlen):
+        self.points = deque(maxlen=maxlen)
+        self.appended = 0 # Positions ever appended, i.e. the absolute index of the next one
+
+        # Simplification of the last simplified() call: its (zoom, tolerance), the kept positions
+        # per chunk by (first, last) absolute index, and (self.appended, result)
+        self._simplified_for = None
+        self._chunks = {}
+        self._simplified = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def append(self, lat, lon):
+        if self.points and self.points[-1] == (lat, lon):
+            return
+        self.points.append((lat, lon))
+        self.appended += 1
+
+    def simplified(self, zoom, tolerance_px):
+        '''
+        The track as a list of (lat, lon), simplified to tolerance_px pixels at the given zoom.
+        The same list is returned until the track, zoom or tolerance changes, don't modify it.
+        '''
+        if self._simplified_for != (zoom, tolerance_px):
+            self._simplified_for = (zoom, tolerance_px)
+            self._chunks = {}
+            self._simplified = None
+        elif self._simplified and self._simplified[0] == self.appended:
+            return self._simplified[1]
+        if not self.points:
+            return []
+
+        # Chunk bounds are at multiples of SIMPLIFY_CHUNK, each shared by the chunks on either side
+        last = self.appended - 1
+        first = self.appended - len(self.points)
+        bounds = [first, *range((first // SIMPLIFY_CHUNK + 1) * SIMPLIFY_CHUNK, last, SIMPLIFY_CHUNK), last]
+
+        chunks = {}
+        trail = []
+        for start, end in zip(bounds, bounds[1:]):
+            kept = self._chunks.get((start, end))
+            if kept is None:
+                points = list(islice(self.points, start - first, end - first + 1))
+                projected = [to_map_pixels(lat, lon, zoom) for lat, lon in points]
+                kept = [points[i] for i in douglas_peucker(projected, tolerance_px)]
+            chunks[(start, end)] = kept
+            trail.extend(kept[:-1])
+        trail.append(self.points[-1])
+
+        # Only the chunks still in the track are kept
+        self._chunks = chunks
+        self._simplified = (self.appended, trail)
+        return trail
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
@@ -0,0 +1,249 @@
+'''
+This module contains a shared, reference counted Zenoh session.
+
+Both the ROCController and the ShipTelemetryMonitor take a SessionManager, so one ROC process only
+opens one Zenoh session (one set of transport links, scouting and background threads) no matter
+how many components use it. Publishers and subscribers are cached per key expression.
+
+With --shm, large payloads published through the session are written into a shared memory pool,
+so peers on the same host receive them without a copy through the network stack. Zenoh still sends
+them over the network to peers that can't map the pool, and payloads that don't fit in the pool are
+sent as plain bytes. Small payloads (all telemetry and commands of the ship simulator) always take
+the network path, for them allocating a shared memory buffer from Python costs more than it saves
+(see bench/bench_shm.py).
+'''
+
+import argparse
+import json
+import sys
+import threading
+import zenoh
+
+from profiler import profiled
+
+try:
+    from zenoh.shm import GarbageCollect, ShmProvider
+except ImportError: # zenoh built without shared memory support
+    ShmProvider = None
+
+# Default size of the shared memory pool payloads are published from with --shm (bytes)
+DEFAULT_SHM_POOL_SIZE = 16 * 1024 * 1024
+
+# Only payloads at least this long are published through shared memory (bytes)
+SHM_MIN_PAYLOAD_SIZE = 4096
+
+
+class SessionConfig:
+    '''
+    Zenoh session settings shared by every component of a ROC process.
+    '''
+    def __init__(self, mode=None, connect=None, listen=None, shm=None, multicast_scouting=None,
+                 shm_pool_size=DEFAULT_SHM_POOL_SIZE):
+        self.mode = mode # "peer" or "client", None for the zenoh default
+        self.connect = list(connect or [])
+        self.listen = list(listen or [])
+        # True to receive and publish through shared memory, False to disable it, None for the
+        # zenoh default (receive only)
+        self.shm = shm
+        self.shm_pool_size = shm_pool_size
+        # False to only use the given endpoints, e.g. on a box without a multicast capable network
+        self.multicast_scouting = multicast_scouting
+
+    @staticmethod
+    def add_arguments(parser):
+        '''
+        Add the session options to an argparse parser.
+        '''
+        group = parser.add_argument_group("zenoh session")
+        group.add_argument("--zenoh-mode",
+                           choices=["peer", "client"],
+                           help="zenoh session mode")
+        group.add_argument("--connect",
+                           action="append",
+                           metavar="ENDPOINT",
+                           help="endpoint to connect to, e.g. tcp/127.0.0.1:7447 (repeatable)")
+        group.add_argument("--listen",
+                           action="append",
+                           metavar="ENDPOINT",
+                           help="endpoint to listen on (repeatable)")
+        group.add_argument("--shm",
+                           action=argparse.BooleanOptionalAction,
+                           default=None,
+                           help="publish through (and receive from) shared memory with peers on this host, or disable it")
+        group.add_argument("--shm-pool-size",
+                           type=float,
+                           default=DEFAULT_SHM_POOL_SIZE / 2**20,
+                           metavar="MIB",
+                           help="size of the shared memory pool published payloads are written to (in MiB)")
+        group.add_argument("--multicast-scouting",
+                           action=argparse.BooleanOptionalAction,
+                           default=None,
+                           help="enable or disable discovering peers by UDP multicast")
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(mode=args.zenoh_mode, connect=args.connect, listen=args.listen, shm=args.shm,
+                   multicast_scouting=args.multicast_scouting, shm_pool_size=int(args.shm_pool_size * 2**20))
+
+    def to_zenoh_config(self):
+        cfg = zenoh.Config()
+        if self.mode:
+            cfg.insert_json5("mode", json.dumps(self.mode))
+        if self.connect:
+            cfg.insert_json5("connect/endpoints", json.dumps(self.connect))
+        if self.listen:
+            cfg.insert_json5("listen/endpoints", json.dumps(self.listen))
+        if self.shm is not None:
+            cfg.insert_json5("transport/shared_memory/enabled", json.dumps(self.shm))
+        if self.multicast_scouting is not None:
+            cfg.insert_json5("scouting/multicast/enabled", json.dumps(self.multicast_scouting))
+        return cfg
+
+
+class ShmPayloads:
+    '''
+    Copies payloads into a shared memory pool for publishing, falling back to the plain payload
+    (published over the network path) when shared memory is unavailable or the pool is full.
+    '''
+    def __init__(self, pool_size=DEFAULT_SHM_POOL_SIZE, min_size=SHM_MIN_PAYLOAD_SIZE):
+        self.provider = None
+        self.min_size = max(1, min_size)
+        self.fallbacks = 0 # Payloads long enough for shared memory, but published without it
+        if ShmProvider is None:
+            print("[WARN] zenoh has no shared memory support, publishing over the network")
+            return
+        try:
+            self.provider = ShmProvider.default_backend(pool_size)
+        except zenoh.ZError as e:
+            print(f"[WARN] Can't create a {pool_size} byte shared memory pool ({e}), publishing over the network")
+
+    def payload(self, data):
+        '''
+        data (bytes or str) in a shared memory buffer, or data itself if it can't be.
+        '''
+        if len(data) < self.min_size:
+            return data
+        if isinstance(data, str):
+            data = data.encode()
+        if self.provider is None:
+            self.fallbacks += 1
+            return data
+        try:
+            # Reclaims buffers subscribers are done with, but never blocks
+            buffer = self.provider.alloc(len(data), policy=GarbageCollect())
+        except zenoh.ZError:
+            self.fallbacks += 1
+            return data
+        buffer[0:len(data)] = data
+        return buffer
+
+
+class _FanOut:
+    '''
+    Subscriber callback forwarding each sample to every registered handler.
+    '''
+    def __init__(self):
+        # Replaced, never mutated, so zenoh threads can iterate without locking
+        self.handlers = ()
+
+    def __call__(self, sample):
+        for handler in self.handlers:
+            handler(sample)
+
+
+class SessionManager:
+    def __init__(self, config=None):
+        self.config = config or SessionConfig()
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._refcount = 0
+        self._shm = None
+
+        # Key expression -> publisher
+        self._publishers = {}
+        # Key expression -> (subscriber, fan out)
+        self._subscribers = {}
+
+    @property
+    def session(self):
+        return self._session
+
+    def acquire(self):
+        '''
+        Take a reference to the shared session, opening it on first use.
+        '''
+        with self._lock:
+            if self._session is None:
+                self._session = zenoh.open(self.config.to_zenoh_config())
+                if self.config.shm and self._shm is None:
+                    self._shm = ShmPayloads(self.config.shm_pool_size)
+            self._refcount += 1
+            return self._session
+
+    def release(self):
+        '''
+        Drop a reference to the shared session, closing it when the last user is done.
+        '''
+        with self._lock:
+            if self._refcount == 0:
+                return
+            self._refcount -= 1
+            if self._refcount == 0:
+                self._publishers.clear()
+                self._subscribers.clear()
+                self._session.close()
+                self._session = None
+
+    def payload(self, data):
+        '''
+        data ready to be put on a publisher of the session: in shared memory with --shm, else as is.
+        '''
+        if self._shm is None:
+            return data
+        return self._shm.payload(data)
+
+    def declare_publisher(self, key_expr):
+        '''
+        Get the publisher for key_expr, declaring it on first use.
+        '''
+        with self._lock:
+            publisher = self._publishers.get(key_expr)
+            if publisher is None:
+                publisher = self._session.declare_publisher(key_expr)
+                self._publishers[key_expr] = publisher
+            return publisher
+
+    def declare_subscriber(self, key_expr, handler):
+        '''
+        Register handler for samples on key_expr. Handlers on the same key expression share a
+        single zenoh subscriber.
+        '''
+        with self._lock:
+            entry = self._subscribers.get(key_expr)
+            if entry is None:
+                fan_out = _FanOut()
+                # Runs on zenoh's threads, so --profile can only see it through profiled()
+                entry = (self._session.declare_subscriber(key_expr, profiled(fan_out)), fan_out)
+                self._subscribers[key_expr] = entry
+            fan_out = entry[1]
+            fan_out.handlers = fan_out.handlers + (handler,)
+
+    def undeclare_subscriber(self, key_expr, handler):
+        '''
+        Unregister handler from key_expr, undeclaring the zenoh subscriber once unused.
+        '''
+        with self._lock:
+            entry = self._subscribers.get(key_expr)
+            if entry is None:
+                return
+            subscriber, fan_out = entry
+            fan_out.handlers = tuple(h for h in fan_out.handlers if h != handler)
+            if not fan_out.handlers:
+                subscriber.undeclare()
+                del self._subscribers[key_expr]
+
+
+if __name__ == '__main__':
+    print("Please run roc_main.py instead.")
+    sys.exit(1)
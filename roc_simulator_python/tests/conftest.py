@@ -0,0 +1,10 @@
+'''
+Unit tests of the ROC simulator. Run from the roc_simulator_python directory:
+```python3 -m pytest tests```.
+'''
+
+import os
+import sys
+
+# The ROC simulator modules live in ../src and import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,74 @@
+import json
+import types
+from unittest import mock
+
+import pytest
+
+from gui_pump import LatestValueSlots
+from handover import COMPLETED, HandoverStatus
+from ingest import IngestClient
+from shared_state import SharedStateReader, SharedStateWriter
+
+
+@pytest.fixture
+def state():
+    writer = SharedStateWriter(max_vessels=4)
+    reader = SharedStateReader(writer.name, shared_tracker=True)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+def viewer_client(reader, ship_id):
+    # An IngestClient as connected to an ingest process, without the connection
+    client = IngestClient.__new__(IngestClient)
+    client.ship_id = ship_id
+    client.state = reader
+    return client
+
+
+def gui_field_renderers():
+    '''
+    field_renderers of a RocGui built without a display.
+    '''
+    import roc_gui
+    controller = types.SimpleNamespace(roc_id="ROC_1", ship_id="MASS_0")
+    with mock.patch.object(roc_gui, "tk"):
+        gui = roc_gui.RocGui(controller)
+    return gui.field_renderers
+
+
+def test_poll_with_gui_field_renderers(state):
+    writer, reader = state
+    writer.write("MASS_0", "location", (63.1, 21.5))
+    writer.write("MASS_0", "cog", 90.0)
+    writer.write("MASS_0", "name", "Seabat")
+    writer.write("MASS_0", "countdown", 42.0)
+    handover = HandoverStatus("MASS_0", COMPLETED, "ROC_1", "ROC_2", None, None)
+    writer.write("MASS_0", "handover", json.dumps(handover._asdict()))
+
+    fields = gui_field_renderers()
+    # Rendered by the GUI, but not kept in the shared state
+    assert "collision_alerts" in fields
+
+    client = viewer_client(reader, "MASS_0")
+    slots = LatestValueSlots()
+    client.poll(slots, fields)
+    updates = {field: args for field, (_, args) in slots.drain().items()}
+    assert updates == {
+        "location": (63.1, 21.5),
+        "cog": (90.0,),
+        "name": ("Seabat",),
+        "countdown": (42,),
+        "handover": (handover,),
+    }
+
+    # Nothing changed since
+    client.poll(slots, fields)
+    assert slots.drain() == {}
+
+
+def test_changes_skips_unknown_fields(state):
+    writer, reader = state
+    writer.write("MASS_0", "sog", 5.0)
+    assert reader.changes("MASS_0", ["sog", "collision_alerts"]) == {"sog": 5.0}
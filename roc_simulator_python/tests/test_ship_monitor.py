@@ -0,0 +1,106 @@
+import os
+import time
+
+from keelson import enclose, uncover
+from keelson.payloads.foxglove.LocationFix_pb2 import LocationFix
+from keelson.payloads.Primitives_pb2 import TimestampedFloat
+from keelson.payloads.ROCStatus_pb2 import ROCStatus
+
+from flight_recorder import FlightRecorder, RecordedSample, ReplaySource
+from ship_monitor import BASE_PATH, DECODE_MESSAGE_REUSE, ShipTelemetryMonitor
+
+COG = "pubsub/course_over_ground_deg/gnss/0"
+LOCATION = "pubsub/location_fix/gnss/0"
+
+
+def key(vessel_id, topic):
+    return f"{BASE_PATH}/{vessel_id}/{topic}"
+
+
+def timestamped_float(value, timestamp_ns=None):
+    msg = TimestampedFloat()
+    msg.timestamp.FromNanoseconds(timestamp_ns or time.time_ns())
+    msg.value = value
+    return enclose(msg.SerializeToString())
+
+
+def location_fix(lat, lon):
+    msg = LocationFix()
+    msg.timestamp.FromNanoseconds(time.time_ns())
+    msg.latitude = lat
+    msg.longitude = lon
+    return enclose(msg.SerializeToString())
+
+
+def test_single_ship_replay_ignores_other_vessels(tmp_path):
+    path = os.path.join(tmp_path, "fleet.log")
+    recorder = FlightRecorder(path)
+    for vessel_id, cog in (("MASS_0", 10.0), ("MASS_1", 200.0), ("MASS_0", 20.0), ("MASS_1", 210.0)):
+        recorder.record(key(vessel_id, COG), timestamped_float(cog))
+        recorder.record(key(vessel_id, LOCATION), location_fix(63.0 + cog / 1000, 21.0))
+    recorder.close()
+
+    cogs = []
+    locations = []
+    monitor = ShipTelemetryMonitor("MASS_0", {"handle_cog": cogs.append,
+                                              "handle_location": lambda lat, lon: locations.append(lat)},
+                                   live=False)
+    ReplaySource(path, monitor, speed=0).run()
+
+    assert cogs == [10.0, 20.0]
+    assert locations == [63.01, 63.02]
+    assert list(monitor.vessels) == ["MASS_0"]
+    assert monitor.cog == 20.0
+
+
+def test_fleet_monitor_takes_every_vessel():
+    cogs = []
+    monitor = ShipTelemetryMonitor("MASS_0", {"handle_cog": lambda vessel_id, cog: cogs.append((vessel_id, cog))},
+                                   fleet=True, live=False)
+    monitor.on_sample(RecordedSample(key("MASS_1", COG), timestamped_float(200.0)))
+    monitor.on_sample(RecordedSample(key("MASS_0", COG), timestamped_float(10.0)))
+    assert cogs == [("MASS_1", 200.0), ("MASS_0", 10.0)]
+
+
+def test_decode_across_message_renewals():
+    monitor = ShipTelemetryMonitor("MASS_0", {}, live=False)
+    count = 2 * DECODE_MESSAGE_REUSE + 10
+    envelopes = []
+    for i in range(count):
+        # Every third value is 0.0, which isn't on the wire at all in proto3
+        value = 0.0 if i % 3 == 0 else float(i)
+        payload = timestamped_float(value, timestamp_ns=1_000_000_000 + i)
+        expected = TimestampedFloat.FromString(uncover(payload)[2])
+
+        msg = monitor._decode(payload, TimestampedFloat)
+        assert msg == expected
+        assert msg.value == value
+        assert msg.timestamp.ToNanoseconds() == 1_000_000_000 + i
+
+        envelope = monitor._buffers.messages[TimestampedFloat][0]
+        if not envelopes or envelopes[-1] is not envelope:
+            envelopes.append(envelope)
+
+    # Reused for DECODE_MESSAGE_REUSE parses, then replaced
+    assert len(envelopes) == -(-count // DECODE_MESSAGE_REUSE)
+
+
+def test_decode_resets_reused_message():
+    monitor = ShipTelemetryMonitor("MASS_0", {}, live=False)
+    full = ROCStatus()
+    full.timestamp.FromNanoseconds(time.time_ns())
+    for roc_id in ("ROC_1", "ROC_2"):
+        entity = full.entities.add()
+        entity.entity_id = roc_id
+        entity.state = ROCStatus.ROCEntity.CONTROLLING
+
+    msg = monitor._decode(enclose(full.SerializeToString()), ROCStatus)
+    assert [entity.entity_id for entity in msg.entities] == ["ROC_1", "ROC_2"]
+    envelope = monitor._buffers.messages[ROCStatus][0]
+
+    # Nothing of the previous sample may show through fields the next one leaves out
+    msg = monitor._decode(enclose(ROCStatus().SerializeToString()), ROCStatus)
+    assert monitor._buffers.messages[ROCStatus][0] is envelope
+    assert msg == ROCStatus()
+    assert not msg.HasField("timestamp")
+    assert len(msg.entities) == 0
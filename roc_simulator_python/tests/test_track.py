@@ -0,0 +1,84 @@
+import math
+import random
+
+from track import SIMPLIFY_CHUNK, TrackHistory, douglas_peucker, to_map_pixels
+
+
+def wander(count, seed=1):
+    rng = random.Random(seed)
+    lat, lon, course = 60.0, 20.0, 0.0
+    for _ in range(count):
+        course += rng.gauss(0, 5)
+        lat += 1e-4 * math.cos(math.radians(course))
+        lon += 2e-4 * math.sin(math.radians(course))
+        yield lat, lon
+
+
+def segment_distance(point, a, b):
+    (px, py), (x1, y1), (x2, y2) = point, a, b
+    dx, dy = x2 - x1, y2 - y1
+    length_sq = dx * dx + dy * dy
+    t = min(max(((px - x1) * dx + (py - y1) * dy) / length_sq, 0.0), 1.0) if length_sq else 0.0
+    return math.hypot(px - x1 - t * dx, py - y1 - t * dy)
+
+
+def test_douglas_peucker_measures_to_segment_ends():
+    # The far end of an out and back leg is far from the segment, though on its line
+    assert douglas_peucker([(0, 0), (10, 0), (1, 0)], 1.0) == [0, 1, 2]
+
+
+def test_simplified_within_tolerance_while_appending():
+    zoom, tolerance = 12, 1.5
+    track = TrackHistory(3 * SIMPLIFY_CHUNK)
+    for i, (lat, lon) in enumerate(wander(5 * SIMPLIFY_CHUNK)):
+        track.append(lat, lon)
+        if i % 37 != 36:
+            continue
+        trail = track.simplified(zoom, tolerance)
+        assert trail[0] == track.points[0] and trail[-1] == track.points[-1]
+
+        projected = [to_map_pixels(lat, lon, zoom) for lat, lon in trail]
+        for point in track.points:
+            x, y = to_map_pixels(*point, zoom)
+            assert min(segment_distance((x, y), a, b) for a, b in zip(projected, projected[1:])) <= tolerance + 1e-9
+
+
+def test_simplified_matches_fresh_track():
+    track = TrackHistory(2 * SIMPLIFY_CHUNK + 50)
+    positions = list(wander(4 * SIMPLIFY_CHUNK))
+    for i, (lat, lon) in enumerate(positions):
+        track.append(lat, lon)
+        if i % 41:
+            continue
+        for zoom in (10, 14):
+            fresh = TrackHistory(track.points.maxlen)
+            fresh.appended = track.appended - len(track.points) # The same chunk bounds
+            for point in track.points:
+                fresh.points.append(point)
+                fresh.appended += 1
+            assert track.simplified(zoom, 1.5) == fresh.simplified(zoom, 1.5)
+
+
+def test_simplified_reused_until_track_changes():
+    track = TrackHistory(1000)
+    for lat, lon in wander(600):
+        track.append(lat, lon)
+    trail = track.simplified(12, 1.5)
+    assert track.simplified(12, 1.5) is trail
+    assert track.simplified(13, 1.5) is not trail
+
+    trail = track.simplified(13, 1.5)
+    track.append(*track.points[-1]) # Same position again, nothing changes
+    assert track.simplified(13, 1.5) is trail
+    track.append(61.0, 21.0)
+    changed = track.simplified(13, 1.5)
+    assert changed is not trail and changed[-1] == (61.0, 21.0)
+
+
+def test_simplified_short_tracks():
+    track = TrackHistory(10)
+    assert track.simplified(12, 1.5) == []
+    track.append(60.0, 20.0)
+    assert track.simplified(12, 1.5) == [(60.0, 20.0)]
+    track.append(60.1, 20.0)
+    assert track.simplified(12, 1.5) == [(60.0, 20.0), (60.1, 20.0)]